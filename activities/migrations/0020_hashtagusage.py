@@ -0,0 +1,51 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:34
+
+from django.db import migrations, models
+
+
+def hashtag_recount(apps, schema_editor):
+    """
+    Sends every hashtag back to outdated, so Stator builds its usage counts
+    """
+    Hashtag = apps.get_model("activities", "hashtag")
+    Hashtag.objects.update(state="outdated", state_next_attempt=None)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("activities", "0019_alter_postattachment_focal_x_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HashtagUsage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("hashtag", models.SlugField(max_length=100)),
+                ("day", models.DateField()),
+                ("count", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name="hashtag",
+            name="stats",
+        ),
+        migrations.AddConstraint(
+            model_name="hashtagusage",
+            constraint=models.UniqueConstraint(
+                fields=("hashtag", "day"), name="unique_hashtag_usage"
+            ),
+        ),
+        migrations.RunPython(
+            code=hashtag_recount,
+            reverse_code=lambda a, s: None,
+        ),
+    ]
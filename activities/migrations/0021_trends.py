@@ -0,0 +1,108 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:39
+
+from django.db import migrations, models
+
+import activities.models.trend
+import stator.models
+
+
+def trend_create(apps, schema_editor):
+    """
+    Makes the row for each kind of trend, so Stator starts refreshing them
+    """
+    Trend = apps.get_model("activities", "trend")
+    for kind in ["tags", "statuses", "links"]:
+        Trend.objects.get_or_create(kind=kind)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("activities", "0020_hashtagusage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Trend",
+            fields=[
+                ("state_changed", models.DateTimeField(auto_now_add=True)),
+                ("state_next_attempt", models.DateTimeField(blank=True, null=True)),
+                (
+                    "state_locked_until",
+                    models.DateTimeField(blank=True, db_index=True, null=True),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("tags", "Tags"),
+                            ("statuses", "Statuses"),
+                            ("links", "Links"),
+                        ],
+                        max_length=20,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                (
+                    "state",
+                    stator.models.StateField(
+                        choices=[("refreshing", "refreshing")],
+                        default="refreshing",
+                        graph=activities.models.trend.TrendStates,
+                        max_length=100,
+                    ),
+                ),
+                ("items", models.JSONField(default=list)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("updated", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="TrendScore",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("tags", "Tags"),
+                            ("statuses", "Statuses"),
+                            ("links", "Links"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("key", models.CharField(max_length=2048)),
+                ("score", models.FloatField(default=0)),
+                ("scored", models.DateTimeField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="trendscore",
+            constraint=models.UniqueConstraint(
+                fields=("kind", "key"), name="unique_trend_score"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="trend",
+            index=models.Index(
+                fields=["state", "state_next_attempt", "state_locked_until"],
+                name="ix_trend_state_next",
+            ),
+        ),
+        migrations.RunPython(
+            code=trend_create,
+            reverse_code=lambda a, s: None,
+        ),
+    ]
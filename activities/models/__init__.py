@@ -1,7 +1,8 @@
 from .emoji import Emoji, EmojiStates  # noqa
 from .fan_out import FanOut, FanOutStates  # noqa
-from .hashtag import Hashtag, HashtagStates  # noqa
+from .hashtag import Hashtag, HashtagStates, HashtagUsage  # noqa
 from .post import Post, PostStates  # noqa
 from .post_attachment import PostAttachment, PostAttachmentStates  # noqa
 from .post_interaction import PostInteraction, PostInteractionStates  # noqa
 from .timeline_event import TimelineEvent  # noqa
+from .trend import Trend, TrendScore, TrendStates  # noqa
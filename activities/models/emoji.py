@@ -243,15 +243,52 @@ class Emoji(StatorModel):
         Return a parsed and sanitized of emoji found in content without
         the surrounding ':'.
         """
-        emoji_hits = FediverseHtmlParser(
-            content, find_emojis=True, emoji_domain=domain
-        ).emojis
-        emojis = sorted({emoji for emoji in emoji_hits})
-        return list(
-            cls.objects.filter(local=(domain is None) or domain.local)
-            .usable(domain)
-            .filter(shortcode__in=emojis)
-        )
+        return cls.emojis_from_contents([(content, domain)])[0]
+
+    @classmethod
+    def emojis_from_contents(
+        cls, contents: list[tuple[str, Domain | None]]
+    ) -> list[list["Emoji"]]:
+        """
+        Does emojis_from_content for several pieces of content (each with
+        their own domain) in a single query.
+        """
+        # Work out which shortcodes each piece of content wants, and from where
+        wanted: list[tuple[str | None, set[str]]] = []
+        for content, domain in contents:
+            emoji_hits = FediverseHtmlParser(
+                content, find_emojis=True, emoji_domain=domain
+            ).emojis
+            # Local emoji are looked up without a domain; remote ones only
+            # come from the content's own domain
+            source = None if (domain is None or domain.local) else domain.pk
+            wanted.append((source, set(emoji_hits)))
+        by_source: dict[str | None, set[str]] = {}
+        for source, shortcodes in wanted:
+            if shortcodes:
+                by_source.setdefault(source, set()).update(shortcodes)
+        if not by_source:
+            return [[] for _ in contents]
+        query = models.Q()
+        for source, shortcodes in by_source.items():
+            if source is None:
+                query |= models.Q(local=True, shortcode__in=shortcodes)
+            else:
+                query |= models.Q(
+                    local=False, domain_id=source, shortcode__in=shortcodes
+                )
+        found: dict[tuple[str | None, str], list[Emoji]] = {}
+        for emoji in cls.objects.usable().filter(query).order_by("shortcode", "pk"):
+            source = None if emoji.local else emoji.domain_id
+            found.setdefault((source, emoji.shortcode), []).append(emoji)
+        return [
+            [
+                emoji
+                for shortcode in sorted(shortcodes)
+                for emoji in found.get((source, shortcode), [])
+            ]
+            for source, shortcodes in wanted
+        ]
 
     def to_ap_tag(self):
         """
@@ -1,10 +1,23 @@
+import asyncio
+import datetime
+import logging
+import threading
+from collections.abc import Iterable, Iterator
+from itertools import islice
+from typing import NamedTuple
+
 import httpx
-from django.db import models
+from cachetools import TTLCache
+from django.db import models, transaction
+from django.db.models.functions import Cast, Concat, Now
+from django.utils import timezone
 
 from activities.models.timeline_event import TimelineEvent
 from core.ld import canonicalise
-from stator.models import State, StateField, StateGraph, StatorModel
-from users.models import Block, FollowStates
+from stator.models import State, StateField, StateGraph, StatorModel, in_db_pool
+from users.models import Block, Domain, FollowStates, Identity
+
+logger = logging.getLogger(__name__)
 
 
 class FanOutStates(StateGraph):
@@ -27,6 +40,10 @@ class FanOutStates(StateGraph):
         if not (instance.identity.local or instance.identity.inbox_uri):
             return
 
+        # Remote deliveries are batched up with their siblings
+        if not instance.identity.local:
+            return cls.deliver_remote(instance)
+
         match (instance.type, instance.identity.local):
             # Handle creating/updating local posts
             case ((FanOut.Types.post | FanOut.Types.post_edited), True):
@@ -71,38 +88,6 @@ class FanOutStates(StateGraph):
                         post=post,
                     )
 
-            # Handle sending remote posts create
-            case (FanOut.Types.post, False):
-                post = instance.subject_post
-                # Sign it and send it
-                try:
-                    post.author.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(post.to_create_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
-            # Handle sending remote posts update
-            case (FanOut.Types.post_edited, False):
-                post = instance.subject_post
-                # Sign it and send it
-                try:
-                    post.author.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(post.to_update_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
             # Handle deleting local posts
             case (FanOut.Types.post_deleted, True):
                 post = instance.subject_post
@@ -113,22 +98,6 @@ class FanOutStates(StateGraph):
                         subject_post=post,
                     ).delete()
 
-            # Handle sending remote post deletes
-            case (FanOut.Types.post_deleted, False):
-                post = instance.subject_post
-                # Send it to the remote inbox
-                try:
-                    post.author.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(post.to_delete_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
             # Handle local boosts/likes
             case (FanOut.Types.interaction, True):
                 interaction = instance.subject_post_interaction
@@ -160,28 +129,6 @@ class FanOutStates(StateGraph):
                     interaction=interaction,
                 )
 
-            # Handle sending remote boosts/likes/votes/pins
-            case (FanOut.Types.interaction, False):
-                interaction = instance.subject_post_interaction
-                # Send it to the remote inbox
-                try:
-                    if interaction.type == interaction.Types.vote:
-                        body = interaction.to_create_ap()
-                    elif interaction.type == interaction.Types.pin:
-                        body = interaction.to_add_ap()
-                    else:
-                        body = interaction.to_ap()
-                    interaction.identity.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(body),
-                    )
-                except httpx.RequestError:
-                    return
-
             # Handle undoing local boosts/likes
             case (FanOut.Types.undo_interaction, True):  # noqa:F841
                 interaction = instance.subject_post_interaction
@@ -192,60 +139,6 @@ class FanOutStates(StateGraph):
                     interaction=interaction,
                 )
 
-            # Handle sending remote undoing boosts/likes/pins
-            case (FanOut.Types.undo_interaction, False):  # noqa:F841
-                interaction = instance.subject_post_interaction
-                # Send an undo to the remote inbox
-                try:
-                    if interaction.type == interaction.Types.pin:
-                        body = interaction.to_remove_ap()
-                    else:
-                        body = interaction.to_undo_ap()
-                    interaction.identity.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(body),
-                    )
-                except httpx.RequestError:
-                    return
-
-            # Handle sending identity edited to remote
-            case (FanOut.Types.identity_edited, False):
-                identity = instance.subject_identity
-                try:
-                    identity.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(instance.subject_identity.to_update_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
-            # Handle sending identity deleted to remote
-            case (FanOut.Types.identity_deleted, False):
-                identity = instance.subject_identity
-                try:
-                    identity.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(instance.subject_identity.to_delete_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
-            # Handle sending identity moved to remote
-            case (FanOut.Types.identity_moved, False):
-                raise NotImplementedError()
-
             # Sending identity edited/deleted to local is a no-op
             case (FanOut.Types.identity_edited, True):
                 pass
@@ -266,6 +159,160 @@ class FanOutStates(StateGraph):
 
         return cls.sent
 
+    @classmethod
+    async def ahandle_new(cls, instance: "FanOut"):
+        """
+        Async version of handle_new for the asyncio runner: remote deliveries
+        wait on other servers on the event loop, and everything else is
+        database work that goes to the pool.
+        """
+        identity = await in_db_pool(getattr, instance, "identity")
+        if not identity.local and identity.inbox_uri:
+            return await cls.adeliver_remote(instance)
+        return await in_db_pool(cls.handle_new, instance)
+
+    @classmethod
+    def deliver_remote(cls, instance: "FanOut"):
+        """
+        Sends a remote fan-out, along with any other pending fan-outs for the
+        same activity that we can claim, as one request per distinct inbox.
+        Each row then gets its own outcome.
+        """
+        delivery = RemoteDelivery(instance)
+        for uri, fan_outs in delivery.inboxes.items():
+            if delivery.backing_off(fan_outs):
+                continue
+            try:
+                outcome = delivery.signer.signed_request(
+                    method="post", uri=uri, body=delivery.body
+                )
+            except Exception as e:
+                outcome = e
+            delivery.record(fan_outs, outcome)
+        return delivery.finish()
+
+    @classmethod
+    async def adeliver_remote(cls, instance: "FanOut"):
+        """
+        Async version of deliver_remote. Each server's inboxes are still sent
+        to one after another (so a failure can hold back the rest), but all
+        the servers are sent to at once.
+        """
+        delivery = await in_db_pool(RemoteDelivery, instance)
+
+        async def deliver_domain(inboxes: list[tuple[str, list[FanOut]]]):
+            for uri, fan_outs in inboxes:
+                if delivery.backing_off(fan_outs):
+                    continue
+                try:
+                    outcome = await delivery.signer.asigned_request(
+                        method="post", uri=uri, body=delivery.body
+                    )
+                except Exception as e:
+                    outcome = e
+                await in_db_pool(delivery.record, fan_outs, outcome)
+
+        domains: dict[str | None, list[tuple[str, list[FanOut]]]] = {}
+        for uri, fan_outs in delivery.inboxes.items():
+            domains.setdefault(fan_outs[0].identity.domain_id, []).append(
+                (uri, fan_outs)
+            )
+        await asyncio.gather(*(deliver_domain(inboxes) for inboxes in domains.values()))
+        return await in_db_pool(delivery.finish)
+
+
+class RemoteDelivery:
+    """
+    One remote fan-out plus the siblings it claimed, grouped by inbox, and
+    what happened when each inbox was sent to.
+    """
+
+    def __init__(self, instance: "FanOut"):
+        self.instance = instance
+        self.signer, self.body = instance.remote_activity()
+        batch = [instance] + instance.claim_siblings(FanOut.DELIVERY_BATCH_SIZE)
+        # Group everything we're sending by the inbox it's going to
+        self.inboxes: dict[str, list[FanOut]] = {}
+        for fan_out in batch:
+            uri = fan_out.identity.shared_inbox_uri or fan_out.identity.inbox_uri
+            self.inboxes.setdefault(uri, []).append(fan_out)
+        self.sent: list[FanOut] = []
+        self.failed: list[FanOut] = []
+        self.error: Exception | None = None
+        # Retry waits for domains that have failed during this batch
+        self.backoffs: dict[str, float] = {}
+
+    def backing_off(self, fan_outs: list["FanOut"]) -> bool:
+        """
+        Fails the fan-outs straight away if their server has just failed us.
+        """
+        domain = fan_outs[0].identity.domain_id
+        if domain not in self.backoffs:
+            return False
+        for fan_out in fan_outs:
+            fan_out.delivery_retry_in = self.backoffs[domain]
+        self.failed.extend(fan_outs)
+        return True
+
+    def record(self, fan_outs: list["FanOut"], outcome: httpx.Response | Exception):
+        """
+        Records the response (or error) from sending to one inbox.
+        """
+        domain = fan_outs[0].identity.domain_id
+        if isinstance(outcome, Exception) and not isinstance(
+            outcome, httpx.RequestError
+        ):
+            self.failed.extend(fan_outs)
+            # Keep the error for the instance we were asked to handle so
+            # the runner still sees it; siblings just get retried
+            if self.instance in fan_outs:
+                self.error = outcome
+            else:
+                logger.exception(outcome)
+        elif (
+            isinstance(outcome, httpx.Response)
+            and outcome.status_code not in FanOut.RETRY_STATUSES
+        ):
+            self.sent.extend(fan_outs)
+            if domain:
+                Domain.record_delivery_success(domain)
+        else:
+            self.failed.extend(fan_outs)
+            if domain:
+                self.backoffs[domain] = Domain.record_delivery_failure(domain)
+                for fan_out in fan_outs:
+                    fan_out.delivery_retry_in = self.backoffs[domain]
+
+    def finish(self) -> State | None:
+        """
+        Records the outcome of the siblings, and returns our own.
+        """
+        FanOut.transition_perform_queryset(
+            FanOut.objects.filter(
+                pk__in=[fan_out.pk for fan_out in self.sent if fan_out != self.instance]
+            ),
+            FanOutStates.sent,
+        )
+        for fan_out in self.failed:
+            if fan_out != self.instance:
+                fan_out.transition_resolve(FanOutStates.new, None)
+        if self.error is not None:
+            raise self.error
+        if self.instance in self.sent:
+            return FanOutStates.sent
+        return None
+
+
+class FanOutTarget(NamedTuple):
+    """
+    Just enough about a fan-out target to make its FanOut row
+    """
+
+    identity_id: int
+    local: bool
+    # Where remote deliveries go (the shared inbox if there is one)
+    inbox: str | None
+
 
 class FanOut(StatorModel):
     """
@@ -283,6 +330,38 @@ class FanOut(StatorModel):
         identity_created = "identity_created"
         identity_moved = "identity_moved"
 
+    # How many pending rows for the same activity one delivery can pick up
+    DELIVERY_BATCH_SIZE = 20
+
+    # How long claimed sibling rows stay locked while we deliver them
+    DELIVERY_LOCK_SECONDS = 300
+
+    # Responses that mean the other server is struggling, not that it
+    # rejected the activity
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    # Timeline inserts for local users go first, then first attempts at
+    # remote delivery, then retries of remote deliveries that failed before
+    state_lanes = [
+        ("local", models.Q(identity__local=True)),
+        (
+            "remote",
+            models.Q(identity__local=False, state_next_attempt__isnull=True),
+        ),
+        (
+            "retry",
+            models.Q(identity__local=False, state_next_attempt__isnull=False),
+        ),
+    ]
+
+    # Seconds to wait before retrying a failed delivery, if it's been
+    # worked out from the destination's health
+    delivery_retry_in: float | None = None
+
+    # Canonicalised activity bodies, shared between deliveries of one activity
+    activity_cache: TTLCache = TTLCache(maxsize=200, ttl=3600)
+    activity_cache_lock = threading.Lock()
+
     state = StateField(FanOutStates)
 
     # The user this event is targeted at
@@ -323,3 +402,170 @@ class FanOut(StatorModel):
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+
+    ### Remote delivery ###
+
+    def remote_activity(self) -> tuple:
+        """
+        Returns the identity that signs this fan-out and its canonicalised
+        body. The body only depends on the activity, so it's built once and
+        shared between all fan-outs that carry it.
+        """
+        match self.type:
+            case (
+                FanOut.Types.post | FanOut.Types.post_edited | FanOut.Types.post_deleted
+            ):
+                subject = self.subject_post
+                signer = subject.author
+            case (FanOut.Types.interaction | FanOut.Types.undo_interaction):
+                subject = self.subject_post_interaction
+                signer = subject.identity
+            case (FanOut.Types.identity_edited | FanOut.Types.identity_deleted):
+                subject = self.subject_identity
+                signer = subject
+            case FanOut.Types.identity_moved:
+                raise NotImplementedError()
+            case _:
+                raise ValueError(f"Cannot fan out with type {self.type} local=False")
+        key = (
+            self.type,
+            self.subject_post_id,
+            self.subject_post_interaction_id,
+            self.subject_identity_id,
+            subject.updated,
+        )
+        with self.activity_cache_lock:
+            body = self.activity_cache.get(key)
+        if body is None:
+            body = canonicalise(self.build_remote_activity(subject))
+            with self.activity_cache_lock:
+                self.activity_cache[key] = body
+        return signer, body
+
+    def build_remote_activity(self, subject) -> dict:
+        """
+        Serializes the subject into the activity this fan-out type sends.
+        """
+        match self.type:
+            case FanOut.Types.post:
+                return subject.to_create_ap()
+            case FanOut.Types.post_edited:
+                return subject.to_update_ap()
+            case FanOut.Types.post_deleted:
+                return subject.to_delete_ap()
+            case FanOut.Types.interaction:
+                if subject.type == subject.Types.vote:
+                    return subject.to_create_ap()
+                elif subject.type == subject.Types.pin:
+                    return subject.to_add_ap()
+                return subject.to_ap()
+            case FanOut.Types.undo_interaction:
+                if subject.type == subject.Types.pin:
+                    return subject.to_remove_ap()
+                return subject.to_undo_ap()
+            case FanOut.Types.identity_edited:
+                return subject.to_update_ap()
+            case FanOut.Types.identity_deleted:
+                return subject.to_delete_ap()
+        raise ValueError(f"Cannot fan out with type {self.type} local=False")
+
+    # How many targets are read, and FanOuts written, at once
+    TARGET_CHUNK_SIZE = 2000
+
+    @classmethod
+    def resolve_targets(
+        cls, candidates: models.Q, sender_id: int
+    ) -> Iterator[FanOutTarget]:
+        """
+        Yields the identities matching `candidates` that should get a copy of
+        something from the sender, leaving out those the sender has fully
+        blocked, and only one remote identity per shared inbox.
+
+        This is all done in the database and streamed out in chunks, so it's
+        safe for identities with huge follower counts.
+        """
+        has_shared_inbox = models.Q(local=False, shared_inbox_uri__gt="")
+        targets = (
+            Identity.objects.filter(candidates)
+            .exclude(
+                pk__in=Block.objects.active()
+                .filter(source_id=sender_id, mute=False)
+                .values("target_id")
+            )
+            .annotate(
+                inbox_key=models.Case(
+                    models.When(has_shared_inbox, then=models.F("shared_inbox_uri")),
+                    default=Concat(models.Value("#"), Cast("pk", models.CharField())),
+                ),
+                target_inbox=models.Case(
+                    models.When(local=True, then=models.Value(None)),
+                    models.When(has_shared_inbox, then=models.F("shared_inbox_uri")),
+                    default=models.F("inbox_uri"),
+                ),
+            )
+            .order_by("inbox_key", "pk")
+            .distinct("inbox_key")
+            .values_list("pk", "local", "target_inbox", "inbox_key")
+        )
+        for identity_id, local, inbox, _ in targets.iterator(
+            chunk_size=cls.TARGET_CHUNK_SIZE
+        ):
+            yield FanOutTarget(identity_id, local, inbox)
+
+    @classmethod
+    def create_for_targets(cls, targets: Iterable[FanOutTarget], **kwargs) -> None:
+        """
+        Creates a FanOut (with the given fields) for each target, in chunks.
+        """
+        targets = iter(targets)
+        while chunk := list(islice(targets, cls.TARGET_CHUNK_SIZE)):
+            cls.objects.bulk_create(
+                [cls(identity_id=target.identity_id, **kwargs) for target in chunk]
+            )
+
+    @classmethod
+    def transition_claim_filter(cls) -> models.Q:
+        """
+        Holds back deliveries to servers whose circuit is open.
+        """
+        return models.Q(identity__domain__delivery_retry_after__isnull=True) | models.Q(
+            identity__domain__delivery_retry_after__lte=Now()
+        )
+
+    def transition_retry_interval(self, state: State) -> float:
+        if self.delivery_retry_in is not None:
+            return self.delivery_retry_in
+        return super().transition_retry_interval(state)
+
+    def claim_siblings(self, number: int) -> list["FanOut"]:
+        """
+        Locks and returns up to `number` other pending remote fan-outs that
+        carry the same activity as this one, skipping any another runner
+        already holds.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            siblings = list(
+                FanOut.objects.filter(
+                    models.Q(state_next_attempt__isnull=True)
+                    | models.Q(state_next_attempt__lte=now),
+                    FanOut.transition_claim_filter(),
+                    type=self.type,
+                    subject_post_id=self.subject_post_id,
+                    subject_post_interaction_id=self.subject_post_interaction_id,
+                    subject_identity_id=self.subject_identity_id,
+                    state=FanOutStates.new,
+                    state_locked_until__isnull=True,
+                    identity__local=False,
+                    identity__inbox_uri__isnull=False,
+                )
+                .exclude(pk=self.pk)
+                .select_related("identity")
+                .select_for_update(skip_locked=True, of=("self",))[:number]
+            )
+            FanOut.objects.filter(pk__in=[s.pk for s in siblings]).update(
+                state_locked_until=(
+                    now + datetime.timedelta(seconds=self.DELIVERY_LOCK_SECONDS)
+                )
+            )
+        return siblings
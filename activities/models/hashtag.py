@@ -1,8 +1,10 @@
 import re
-from datetime import date, timedelta
+from collections.abc import Iterable
+from datetime import date
 
 import urlman
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.functions import TruncDate, TruncMonth
 from django.utils import timezone
 
 from core.models import Config
@@ -19,35 +21,28 @@ class HashtagStates(StateGraph):
     @classmethod
     def handle_outdated(cls, instance: "Hashtag"):
         """
-        Computes the stats and other things for a Hashtag
+        Rebuilds the usage counts for a Hashtag from its posts. This only
+        happens when a hashtag is first seen or an admin asks for it; after
+        that posts keep the counts up to date as they come and go.
         """
-        from .post import Post
-
-        posts_query = Post.objects.local_public().tagged_with(instance)
-        total = posts_query.count()
-
-        today = timezone.now().date()
-        total_today = posts_query.filter(
-            created__gte=today,
-            created__lte=today + timedelta(days=1),
-        ).count()
-        total_month = posts_query.filter(
-            created__year=today.year,
-            created__month=today.month,
-        ).count()
-        total_year = posts_query.filter(
-            created__year=today.year,
-        ).count()
-        if total:
-            if not instance.stats:
-                instance.stats = {}
-            instance.stats.update(
-                {
-                    "total": total,
-                    today.isoformat(): total_today,
-                    today.strftime("%Y-%m"): total_month,
-                    today.strftime("%Y"): total_year,
-                }
+        from .post import Post, PostStates
+
+        days = (
+            Post.objects.local_public()
+            # Posts still in "deleted" have yet to take themselves off
+            .exclude(state=PostStates.deleted_fanned_out)
+            .filter(hashtags__contains=instance.hashtag)
+            .annotate(day=TruncDate("created"))
+            .values("day")
+            .annotate(number=models.Count("id"))
+        )
+        with transaction.atomic():
+            HashtagUsage.objects.filter(hashtag=instance.hashtag).delete()
+            HashtagUsage.objects.bulk_create(
+                HashtagUsage(
+                    hashtag=instance.hashtag, day=day["day"], count=day["number"]
+                )
+                for day in days
             )
             instance.stats_updated = timezone.now()
             instance.save()
@@ -94,9 +89,7 @@ class Hashtag(StatorModel):
     # State of this Hashtag
     state = StateField(HashtagStates)
 
-    # Metrics for this Hashtag
-    stats = models.JSONField(null=True, blank=True)
-    # Timestamp of last time the stats were updated
+    # Timestamp of last time the usage counts were rebuilt
     stats_updated = models.DateTimeField(null=True, blank=True)
 
     # List of other hashtags that are considered similar
@@ -132,36 +125,70 @@ class Hashtag(StatorModel):
     def __str__(self):
         return self.display_name
 
+    @property
+    def all_names(self) -> list[str]:
+        """
+        Returns the hashtag and its aliases, which all count as uses of it
+        """
+        return [self.hashtag, *(self.aliases or [])]
+
+    def usage(self):
+        return HashtagUsage.objects.filter(hashtag__in=self.all_names)
+
     def usage_months(self, num: int = 12) -> dict[date, int]:
         """
         Return the most recent num months of stats
         """
-        if not self.stats:
-            return {}
-        results = {}
-        for key, val in self.stats.items():
-            parts = key.split("-")
-            if len(parts) == 2:
-                year = int(parts[0])
-                month = int(parts[1])
-                results[date(year, month, 1)] = val
-        return dict(sorted(results.items(), reverse=True)[:num])
+        months = (
+            self.usage()
+            .annotate(month=TruncMonth("day"))
+            .values("month")
+            .annotate(total=models.Sum("count"))
+            .filter(total__gt=0)
+            .order_by("-month")[:num]
+        )
+        return {month["month"]: month["total"] for month in months}
 
     def usage_days(self, num: int = 7) -> dict[date, int]:
         """
         Return the most recent num days of stats
         """
-        if not self.stats:
-            return {}
-        results = {}
-        for key, val in self.stats.items():
-            parts = key.split("-")
-            if len(parts) == 3:
-                year = int(parts[0])
-                month = int(parts[1])
-                day = int(parts[2])
-                results[date(year, month, day)] = val
-        return dict(sorted(results.items(), reverse=True)[:num])
+        days = (
+            self.usage()
+            .values("day")
+            .annotate(total=models.Sum("count"))
+            .filter(total__gt=0)
+            .order_by("-day")[:num]
+        )
+        return {day["day"]: day["total"] for day in days}
+
+    @property
+    def usage_total(self) -> int:
+        """
+        Returns how many local public posts have ever used this hashtag
+        """
+        if "_usage_total" not in self.__dict__:
+            self.prefetch_usage_totals([self])
+        return self.__dict__["_usage_total"]
+
+    @classmethod
+    def prefetch_usage_totals(cls, hashtags: Iterable["Hashtag"]):
+        """
+        Works out usage_total for several hashtags in one query
+        """
+        hashtags = list(hashtags)
+        totals = dict(
+            HashtagUsage.objects.filter(
+                hashtag__in={name for tag in hashtags for name in tag.all_names}
+            )
+            .values("hashtag")
+            .annotate(total=models.Sum("count"))
+            .values_list("hashtag", "total")
+        )
+        for hashtag in hashtags:
+            hashtag.__dict__["_usage_total"] = sum(
+                totals.get(name, 0) for name in hashtag.all_names
+            )
 
     def to_mastodon_json(self, following: bool | None = None):
         value = {
@@ -174,3 +201,45 @@ class Hashtag(StatorModel):
             value["following"] = following
 
         return value
+
+
+class HashtagUsage(models.Model):
+    """
+    How many local public posts used a hashtag on each day, kept up to date
+    as posts are made, edited and deleted.
+    """
+
+    # Normalized hashtag without the '#' (not a foreign key, as posts can
+    # be counted before their Hashtag is made)
+    hashtag = models.SlugField(max_length=100)
+
+    day = models.DateField()
+
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["hashtag", "day"], name="unique_hashtag_usage"
+            )
+        ]
+
+    @classmethod
+    def add(cls, hashtags: Iterable[str], day: date, delta: int = 1):
+        """
+        Adds delta to each hashtag's count for the day, in one query
+        """
+        hashtags = sorted(set(hashtags))
+        if not hashtags or not delta:
+            return
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (hashtag, day, count)
+                SELECT unnest(%s::varchar[]), %s, GREATEST(%s, 0)
+                ON CONFLICT (hashtag, day) DO UPDATE
+                SET count = GREATEST({table}.count + %s, 0)
+                """,
+                [hashtags, day, delta, delta],
+            )
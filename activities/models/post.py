@@ -3,7 +3,7 @@ import json
 import logging
 import mimetypes
 import ssl
-from collections.abc import Iterable
+from collections.abc import Iterator
 from typing import Optional
 from urllib.parse import urlparse
 
@@ -20,14 +20,16 @@ from django.utils import timezone
 from pyld.jsonld import JsonLdError
 
 from activities.models.emoji import Emoji
-from activities.models.fan_out import FanOut
-from activities.models.hashtag import Hashtag, HashtagStates
+from activities.models.fan_out import FanOut, FanOutTarget
+from activities.models.hashtag import Hashtag, HashtagUsage
+from activities.models.post_attachment import PostAttachment
 from activities.models.post_types import (
     PostTypeData,
     PostTypeDataDecoder,
     PostTypeDataEncoder,
     QuestionData,
 )
+from activities.models.trend import TrendScore
 from core.exceptions import ActivityPubFormatError
 from core.html import ContentRenderer, FediverseHtmlParser
 from core.ld import (
@@ -40,7 +42,7 @@ from core.ld import (
 from core.snowflake import Snowflake
 from stator.exceptions import TryAgainLater
 from stator.models import State, StateField, StateGraph, StatorModel
-from users.models.follow import FollowStates
+from users.models.follow import Follow, FollowStates
 from users.models.hashtag_follow import HashtagFollow
 from users.models.identity import Identity, IdentityStates
 from users.models.inbox_message import InboxMessage
@@ -71,12 +73,9 @@ class PostStates(StateGraph):
     @classmethod
     def targets_fan_out(cls, post: "Post", type_: str) -> None:
         # Fan out to each target
-        for follow in post.get_targets():
-            FanOut.objects.create(
-                identity=follow,
-                type=type_,
-                subject_post=post,
-            )
+        FanOut.create_for_targets(
+            post.get_fan_out_targets(), type=type_, subject_post=post
+        )
 
     @classmethod
     def handle_new(cls, instance: "Post"):
@@ -90,6 +89,7 @@ class PostStates(StateGraph):
         ):
             cls.targets_fan_out(instance, FanOut.Types.post)
         instance.ensure_hashtags()
+        TrendScore.count_post(instance)
         return cls.fanned_out
 
     @classmethod
@@ -120,6 +120,11 @@ class PostStates(StateGraph):
         Creates all needed fan-out objects needed to delete a Post.
         """
         cls.targets_fan_out(instance, FanOut.Types.post_deleted)
+        HashtagUsage.add(
+            instance.counted_hashtags(),
+            timezone.localdate(instance.created),
+            delta=-1,
+        )
         return cls.deleted_fanned_out
 
     @classmethod
@@ -251,6 +256,9 @@ class Post(StatorModel):
         question = "Question"
         video = "Video"
 
+    # How many changes each transition_reconcile batch handles
+    RECONCILE_BATCH_SIZE = 500
+
     id = models.BigIntegerField(primary_key=True, default=Snowflake.generate_post)
 
     # The author (attributedTo) of the post
@@ -442,6 +450,12 @@ class Post(StatorModel):
             return func(local=local)
         return self._safe_content_note(local=local)  # fallback
 
+    def invalidate_rendered_content(self):
+        """
+        Forgets any cached renderings of the content; call before changing it.
+        """
+        ContentRenderer.invalidate(self, [("post", self.content)])
+
     def safe_content_local(self):
         """
         Returns the content formatted for local display
@@ -525,9 +539,10 @@ class Post(StatorModel):
                 post.type = question["type"]
                 post.type_data = PostTypeData(__root__=question).__root__
             post.save()
-            # Recalculate parent stats for replies
+            # Count the reply on its parent
             if reply_to:
-                reply_to.calculate_stats()
+                reply_to.adjust_stats(replies=1)
+            HashtagUsage.add(post.counted_hashtags(), timezone.localdate(post.created))
         return post
 
     def edit_local(
@@ -540,6 +555,8 @@ class Post(StatorModel):
         attachment_attributes: list | None = None,
     ):
         with transaction.atomic():
+            self.invalidate_rendered_content()
+            counted_hashtags = self.counted_hashtags()
             # Strip all HTML and apply linebreaks filter
             parser = FediverseHtmlParser(linebreaks_filter(content), find_hashtags=True)
             self.content = parser.html
@@ -555,6 +572,9 @@ class Post(StatorModel):
             self.emojis.set(Emoji.emojis_from_content(content, None))
             self.attachments.set(attachments or [])
             self.save()
+            day = timezone.localdate(self.created)
+            HashtagUsage.add(counted_hashtags - self.counted_hashtags(), day, -1)
+            HashtagUsage.add(self.counted_hashtags() - counted_hashtags, day)
 
             for attrs in attachment_attributes or []:
                 attachment = next(
@@ -595,10 +615,23 @@ class Post(StatorModel):
         # Ensure hashtags
         if self.hashtags:
             for hashtag in self.hashtags:
-                tag, _ = Hashtag.objects.get_or_create(
+                Hashtag.objects.get_or_create(
                     hashtag=hashtag[: Hashtag.MAXIMUM_LENGTH],
                 )
-                tag.transition_perform(HashtagStates.outdated)
+
+    def counted_hashtags(self) -> set[str]:
+        """
+        Returns the hashtags this post counts towards in HashtagUsage; only
+        local, public, top-level posts are counted.
+        """
+        if (
+            not self.local
+            or self.in_reply_to
+            or self.visibility
+            not in [self.Visibilities.public, self.Visibilities.local_only]
+        ):
+            return set()
+        return set(self.hashtags or [])
 
     def calculate_stats(self, save=True):
         """
@@ -615,7 +648,9 @@ class Post(StatorModel):
                 type=PostInteraction.Types.boost,
                 state__in=PostInteractionStates.group_active(),
             ).count(),
-            "replies": Post.objects.filter(in_reply_to=self.object_uri).count(),
+            "replies": Post.objects.filter(in_reply_to=self.object_uri)
+            .exclude(state__in=[PostStates.deleted, PostStates.deleted_fanned_out])
+            .count(),
         }
         if save:
             self.save()
@@ -644,6 +679,135 @@ class Post(StatorModel):
         if save:
             self.save()
 
+    def adjust_stats(self, **deltas: int):
+        """
+        Adds the given deltas (likes=1, replies=-1 and so on) to our stats in
+        a single atomic UPDATE, rather than recounting them all; the counts
+        are recalculated periodically by transition_reconcile to fix drift.
+        """
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        expression = "COALESCE(stats, '{}'::jsonb)"
+        params: list = []
+        for key, delta in deltas.items():
+            expression = (
+                f"jsonb_set({expression}, %s, "
+                "to_jsonb(GREATEST(COALESCE((stats->>%s)::int, 0) + %s, 0)))"
+            )
+            params.extend([[key], key, delta])
+        Post.objects.filter(pk=self.pk).update(
+            stats=models.expressions.RawSQL(expression, params)
+        )
+        self.stats = self.stats or {}
+        for key, delta in deltas.items():
+            self.stats[key] = max(self.stats.get(key, 0) + delta, 0)
+
+    def uncount_reply(self):
+        """
+        Takes this post, which is about to be deleted, off its parent's reply
+        count (unless it's been deleted already).
+        """
+        if self.state in [PostStates.deleted, PostStates.deleted_fanned_out]:
+            return
+        parent = self.in_reply_to_post()
+        if parent is not None:
+            parent.adjust_stats(replies=-1)
+
+    def add_votes(self, choices: list[str], new_voter: bool = True):
+        """
+        Counts new votes on a local poll. The row is locked while we do it,
+        so concurrent votes aren't lost.
+        """
+        if not (self.local and isinstance(self.type_data, QuestionData)):
+            return
+        with transaction.atomic():
+            question = (
+                Post.objects.select_for_update()
+                .values_list("type_data", flat=True)
+                .get(pk=self.pk)
+            )
+            if not isinstance(question, QuestionData):
+                return
+            for option in question.options or []:
+                option.votes += choices.count(option.name)
+            if new_voter:
+                question.voter_count += 1
+            Post.objects.filter(pk=self.pk).update(type_data=question)
+        self.type_data = question
+
+    @classmethod
+    def transition_reconcile(
+        cls, since: datetime.datetime, until: datetime.datetime
+    ) -> datetime.datetime | None:
+        """
+        Recounts the stats (and poll votes) of posts whose likes, boosts,
+        votes or replies were added, undone or deleted after `since`, in
+        order of change and RECONCILE_BATCH_SIZE changes at a time, fixing
+        any drift in the counts kept by adjust_stats and add_votes.
+        """
+        from activities.models import PostInteraction
+
+        interactions = PostInteraction.objects.filter(
+            type__in=[
+                PostInteraction.Types.like,
+                PostInteraction.Types.boost,
+                PostInteraction.Types.vote,
+            ],
+        ).values_list("state_changed", "post_id")
+        # Replies' state changes include them being deleted
+        replies = cls.objects.filter(in_reply_to__isnull=False).values_list(
+            "state_changed", "in_reply_to"
+        )
+        batch_size = cls.RECONCILE_BATCH_SIZE
+        changes = sorted(
+            [
+                (changed, "pk", key)
+                for changed, key in interactions.filter(
+                    state_changed__gt=since, state_changed__lte=until
+                ).order_by("state_changed")[:batch_size]
+            ]
+            + [
+                (changed, "object_uri", key)
+                for changed, key in replies.filter(
+                    state_changed__gt=since, state_changed__lte=until
+                ).order_by("state_changed")[:batch_size]
+            ]
+        )[:batch_size]
+        if not changes:
+            return None
+        # Take everything else changed at the same moment as the last one
+        # too, so the next batch can safely start after it
+        reached = changes[-1][0]
+        changes += [
+            (changed, "pk", key)
+            for changed, key in interactions.filter(state_changed=reached)
+        ] + [
+            (changed, "object_uri", key)
+            for changed, key in replies.filter(state_changed=reached)
+        ]
+        post_ids = cls.objects.filter(
+            models.Q(pk__in={key for _, field, key in changes if field == "pk"})
+            | models.Q(
+                object_uri__in={
+                    key for _, field, key in changes if field == "object_uri"
+                }
+            )
+        ).values_list("pk", flat=True)
+        for post_id in post_ids:
+            # Lock each post while it's recounted, so deltas from
+            # adjust_stats and add_votes wait rather than being overwritten
+            with transaction.atomic():
+                post = cls.objects.select_for_update().filter(pk=post_id).first()
+                if post is None:
+                    continue
+                post.calculate_stats(save=False)
+                post.calculate_type_data(save=False)
+                cls.objects.filter(pk=post.pk).update(
+                    stats=post.stats, type_data=post.type_data
+                )
+        return reached
+
     ### ActivityPub (outbound) ###
 
     def to_ap(self) -> dict:
@@ -758,71 +922,66 @@ class Post(StatorModel):
             "object": object,
         }
 
-    def get_targets(self) -> Iterable[Identity]:
+    def get_fan_out_targets(self) -> Iterator[FanOutTarget]:
         """
-        Returns a list of Identities that need to see posts and their changes
+        Returns the identities that need to see posts and their changes
         """
-        targets = set()
-        for mention in self.mentions.all():
-            targets.add(mention)
+        author_followers = models.Q(
+            pk__in=Follow.objects.filter(
+                target_id=self.author_id, state__in=FollowStates.group_active()
+            ).values("source_id")
+        )
+        candidates = [models.Q(pk__in=self.mentions.values("pk"))]
         if self.visibility in [Post.Visibilities.public, Post.Visibilities.unlisted]:
-            for interaction in self.interactions.all():
-                targets.add(interaction.identity)
+            candidates.append(models.Q(pk__in=self.interactions.values("identity_id")))
         # Then, if it's not mentions only, also deliver to followers and all hashtag followers
         if self.visibility != Post.Visibilities.mentioned:
-            for follower in self.author.inbound_follows.filter(
-                state__in=FollowStates.group_active()
-            ).select_related("source"):
-                targets.add(follower.source)
+            candidates.append(author_followers)
             if self.hashtags:
-                for follow in HashtagFollow.objects.by_hashtags(
-                    self.hashtags
-                ).prefetch_related("identity"):
-                    targets.add(follow.identity)
+                candidates.append(
+                    models.Q(
+                        pk__in=HashtagFollow.objects.by_hashtags(self.hashtags).values(
+                            "identity_id"
+                        )
+                    )
+                )
 
         # If it's a reply, always include the original author if we know them
         reply_post = self.in_reply_to_post()
         if reply_post:
-            targets.add(reply_post.author)
+            candidates.append(models.Q(pk=reply_post.author_id))
             # And if it's a reply to one of our own, we have to re-fan-out to
             # the original author's followers
             if reply_post.author.local:
-                for follower in reply_post.author.inbound_follows.filter(
-                    state__in=FollowStates.group_active()
-                ).select_related("source"):
-                    targets.add(follower.source)
+                candidates.append(
+                    models.Q(
+                        pk__in=Follow.objects.filter(
+                            target_id=reply_post.author_id,
+                            state__in=FollowStates.group_active(),
+                        ).values("source_id")
+                    )
+                )
+        query = candidates[0]
+        for candidate in candidates[1:]:
+            query |= candidate
         # If this is a remote post or local-only, filter to only include
         # local identities
         if not self.local or self.visibility == Post.Visibilities.local_only:
-            targets = {target for target in targets if target.local}
+            query &= models.Q(local=True)
         # If it's a local post, include the author
         if self.local:
-            targets.add(self.author)
-        # Fetch the author's full blocks and remove them as targets
-        blocks = (
-            self.author.outbound_blocks.active()
-            .filter(mute=False)
-            .select_related("target")
+            query |= models.Q(pk=self.author_id)
+        return FanOut.resolve_targets(query, self.author_id)
+
+    def get_targets(self) -> set[Identity]:
+        """
+        Returns the Identities from get_fan_out_targets
+        """
+        return set(
+            Identity.objects.filter(
+                pk__in=[target.identity_id for target in self.get_fan_out_targets()]
+            )
         )
-        for block in blocks:
-            try:
-                targets.remove(block.target)
-            except KeyError:
-                pass
-        # Now dedupe the targets based on shared inboxes (we only keep one per
-        # shared inbox)
-        deduped_targets = set()
-        shared_inboxes = set()
-        for target in targets:
-            if target.local or not target.shared_inbox_uri:
-                deduped_targets.add(target)
-            elif target.shared_inbox_uri not in shared_inboxes:
-                shared_inboxes.add(target.shared_inbox_uri)
-                deduped_targets.add(target)
-            else:
-                # Their shared inbox is already being sent to
-                pass
-        return deduped_targets
 
     ### ActivityPub (inbound) ###
 
@@ -893,6 +1052,7 @@ class Post(StatorModel):
             else:
                 raise cls.DoesNotExist(f"No post with ID {data['id']}", data)
         if update or created:
+            post.invalidate_rendered_content()
             post.type = data["type"]
             post.url = data.get("url", data["id"])
             if post.type in (cls.Types.article, cls.Types.question):
@@ -975,6 +1135,7 @@ class Post(StatorModel):
                 post.attachments.create(
                     remote_url=attachment["url"],
                     mimetype=mimetype,
+                    state=PostAttachment.remote_initial_state(mimetype),
                     name=attachment.get("name"),
                     width=attachment.get("width"),
                     height=attachment.get("height"),
@@ -982,15 +1143,21 @@ class Post(StatorModel):
                     focal_x=focal_x,
                     focal_y=focal_y,
                 )
-            # Calculate stats in case we have existing replies
-            post.calculate_stats(save=False)
+            # Count any replies that arrived before we did (nothing can have
+            # liked or boosted us yet, as those need the post to exist)
+            if created:
+                post.stats = {
+                    "likes": 0,
+                    "boosts": 0,
+                    "replies": Post.objects.filter(in_reply_to=post.object_uri).count(),
+                }
             with transaction.atomic():
                 # if we don't commit the transaction here, there's a chance
                 # the parent fetch below goes into an infinite loop
                 post.save()
 
-            # Potentially schedule a fetch of the reply parent, and recalculate
-            # its stats if it's here already.
+            # Potentially schedule a fetch of the reply parent, and count the
+            # reply on it if it's here already.
             if post.in_reply_to:
                 try:
                     parent = cls.by_object_uri(post.in_reply_to)
@@ -1004,7 +1171,8 @@ class Post(StatorModel):
                             post.in_reply_to,
                         )
                 else:
-                    parent.calculate_stats()
+                    if created:
+                        parent.adjust_stats(replies=1)
         return post
 
     @classmethod
@@ -1117,6 +1285,7 @@ class Post(StatorModel):
             # Ensure the actor on the request authored the post
             if not post.author.actor_uri == data["actor"]:
                 raise ValueError("Actor on delete does not match object")
+            post.uncount_reply()
             post.delete()
 
     @classmethod
@@ -1149,9 +1318,54 @@ class Post(StatorModel):
 
     ### Mastodon API ###
 
+    @classmethod
+    def prefetch_mastodon(cls, posts: list["Post"], identity: Identity | None = None):
+        """
+        Looks up the reply parents, authors' emoji and (for `identity`) poll
+        votes that to_mastodon_json needs for a page of posts, in a fixed
+        number of queries rather than a few per post.
+        """
+        from activities.models.post_interaction import PostInteraction
+
+        # Reply parents, just the PK and author ID like to_mastodon_json
+        reply_uris = {post.in_reply_to for post in posts if post.in_reply_to}
+        reply_parents = {}
+        if reply_uris:
+            reply_parents = {
+                parent.object_uri: parent
+                for parent in Post.objects.filter(object_uri__in=reply_uris).only(
+                    "pk", "author_id", "object_uri"
+                )
+            }
+        for post in posts:
+            post._reply_parent = reply_parents.get(post.in_reply_to or "")
+        # Votes on any polls
+        if identity:
+            polls = [post for post in posts if isinstance(post.type_data, QuestionData)]
+            votes: dict[int, list[PostInteraction]] = {}
+            if polls:
+                for vote in PostInteraction.objects.filter(
+                    identity=identity,
+                    type=PostInteraction.Types.vote,
+                    post__in=polls,
+                ):
+                    votes.setdefault(vote.post_id, []).append(vote)
+            for post in polls:
+                post._own_votes = (identity.pk, votes.get(post.pk, []))
+        # Content that's already been rendered, and for the rest, the domains
+        # of mentions, which are rendered as profile links
+        ContentRenderer(local=False).prefetch(
+            "post", [(post, post.content) for post in posts]
+        )
+        models.prefetch_related_objects(posts, "mentions__domain")
+        # Emoji used in the authors' profiles
+        Identity.prefetch_mastodon_emojis(post.author for post in posts)
+
     def to_mastodon_json(self, interactions=None, bookmarks=None, identity=None):
         reply_parent = None
-        if self.in_reply_to:
+        if hasattr(self, "_reply_parent"):
+            reply_parent = self._reply_parent
+        elif self.in_reply_to:
             # Load the PK and author.id explicitly to prevent a SELECT on the entire author Identity
             reply_parent = (
                 Post.objects.filter(object_uri=self.in_reply_to)
@@ -1,7 +1,15 @@
+import datetime
 from functools import partial
 
-from django.db import models
+import httpx
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from PIL import Image
 
+from core.files import blurhash_image, get_remote_file, process_image, thumbnail_image
 from core.uploads import upload_namer
 from core.uris import ProxyAbsoluteUrl, RelativeAbsoluteUrl
 from stator.models import State, StateField, StateGraph, StatorModel
@@ -9,9 +17,75 @@ from stator.models import State, StateField, StateGraph, StatorModel
 
 class PostAttachmentStates(StateGraph):
     new = State(externally_progressed=True)
+    processing = State(try_interval=60)
+    fetching = State(try_interval=300)
     fetched = State()
+    cached = State(try_interval=86400, attempt_immediately=False)
+    expired = State()
+    failed = State()
 
+    new.transitions_to(processing)
+    new.transitions_to(fetching)
     new.transitions_to(fetched)
+    processing.transitions_to(fetched)
+    processing.transitions_to(failed)
+    processing.times_out_to(failed, seconds=3600)
+    fetching.transitions_to(cached)
+    fetching.transitions_to(failed)
+    fetching.times_out_to(failed, seconds=86400)
+    cached.transitions_to(cached)
+    cached.transitions_to(expired)
+
+    @classmethod
+    def handle_processing(cls, instance: "PostAttachment"):
+        """
+        Turns an uploaded original into the files we actually serve
+        """
+        if not instance.file:
+            # Shouldn't happen, but don't fail an upload that's still arriving
+            return
+        try:
+            instance.process_upload()
+        except (OSError, ValueError, Image.DecompressionBombError):
+            # Not an image Pillow can read after all
+            return cls.failed
+        return cls.fetched
+
+    @classmethod
+    def handle_fetching(cls, instance: "PostAttachment"):
+        """
+        Downloads a remote image to make a local thumbnail
+        """
+        try:
+            file, _ = get_remote_file(
+                instance.remote_url,
+                timeout=settings.SETUP.REMOTE_TIMEOUT,
+                max_size=settings.SETUP.REMOTE_MEDIA_MAX_IMAGE_FILESIZE_KB * 1024,
+            )
+        except httpx.RequestError:
+            return
+        if file is None:
+            # Too big; it'll keep going through the proxy
+            return cls.failed
+        try:
+            instance.cache_remote(file)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return cls.failed
+        return cls.cached
+
+    @classmethod
+    def handle_cached(cls, instance: "PostAttachment"):
+        """
+        Drops the local thumbnail once it's past the remote prune horizon
+        (if the post itself wasn't pruned)
+        """
+        horizon = settings.SETUP.REMOTE_PRUNE_HORIZON
+        if horizon <= 0:
+            return
+        if instance.created > timezone.now() - datetime.timedelta(days=horizon):
+            return
+        instance.thumbnail.delete(save=True)
+        return cls.expired
 
 
 class PostAttachment(StatorModel):
@@ -64,15 +138,17 @@ class PostAttachment(StatorModel):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    IMAGE_MIMETYPES = [
+        "image/apng",
+        "image/avif",
+        "image/gif",
+        "image/jpeg",
+        "image/png",
+        "image/webp",
+    ]
+
     def is_image(self):
-        return self.mimetype in [
-            "image/apng",
-            "image/avif",
-            "image/gif",
-            "image/jpeg",
-            "image/png",
-            "image/webp",
-        ]
+        return self.mimetype in self.IMAGE_MIMETYPES
 
     def is_video(self):
         return self.mimetype in [
@@ -102,6 +178,45 @@ class PostAttachment(StatorModel):
             )
         return RelativeAbsoluteUrl(self.remote_url)
 
+    def process_upload(self):
+        """
+        Replaces the uploaded original in `file` with its display copy, and
+        adds the thumbnail and blurhash
+        """
+        original = self.file.name
+        with self.file.open("rb"):
+            main_file, thumbnail_file, self.blurhash = process_image(self.file)
+        self.mimetype = "image/webp"
+        self.width = main_file.image.width
+        self.height = main_file.image.height
+        self.file.save(main_file.name, main_file, save=False)
+        self.thumbnail.save(thumbnail_file.name, thumbnail_file, save=False)
+        self.save()
+        self.file.storage.delete(original)
+
+    @classmethod
+    def remote_initial_state(cls, mimetype: str) -> State:
+        """
+        Returns the state a new remote attachment starts in: fetching, if
+        it's an image and we're set to prefetch those
+        """
+        if settings.SETUP.REMOTE_MEDIA_PREFETCH and mimetype in cls.IMAGE_MIMETYPES:
+            return PostAttachmentStates.fetching
+        return PostAttachmentStates.new
+
+    def cache_remote(self, file):
+        """
+        Makes and stores a thumbnail (and the blurhash and size, if the
+        remote server didn't send them) from a downloaded remote image
+        """
+        thumbnail_file, (width, height) = thumbnail_image(file)
+        if not self.blurhash:
+            self.blurhash = blurhash_image(thumbnail_file.image)
+        if not (self.width and self.height):
+            self.width, self.height = width, height
+        self.thumbnail.save(thumbnail_file.name, thumbnail_file, save=False)
+        self.save()
+
     @property
     def file_display_name(self):
         if self.remote_url:
@@ -130,6 +245,18 @@ class PostAttachment(StatorModel):
     ### Mastodon Client API ###
 
     def to_mastodon_json(self):
+        if self.state == PostAttachmentStates.processing:
+            # Mastodon clients wait for the URLs to appear
+            return {
+                "id": self.pk,
+                "type": "image",
+                "url": None,
+                "preview_url": None,
+                "remote_url": None,
+                "meta": {"focus": {"x": self.focal_x or 0, "y": self.focal_y or 0}},
+                "description": self.name,
+                "blurhash": None,
+            }
         type_ = "unknown"
         if self.is_image():
             type_ = "image"
@@ -158,3 +285,15 @@ class PostAttachment(StatorModel):
                 "aspect": self.width / self.height,
             }
         return value
+
+
+@receiver(post_delete, sender=PostAttachment)
+def delete_remote_thumbnail(sender, instance: PostAttachment, **kwargs):
+    """
+    Removes our thumbnails of remote images when their rows go (usually as
+    their posts are pruned)
+    """
+    if instance.remote_url and instance.thumbnail:
+        storage = instance.thumbnail.storage
+        name = instance.thumbnail.name
+        transaction.on_commit(lambda: storage.delete(name))
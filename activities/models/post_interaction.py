@@ -1,11 +1,12 @@
-from collections.abc import Iterable
+from collections.abc import Iterator
 
 from django.db import models, transaction
 from django.utils import timezone
 
-from activities.models.fan_out import FanOut
+from activities.models.fan_out import FanOut, FanOutTarget
 from activities.models.post import Post
 from activities.models.post_types import QuestionData
+from activities.models.trend import TrendScore
 from core.ld import format_ld_date, get_str_or_id, parse_ld_date
 from core.snowflake import Snowflake
 from stator.models import State, StateField, StateGraph, StatorModel
@@ -35,13 +36,12 @@ class PostInteractionStates(StateGraph):
         # to just local follows if it's a remote boost)
         # Pin: send Add activity to all people who follow this user
         if instance.type == instance.Types.boost or instance.type == instance.Types.pin:
-            for target in instance.get_targets():
-                FanOut.objects.create(
-                    type=FanOut.Types.interaction,
-                    identity=target,
-                    subject_post=instance.post,
-                    subject_post_interaction=instance,
-                )
+            FanOut.create_for_targets(
+                instance.get_fan_out_targets(),
+                type=FanOut.Types.interaction,
+                subject_post=instance.post,
+                subject_post_interaction=instance,
+            )
         # Like: send a copy to the original post author only,
         # if the liker is local or they are
         elif instance.type == instance.Types.like:
@@ -83,16 +83,20 @@ class PostInteractionStates(StateGraph):
         # Undo Boost: send a copy to all people who follow this user
         # Undo Pin: send a Remove activity to all people who follow this user
         if instance.type == instance.Types.boost or instance.type == instance.Types.pin:
-            for follow in instance.identity.inbound_follows.select_related(
-                "source", "target"
-            ):
-                if follow.source.local or follow.target.local:
-                    FanOut.objects.create(
+            FanOut.objects.bulk_create(
+                [
+                    FanOut(
                         type=FanOut.Types.undo_interaction,
                         identity_id=follow.source_id,
                         subject_post=instance.post,
                         subject_post_interaction=instance,
                     )
+                    for follow in instance.identity.inbound_follows.select_related(
+                        "source", "target"
+                    )
+                    if follow.source.local or follow.target.local
+                ]
+            )
         # Undo Like: send a copy to the original post author only
         elif instance.type == instance.Types.like:
             FanOut.objects.create(
@@ -125,6 +129,9 @@ class PostInteraction(StatorModel):
         vote = "vote"
         pin = "pin"
 
+    # The Post.stats key each type of interaction is counted under
+    STATS_KEYS = {Types.like: "likes", Types.boost: "boosts"}
+
     id = models.BigIntegerField(
         primary_key=True,
         default=Snowflake.generate_post_interaction,
@@ -198,52 +205,37 @@ class PostInteraction(StatorModel):
             [e.subject_post for e in events if e.subject_post], identity
         )
 
-    def get_targets(self) -> Iterable[Identity]:
+    def get_fan_out_targets(self) -> Iterator[FanOutTarget]:
         """
-        Returns an iterable with Identities of followers that have unique
-        shared_inbox among each other to be used as target.
+        Returns the post author and the followers, with unique shared inboxes
+        among each other, to be used as targets.
 
         When interaction is boost, only boost follows are considered,
         for pins all followers are considered.
         """
-        # Start including the post author
-        targets = {self.post.author}
-
-        query = self.identity.inbound_follows.active()
+        follows = self.identity.inbound_follows.active()
         # Include all followers that are following the boosts
         if self.type == self.Types.boost:
-            query = query.filter(boosts=True)
-        for follow in query.select_related("source"):
-            targets.add(follow.source)
-
-        # Fetch the full blocks and remove them as targets
-        for block in (
-            self.identity.outbound_blocks.active()
-            .filter(mute=False)
-            .select_related("target")
-        ):
-            try:
-                targets.remove(block.target)
-            except KeyError:
-                pass
-
-        deduped_targets = set()
-        shared_inboxes = set()
-        for target in targets:
-            if target.local:
-                # Local targets always gets the boosts
-                # despite its creator locality
-                deduped_targets.add(target)
-            elif self.identity.local:
-                # Dedupe the targets based on shared inboxes
-                # (we only keep one per shared inbox)
-                if not target.shared_inbox_uri:
-                    deduped_targets.add(target)
-                elif target.shared_inbox_uri not in shared_inboxes:
-                    shared_inboxes.add(target.shared_inbox_uri)
-                    deduped_targets.add(target)
-
-        return deduped_targets
+            follows = follows.filter(boosts=True)
+        # Start including the post author
+        query = models.Q(pk=self.post.author_id) | models.Q(
+            pk__in=follows.values("source_id")
+        )
+        # Local targets always get the boosts despite its creator locality,
+        # but only local interactions go out to remote servers
+        if not self.identity.local:
+            query &= models.Q(local=True)
+        return FanOut.resolve_targets(query, self.identity_id)
+
+    def get_targets(self) -> set[Identity]:
+        """
+        Returns the Identities from get_fan_out_targets
+        """
+        return set(
+            Identity.objects.filter(
+                pk__in=[target.identity_id for target in self.get_fan_out_targets()]
+            )
+        )
 
     ### Create helpers ###
 
@@ -273,13 +265,25 @@ class PostInteraction(StatorModel):
                 if not post.local:
                     question.options[choice].votes += 1
 
-            if not post.local:
+            if post.local:
+                post.add_votes(
+                    [question.options[choice].name for choice in set(choices)]
+                )
+            else:
                 question.voter_count += 1
-
-            post.calculate_type_data()
+                post.save()
 
         return votes
 
+    def stats_delta(self, delta: int) -> dict[str, int]:
+        """
+        Returns the Post.adjust_stats arguments for counting (or, with a
+        negative delta, uncounting) this interaction.
+        """
+        if self.type in self.STATS_KEYS:
+            return {self.STATS_KEYS[self.type]: delta}
+        return {}
+
     ### ActivityPub (outbound) ###
 
     def to_ap(self) -> dict:
@@ -441,6 +445,9 @@ class PostInteraction(StatorModel):
         Handles an incoming announce/like
         """
         with transaction.atomic():
+            # Redeliveries of one we already have don't change any counts
+            if cls.objects.filter(object_uri=data["id"]).exists():
+                return
             # Create it
             try:
                 interaction = cls.by_ap(data, create=True)
@@ -450,8 +457,17 @@ class PostInteraction(StatorModel):
                 return
 
             if interaction and interaction.post:
-                interaction.post.calculate_stats()
-                interaction.post.calculate_type_data()
+                interaction.post.adjust_stats(**interaction.stats_delta(1))
+                TrendScore.count_interaction(interaction)
+                if interaction.type == cls.Types.vote:
+                    interaction.post.add_votes(
+                        [interaction.value],
+                        new_voter=not interaction.post.interactions.filter(
+                            type=cls.Types.vote, identity=interaction.identity
+                        )
+                        .exclude(pk=interaction.pk)
+                        .exists(),
+                    )
 
     @classmethod
     def handle_undo_ap(cls, data):
@@ -470,11 +486,12 @@ class PostInteraction(StatorModel):
                 raise ValueError("Actor mismatch on interaction undo")
             # Delete all events that reference it
             interaction.timeline_events.all().delete()
-            # Force it into undone_fanned_out as it's not ours
+            # Force it into undone_fanned_out as it's not ours, uncounting
+            # it if it was counted
+            was_active = interaction.state in PostInteractionStates.group_active()
             interaction.transition_perform(PostInteractionStates.undone_fanned_out)
-            # Recalculate post stats
-            interaction.post.calculate_stats()
-            interaction.post.calculate_type_data()
+            if was_active:
+                interaction.post.adjust_stats(**interaction.stats_delta(-1))
 
     @classmethod
     def handle_add_ap(cls, data):
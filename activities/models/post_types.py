@@ -82,11 +82,16 @@ class QuestionData(BasePostDataType):
             option_map[option.name] = index
 
         if identity:
-            votes = post.interactions.filter(
-                identity=identity,
-                type=PostInteraction.Types.vote,
-            )
-            value["voted"] = post.author == identity or votes.exists()
+            # Post.prefetch_mastodon may have fetched these already
+            voter_id, votes = getattr(post, "_own_votes", (None, None))
+            if voter_id != identity.pk:
+                votes = list(
+                    post.interactions.filter(
+                        identity=identity,
+                        type=PostInteraction.Types.vote,
+                    )
+                )
+            value["voted"] = post.author == identity or bool(votes)
             value["own_votes"] = [
                 option_map[vote.value] for vote in votes if vote.value in option_map
             ]
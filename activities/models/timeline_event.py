@@ -2,6 +2,7 @@ from django.db import models
 from django.utils import timezone
 
 from core.ld import format_ld_date
+from users.models.identity import Identity
 
 
 class TimelineEvent(models.Model):
@@ -251,6 +252,27 @@ class TimelineEvent(models.Model):
             raise ValueError(f"Cannot convert {self.type} to notification JSON")
         return result
 
+    @classmethod
+    def prefetch_mastodon(
+        cls, events: list["TimelineEvent"], identity: Identity | None = None
+    ):
+        """
+        Does Post.prefetch_mastodon for the posts (and boosters) of a page of
+        post/boost events.
+        """
+        from activities.models.post import Post
+
+        posts = []
+        boosters = []
+        for event in events:
+            if event.type == cls.Types.post:
+                posts.append(event.subject_post)
+            elif event.type == cls.Types.boost:
+                posts.append(event.subject_post_interaction.post)
+                boosters.append(event.subject_post_interaction.identity)
+        Post.prefetch_mastodon(posts, identity)
+        Identity.prefetch_mastodon_emojis(boosters)
+
     def to_mastodon_status_json(self, interactions=None, bookmarks=None, identity=None):
         if self.type == self.Types.post:
             return self.subject_post.to_mastodon_json(
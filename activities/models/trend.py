@@ -0,0 +1,222 @@
+import datetime
+from collections.abc import Iterable
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.db import connection, models
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from core.html import LinkFinder
+from stator.models import State, StateField, StateGraph, StatorModel
+
+
+class TrendStates(StateGraph):
+    refreshing = State(
+        try_interval=settings.SETUP.TRENDS_REFRESH_INTERVAL,
+        attempt_immediately=False,
+        force_initial=True,
+    )
+
+    refreshing.transitions_to(refreshing)
+
+    @classmethod
+    def handle_refreshing(cls, instance: "Trend"):
+        """
+        Recomputes the trending list, and comes back to do it again later
+        """
+        instance.refresh()
+        return cls.refreshing
+
+
+class Trend(StatorModel):
+    """
+    The current top items of one kind (tags, statuses or links), worked out
+    from TrendScore every so often so the API only has to read one row.
+    """
+
+    class Kinds(models.TextChoices):
+        tags = "tags"
+        statuses = "statuses"
+        links = "links"
+
+    kind = models.CharField(max_length=20, choices=Kinds.choices, primary_key=True)
+
+    state = StateField(TrendStates)
+
+    # Ordered list of Mastodon JSON for tags and links, or post IDs
+    items = models.JSONField(default=list)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def top(cls, kind: str, limit: int, offset: int | None = None) -> list:
+        """
+        Returns a page of the current list for a kind
+        """
+        limit = max(min(limit, settings.SETUP.TRENDS_SIZE), 0)
+        trend = cls.objects.filter(kind=kind).only("items").first()
+        if trend is None:
+            return []
+        return trend.items[offset or 0 :][:limit]
+
+    def refresh(self):
+        """
+        Rebuilds the list from the highest current scores, forgetting any
+        scores that have faded to nothing on the way.
+        """
+        from activities.models import Hashtag, Post
+
+        scores = TrendScore.objects.filter(kind=self.kind).annotate(
+            decayed=TrendScore.decayed(timezone.now())
+        )
+        TrendScore.objects.filter(
+            pk__in=scores.filter(decayed__lt=TrendScore.MINIMUM_SCORE).values("pk")
+        ).delete()
+        # Fetch extra, as some may be filtered out below
+        keys = list(
+            scores.order_by("-decayed").values_list("key", flat=True)[
+                : settings.SETUP.TRENDS_SIZE * 2
+            ]
+        )
+        if self.kind == self.Kinds.tags:
+            hashtags = Hashtag.objects.public().in_bulk(keys)
+            items = [
+                hashtags[key].to_mastodon_json() for key in keys if key in hashtags
+            ]
+        elif self.kind == self.Kinds.statuses:
+            visible = set(
+                Post.objects.not_hidden()
+                .filter(
+                    pk__in=[int(key) for key in keys],
+                    visibility=Post.Visibilities.public,
+                )
+                .values_list("pk", flat=True)
+            )
+            items = [int(key) for key in keys if int(key) in visible]
+        else:
+            items = [self.link_card(key) for key in keys]
+        self.items = items[: settings.SETUP.TRENDS_SIZE]
+        self.save()
+
+    @classmethod
+    def link_card(cls, url: str) -> dict:
+        """
+        Returns a minimal Mastodon PreviewCard for a trending link (we don't
+        fetch the page to fill in the rest)
+        """
+        domain = urlparse(url).hostname or ""
+        return {
+            "url": url,
+            "title": url,
+            "description": "",
+            "type": "link",
+            "author_name": "",
+            "author_url": "",
+            "provider_name": domain,
+            "provider_url": f"https://{domain}/" if domain else "",
+            "html": "",
+            "width": 0,
+            "height": 0,
+            "image": None,
+            "embed_url": "",
+            "blurhash": None,
+            "history": [],
+        }
+
+
+class TrendScore(models.Model):
+    """
+    A decaying score for something that might be trending, kept up to date
+    as posts and interactions come in. The stored score is as of `scored`;
+    it halves every TRENDS_HALF_LIFE hours after that.
+    """
+
+    # Scores below this are forgotten on the next refresh
+    MINIMUM_SCORE = 0.05
+
+    # How much each kind of interaction adds to a status's score
+    INTERACTION_WEIGHTS = {"like": 1, "boost": 2}
+
+    kind = models.CharField(max_length=20, choices=Trend.Kinds.choices)
+
+    # Hashtag, post ID, or URL
+    key = models.CharField(max_length=2048)
+
+    score = models.FloatField(default=0)
+    scored = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["kind", "key"], name="unique_trend_score")
+        ]
+
+    @classmethod
+    def half_life(cls) -> float:
+        return settings.SETUP.TRENDS_HALF_LIFE * 3600
+
+    @classmethod
+    def decayed(cls, now: datetime.datetime) -> RawSQL:
+        """
+        Returns an expression for each score decayed to `now`
+        """
+        return RawSQL(
+            "score * power(0.5, GREATEST(EXTRACT(EPOCH FROM (%s - scored)), 0) / %s)",
+            (now, cls.half_life()),
+            output_field=models.FloatField(),
+        )
+
+    @classmethod
+    def add(cls, kind: str, keys: Iterable[str], weight: float = 1):
+        """
+        Decays the scores for keys to now and adds weight to them, in one query
+        """
+        keys = sorted(set(keys))
+        if not keys:
+            return
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (kind, key, score, scored)
+                SELECT %s, unnest(%s::varchar[]), %s, %s
+                ON CONFLICT (kind, key) DO UPDATE
+                SET score = {table}.score * power(
+                    0.5,
+                    GREATEST(EXTRACT(EPOCH FROM (EXCLUDED.scored - {table}.scored)), 0)
+                    / %s
+                ) + EXCLUDED.score,
+                scored = GREATEST({table}.scored, EXCLUDED.scored)
+                """,
+                [kind, keys, weight, timezone.now(), cls.half_life()],
+            )
+
+    @classmethod
+    def count_post(cls, post):
+        """
+        Counts a newly seen post towards its hashtags' and links' scores
+        """
+        if post.visibility != post.Visibilities.public:
+            return
+        if timezone.now() - post.published > datetime.timedelta(days=1):
+            return
+        cls.add(Trend.Kinds.tags, post.hashtags or [])
+        cls.add(
+            Trend.Kinds.links,
+            [
+                link
+                for link in LinkFinder(post.content or "").links
+                if len(link) <= 2048
+            ],
+        )
+
+    @classmethod
+    def count_interaction(cls, interaction):
+        """
+        Counts a new like or boost towards its post's score
+        """
+        weight = cls.INTERACTION_WEIGHTS.get(interaction.type)
+        post = interaction.post
+        if weight and post and post.visibility == post.Visibilities.public:
+            cls.add(Trend.Kinds.statuses, [str(post.pk)], weight)
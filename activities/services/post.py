@@ -1,13 +1,16 @@
 import logging
 
+from django.db import connection
+
 from activities.models import (
     Post,
     PostInteraction,
     PostInteractionStates,
     PostStates,
     TimelineEvent,
+    TrendScore,
 )
-from users.models import Identity
+from users.models import Follow, Identity
 
 logger = logging.getLogger(__name__)
 
@@ -42,14 +45,18 @@ class PostService:
         """
         Performs an interaction on this Post
         """
-        interaction = PostInteraction.objects.get_or_create(
+        interaction, created = PostInteraction.objects.get_or_create(
             type=type,
             identity=identity,
             post=self.post,
-        )[0]
+        )
         if interaction.state not in PostInteractionStates.group_active():
             interaction.transition_perform(PostInteractionStates.new)
-        self.post.calculate_stats()
+        elif not created:
+            # Already done, so nothing to count
+            return
+        self.post.adjust_stats(**interaction.stats_delta(1))
+        TrendScore.count_interaction(interaction)
 
     def uninteract_as(self, identity, type):
         """
@@ -60,8 +67,9 @@ class PostService:
             identity=identity,
             post=self.post,
         ):
+            if interaction.state in PostInteractionStates.group_active():
+                self.post.adjust_stats(**interaction.stats_delta(-1))
             interaction.transition_perform(PostInteractionStates.undone)
-        self.post.calculate_stats()
 
     def like_as(self, identity: Identity):
         self.interact_as(identity, PostInteraction.Types.like)
@@ -75,6 +83,10 @@ class PostService:
     def unboost_as(self, identity: Identity):
         self.uninteract_as(identity, PostInteraction.Types.boost)
 
+    # The most posts a thread's descendant tree is loaded with; anything past
+    # this in a giant thread is left out
+    MAX_THREAD_POSTS = 5000
+
     def context(
         self,
         identity: Identity | None,
@@ -90,52 +102,149 @@ class PostService:
         If identity is provided, includes mentions/followers-only posts they
         can see. Otherwise, shows unlisted and above only.
         """
-        # Retrieve ancestors via parent walk
-        ancestors: list[Post] = []
-        ancestor = self.post
-        while ancestor.in_reply_to and len(ancestors) < num_ancestors:
-            object_uri = ancestor.in_reply_to
-            reason = ancestor.object_uri
-            ancestor = self.queryset().filter(object_uri=object_uri).first()
-            if ancestor is None:
-                try:
-                    Post.ensure_object_uri(object_uri, reason=reason)
-                except ValueError:
-                    logger.error(
-                        f"Cannot fetch ancestor Post={self.post.pk}, ancestor_uri={object_uri}"
+        ancestor_ids = self.ancestor_ids(num_ancestors)
+        descendant_ids = self.descendant_ids(identity, num_descendants)
+        posts = self.queryset().in_bulk(ancestor_ids + descendant_ids)
+        return (
+            [posts[pk] for pk in ancestor_ids if pk in posts],
+            [posts[pk] for pk in descendant_ids if pk in posts],
+        )
+
+    def ancestor_ids(self, num_ancestors: int) -> list[int]:
+        """
+        Returns the IDs of up to num_ancestors posts this one is (indirectly)
+        replying to, closest first, in one query. If we find a gap in the
+        chain, a fetch of the missing post is scheduled.
+        """
+        if not self.post.in_reply_to or num_ancestors < 1:
+            return []
+        hidden = [str(PostStates.deleted), str(PostStates.deleted_fanned_out)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH RECURSIVE ancestors (id, object_uri, in_reply_to, depth) AS (
+                    SELECT id, object_uri, in_reply_to, 1
+                    FROM {Post._meta.db_table}
+                    WHERE object_uri = %s AND NOT state = ANY(%s)
+                  UNION ALL
+                    SELECT parent.id, parent.object_uri, parent.in_reply_to,
+                        ancestors.depth + 1
+                    FROM ancestors
+                    JOIN {Post._meta.db_table} parent
+                        ON parent.object_uri = ancestors.in_reply_to
+                    WHERE ancestors.depth < %s AND NOT parent.state = ANY(%s)
+                )
+                SELECT id, object_uri, in_reply_to FROM ancestors ORDER BY depth
+                """,
+                [self.post.in_reply_to, hidden, num_ancestors, hidden],
+            )
+            rows = cursor.fetchall()
+        # If the chain stopped early, see if we need to go fetch the next one
+        reason, object_uri = self.post.object_uri, self.post.in_reply_to
+        if rows:
+            reason, object_uri = rows[-1][1], rows[-1][2]
+        if object_uri and len(rows) < num_ancestors:
+            try:
+                Post.ensure_object_uri(object_uri, reason=reason)
+            except ValueError:
+                logger.error(
+                    f"Cannot fetch ancestor Post={self.post.pk}, ancestor_uri={object_uri}"
+                )
+        return [row[0] for row in rows]
+
+    def descendant_ids(
+        self, identity: Identity | None, num_descendants: int
+    ) -> list[int]:
+        """
+        Returns the IDs of up to (about) num_descendants replies to this post
+        that identity can see, in the same order as a walk that takes each
+        post's replies oldest first, diving into the newest. The reply tree
+        is loaded in one query, skipping (along with their replies) posts
+        that are deleted or not visible.
+        """
+        if not self.post.object_uri or num_descendants < 1:
+            return []
+        table = Post._meta.db_table
+        # Visibility rules as in PostQuerySet.visible_to/unlisted
+        visible = "child.visibility = ANY(%s)"
+        visible_params: list = [
+            [
+                Post.Visibilities.public,
+                Post.Visibilities.local_only,
+                Post.Visibilities.unlisted,
+            ]
+        ]
+        if identity:
+            mentions = Post.mentions.through._meta
+            visible = f"""(
+                {visible}
+                OR child.author_id = %s
+                OR (
+                    child.visibility = %s AND EXISTS (
+                        SELECT 1 FROM {Follow._meta.db_table} follow
+                        WHERE follow.source_id = %s
+                            AND follow.target_id = child.author_id
                     )
-                break
-            if ancestor.state in [PostStates.deleted, PostStates.deleted_fanned_out]:
-                break
-            ancestors.append(ancestor)
-        # Retrieve descendants via breadth-first-search
-        descendants: list[Post] = []
-        queue = [self.post]
-        seen: set[str] = set()
-        while queue and len(descendants) < num_descendants:
-            node = queue.pop()
-            child_queryset = (
-                self.queryset()
-                .filter(in_reply_to=node.object_uri)
-                .order_by("published")
+                )
+                OR EXISTS (
+                    SELECT 1 FROM {mentions.db_table} mention
+                    WHERE mention.post_id = child.id AND mention.identity_id = %s
+                )
+            )"""
+            visible_params.extend(
+                [identity.pk, Post.Visibilities.followers, identity.pk, identity.pk]
             )
-            if identity:
-                child_queryset = child_queryset.visible_to(
-                    identity=identity, include_replies=True
+        hidden = [str(PostStates.deleted), str(PostStates.deleted_fanned_out)]
+        condition = f"{visible} AND NOT child.state = ANY(%s)"
+        condition_params = visible_params + [hidden]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH RECURSIVE thread (id, object_uri, in_reply_to, published) AS (
+                    SELECT child.id, child.object_uri, child.in_reply_to,
+                        child.published
+                    FROM {table} child
+                    WHERE child.in_reply_to = %s AND {condition}
+                  UNION
+                    SELECT child.id, child.object_uri, child.in_reply_to,
+                        child.published
+                    FROM thread
+                    JOIN {table} child ON child.in_reply_to = thread.object_uri
+                    WHERE {condition}
                 )
-            else:
-                child_queryset = child_queryset.unlisted(include_replies=True)
-            for child in child_queryset:
-                if child.pk not in seen:
-                    descendants.append(child)
-                    queue.append(child)
-                    seen.add(child.pk)
-        return ancestors, descendants
+                SELECT id, object_uri, in_reply_to, published FROM thread LIMIT %s
+                """,
+                [self.post.object_uri]
+                + condition_params
+                + condition_params
+                + [self.MAX_THREAD_POSTS],
+            )
+            rows = cursor.fetchall()
+        # The LIMIT (without an ORDER BY) stops the recursion early on giant
+        # threads, and UNION stops it going round any reply loops
+        replies: dict[str, list[tuple[int, str]]] = {}
+        for pk, object_uri, in_reply_to, published in sorted(
+            rows, key=lambda row: (row[3], row[0])
+        ):
+            replies.setdefault(in_reply_to, []).append((pk, object_uri))
+        # Walk the tree the same way we always have
+        descendants: list[int] = []
+        queue = [self.post.object_uri]
+        seen: set[int] = set()
+        while queue and len(descendants) < num_descendants:
+            node_uri = queue.pop()
+            for pk, object_uri in replies.get(node_uri, []):
+                if pk not in seen:
+                    descendants.append(pk)
+                    queue.append(object_uri)
+                    seen.add(pk)
+        return descendants
 
     def delete(self):
         """
         Marks a post as deleted and immediately cleans up its timeline events etc.
         """
+        self.post.uncount_reply()
         self.post.transition_perform(PostStates.deleted)
         TimelineEvent.objects.filter(subject_post=self.post).delete()
         PostInteraction.transition_perform_queryset(
@@ -6,7 +6,7 @@ from django.utils import timezone
 from django.views.generic import FormView
 
 from activities.models import Post, PostAttachment, PostAttachmentStates, TimelineEvent
-from core.files import blurhash_image, resize_image
+from core.files import process_image
 from core.models import Config
 from users.views.base import IdentityViewMixin
 
@@ -150,18 +150,11 @@ class Compose(IdentityViewMixin, FormView):
         # See if we need to make an image attachment
         attachments = []
         if form.cleaned_data.get("image"):
-            main_file = resize_image(
-                form.cleaned_data["image"],
-                size=(2000, 2000),
-                cover=False,
-            )
-            thumbnail_file = resize_image(
-                form.cleaned_data["image"],
-                size=(400, 225),
-                cover=True,
+            main_file, thumbnail_file, blurhash = process_image(
+                form.cleaned_data["image"]
             )
             attachment = PostAttachment.objects.create(
-                blurhash=blurhash_image(thumbnail_file),
+                blurhash=blurhash,
                 mimetype="image/webp",
                 width=main_file.image.width,
                 height=main_file.image.height,
@@ -1,6 +1,11 @@
+from asgiref.sync import sync_to_async
 from django.http import HttpResponse
 
 from api.models import Token
+from core.middleware import AsyncMiddlewareMixin
+
+# Paths whose views check a bearer token of their own
+OWN_TOKEN_PATHS = {"/metrics"}
 
 
 class ApiTokenMiddleware:
@@ -16,15 +21,18 @@ class ApiTokenMiddleware:
         auth_header = request.headers.get("authorization", None)
         request.token = None
         request.identity = None
-        if auth_header and auth_header.startswith("Bearer "):
+        if (
+            auth_header
+            and auth_header.startswith("Bearer ")
+            and request.path not in OWN_TOKEN_PATHS
+        ):
             token_value = auth_header[7:]
             if token_value == "__app__":
                 # Special client app token value
                 pass
             else:
-                try:
-                    token = Token.objects.get(token=token_value, revoked=None)
-                except Token.DoesNotExist:
+                token = Token.get_active(token_value)
+                if token is None:
                     return HttpResponse("Invalid Bearer token", status=400)
                 request.user = token.user
                 request.identity = token.identity
@@ -32,3 +40,20 @@ class ApiTokenMiddleware:
             request.session = None
         response = self.get_response(request)
         return response
+
+
+class AsyncApiTokenMiddleware(AsyncMiddlewareMixin):
+    """
+    ApiTokenMiddleware, for running natively async under ASGI.
+    """
+
+    async def aprocess_request(self, request):
+        # Only API requests (which have sync views anyway) need a lookup
+        if request.headers.get("authorization", "").startswith("Bearer "):
+            return await sync_to_async(self.process_request)(request)
+        request.token = None
+        request.identity = None
+
+    def process_request(self, request):
+        # The sync middleware's checks, with no view behind it to call
+        return ApiTokenMiddleware(lambda request: None)(request)
@@ -1,7 +1,10 @@
 import urlman
+from django.conf import settings
 from django.db import models
 from pydantic import BaseModel
 
+from core.lookups import LookupCache
+
 
 class PushSubscriptionSchema(BaseModel):
     """
@@ -56,9 +59,49 @@ class Token(models.Model):
 
     push_subscription = models.JSONField(blank=True, null=True)
 
+    # Active tokens by token value, for the request path
+    lookup_cache = LookupCache("token")
+
     class urls(urlman.Urls):
         edit = "/@{self.identity.handle}/settings/tokens/{self.id}/"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.lookup_cache.invalidate(self.token)
+
+    def delete(self, *args, **kwargs):
+        self.lookup_cache.invalidate(self.token)
+        return super().delete(*args, **kwargs)
+
+    @classmethod
+    def get_active(cls, token: str) -> "Token | None":
+        """
+        Returns the unrevoked Token with this value, with its user and
+        identity loaded, if there is one and its user isn't banned or deleted.
+
+        It's only cached if LOOKUP_CACHE_SHARED is set; otherwise other
+        processes couldn't be told it had been revoked, so it's fetched
+        (along with the user and identity) in a single query each time.
+        """
+        from users.models import Identity, User
+
+        if settings.SETUP.LOOKUP_CACHE_SHARED:
+            instance = cls.lookup_cache.get(
+                token, lambda: cls.objects.filter(token=token, revoked=None).first()
+            )
+            if instance is not None:
+                instance.user = User.get_cached(instance.user_id)
+                instance.identity = Identity.get_cached(instance.identity_id)
+        else:
+            instance = (
+                cls.objects.select_related("user", "identity__domain")
+                .filter(token=token, revoked=None)
+                .first()
+            )
+        if instance is None or (instance.user and not instance.user.is_active):
+            return None
+        return instance
+
     def has_scope(self, scope: str):
         """
         Returns if this token has the given scope.
@@ -96,8 +96,8 @@ class Account(Schema):
 class MediaAttachment(Schema):
     id: str
     type: Literal["unknown", "image", "gifv", "video", "audio"]
-    url: str
-    preview_url: str
+    url: str | None
+    preview_url: str | None
     remote_url: str | None
     meta: dict
     description: str | None
@@ -201,6 +201,7 @@ class Status(Schema):
         posts: list[activities_models.Post],
         identity: users_models.Identity,
     ) -> list["Status"]:
+        activities_models.Post.prefetch_mastodon(posts, identity)
         interactions = activities_models.PostInteraction.get_post_interactions(
             posts, identity
         )
@@ -235,6 +236,7 @@ class Status(Schema):
         events: list[activities_models.TimelineEvent],
         identity: users_models.Identity,
     ) -> list["Status"]:
+        activities_models.TimelineEvent.prefetch_mastodon(events, identity)
         interactions = activities_models.PostInteraction.get_event_interactions(
             events, identity
         )
@@ -69,7 +69,7 @@ urlpatterns = [
     path("v1/lists", lists.get_lists),
     # Media
     path("v1/media", media.upload_media),
-    path("v2/media", media.upload_media),
+    path("v2/media", media.upload_media_async),
     path("v1/media/<id>", methods(get=media.get_media, put=media.update_media)),
     path(
         "v1/statuses/<id>",
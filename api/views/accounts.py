@@ -1,7 +1,7 @@
 from typing import Any
 
 from django.core.files import File
-from django.http import HttpRequest
+from django.http import Http404, HttpRequest
 from django.shortcuts import get_object_or_404
 from hatchway import ApiResponse, QueryOrBody, api_view
 
@@ -82,19 +82,18 @@ def update_credentials(
 def account_relationships(
     request, id: list[str] | str | None
 ) -> list[schemas.Relationship]:
-    result = []
     if isinstance(id, str):
         ids = [id]
     elif id is None:
         ids = []
     else:
         ids = id
-    for actual_id in ids:
-        identity = get_object_or_404(Identity, pk=actual_id)
-        result.append(
-            IdentityService(identity).mastodon_json_relationship(request.identity)
+    return [
+        schemas.Relationship(**relationship)
+        for relationship in IdentityService.mastodon_json_relationships(
+            identities_or_404(ids), request.identity
         )
-    return result
+    ]
 
 
 @scope_required("read")
@@ -111,22 +110,36 @@ def familiar_followers(
         ids = []
     else:
         ids = id
-    result = []
-    for actual_id in ids:
-        target_identity = get_object_or_404(Identity, pk=actual_id)
-        result.append(
-            schemas.FamiliarFollowers(
-                id=actual_id,
-                accounts=[
-                    schemas.Account.from_identity(identity)
-                    for identity in Identity.objects.filter(
-                        inbound_follows__source=request.identity,
-                        outbound_follows__target=target_identity,
-                    )[:20]
-                ],
-            )
+    target_identities = identities_or_404(ids)
+    familiar = IdentityService.familiar_followers(request.identity, target_identities)
+    Identity.prefetch_mastodon_emojis(
+        identity for identities in familiar.values() for identity in identities
+    )
+    return [
+        schemas.FamiliarFollowers(
+            id=actual_id,
+            accounts=[
+                schemas.Account.from_identity(identity)
+                for identity in familiar[target_identity.pk]
+            ],
         )
-    return result
+        for actual_id, target_identity in zip(ids, target_identities)
+    ]
+
+
+def identities_or_404(ids: list[str]) -> list[Identity]:
+    """
+    Fetches the identities with the given IDs in one query, in the same
+    order, raising Http404 if any of them don't exist. Only the IDs are
+    loaded, as that's all relationship lookups need.
+    """
+    found = {
+        str(identity.pk): identity
+        for identity in Identity.objects.filter(pk__in=ids).only("pk")
+    }
+    if not all(actual_id in found for actual_id in ids):
+        raise Http404("No Identity matches the given query.")
+    return [found[actual_id] for actual_id in ids]
 
 
 @scope_required("read")
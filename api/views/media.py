@@ -1,14 +1,27 @@
 from django.core.files import File
 from django.shortcuts import get_object_or_404
-from hatchway import ApiError, QueryOrBody, api_view
+from hatchway import ApiError, ApiResponse, QueryOrBody, api_view
+from PIL import Image
 
 from activities.models import PostAttachment, PostAttachmentStates
 from api import schemas
-from core.files import blurhash_image, resize_image
+from core.files import process_image
 
 from ..decorators import scope_required
 
 
+def check_image(file: File):
+    """
+    Checks an upload looks like an image we can process (without decoding it)
+    """
+    try:
+        with Image.open(file):
+            pass
+    except (OSError, Image.DecompressionBombError):
+        raise ApiError(422, "File is not a supported image")
+    file.seek(0)
+
+
 @scope_required("write:media")
 @api_view.post
 def upload_media(
@@ -17,18 +30,10 @@ def upload_media(
     description: QueryOrBody[str] = "",
     focus: QueryOrBody[str] = "0,0",
 ) -> schemas.MediaAttachment:
-    main_file = resize_image(
-        file,
-        size=(2000, 2000),
-        cover=False,
-    )
-    thumbnail_file = resize_image(
-        file,
-        size=(400, 225),
-        cover=True,
-    )
+    check_image(file)
+    main_file, thumbnail_file, blurhash = process_image(file)
     attachment = PostAttachment.objects.create(
-        blurhash=blurhash_image(thumbnail_file),
+        blurhash=blurhash,
         mimetype="image/webp",
         width=main_file.image.width,
         height=main_file.image.height,
@@ -48,19 +53,51 @@ def upload_media(
     return schemas.MediaAttachment.from_post_attachment(attachment)
 
 
+@scope_required("write:media")
+@api_view.post
+def upload_media_async(
+    request,
+    file: File,
+    description: QueryOrBody[str] = "",
+    focus: QueryOrBody[str] = "0,0",
+) -> ApiResponse[schemas.MediaAttachment]:
+    """
+    Stores the original and leaves Stator to resize it; clients poll
+    get_media until it's done
+    """
+    check_image(file)
+    attachment = PostAttachment(
+        mimetype=file.content_type or "application/octet-stream",
+        name=description or None,
+        state=PostAttachmentStates.processing,
+        author=request.identity,
+    )
+    # Store the original first, so Stator never sees the row without it
+    attachment.file.save(file.name, file, save=False)
+    attachment.save()
+    return ApiResponse(
+        schemas.MediaAttachment.from_post_attachment(attachment), status=202
+    )
+
+
 @scope_required("read:media")
 @api_view.get
 def get_media(
     request,
     id: str,
-) -> schemas.MediaAttachment:
+) -> ApiResponse[schemas.MediaAttachment]:
     attachment = get_object_or_404(PostAttachment, pk=id)
     if attachment.post:
         if attachment.post.author != request.identity:
             raise ApiError(401, "Not the author of this attachment")
     elif attachment.author and attachment.author != request.identity:
         raise ApiError(401, "Not the author of this attachment")
-    return schemas.MediaAttachment.from_post_attachment(attachment)
+    if attachment.state == PostAttachmentStates.failed:
+        raise ApiError(422, "Media could not be processed")
+    return ApiResponse(
+        schemas.MediaAttachment.from_post_attachment(attachment),
+        status=206 if attachment.state == PostAttachmentStates.processing else 200,
+    )
 
 
 @scope_required("write:media")
@@ -9,6 +9,7 @@ from hatchway import ApiError, ApiResponse, Schema, api_view
 from activities.models import (
     Post,
     PostAttachment,
+    PostAttachmentStates,
     PostInteraction,
     PostInteractionStates,
     TimelineEvent,
@@ -78,6 +79,20 @@ def post_for_id(request: HttpRequest, id: str) -> Post:
     return get_object_or_404(queryset, pk=id)
 
 
+def attachments_for_ids(ids: list[str]) -> list[PostAttachment]:
+    """
+    Fetches attachments to go on a post, which must have finished processing
+    """
+    attachments = [get_object_or_404(PostAttachment, pk=id) for id in ids]
+    for attachment in attachments:
+        if attachment.state in [
+            PostAttachmentStates.processing,
+            PostAttachmentStates.failed,
+        ]:
+            raise ApiError(422, "Cannot attach files that have not finished processing")
+    return attachments
+
+
 @scope_required("write:statuses")
 @api_view.post
 def post_status(request, details: PostStatusSchema) -> schemas.Status:
@@ -87,7 +102,7 @@ def post_status(request, details: PostStatusSchema) -> schemas.Status:
     if not details.status and not details.media_ids:
         raise ApiError(400, "Status is empty")
     # Grab attachments
-    attachments = [get_object_or_404(PostAttachment, pk=id) for id in details.media_ids]
+    attachments = attachments_for_ids(details.media_ids)
     # Create the Post
     visibility_map = {
         "public": Post.Visibilities.public,
@@ -133,7 +148,7 @@ def edit_status(request, id: str, details: EditStatusSchema) -> schemas.Status:
     if post.author != request.identity:
         raise ApiError(401, "Not the author of this status")
     # Grab attachments
-    attachments = [get_object_or_404(PostAttachment, pk=id) for id in details.media_ids]
+    attachments = attachments_for_ids(details.media_ids)
     # Update all details, as the client must provide them all
     post.edit_local(
         content=details.status,
@@ -168,6 +183,7 @@ def status_context(request, id: str) -> schemas.Context:
     post = post_for_id(request, id)
     service = PostService(post)
     ancestors, descendants = service.context(request.identity)
+    Post.prefetch_mastodon(ancestors + descendants, request.identity)
     interactions = PostInteraction.get_post_interactions(
         ancestors + descendants, request.identity
     )
@@ -1,6 +1,7 @@
 from django.http import HttpRequest
 from hatchway import api_view
 
+from activities.models import Post, Trend
 from api import schemas
 from api.decorators import scope_required
 
@@ -12,8 +13,7 @@ def trends_tags(
     limit: int = 10,
     offset: int | None = None,
 ) -> list[schemas.Tag]:
-    # We don't implement this yet
-    return []
+    return [schemas.Tag(**tag) for tag in Trend.top(Trend.Kinds.tags, limit, offset)]
 
 
 @scope_required("read")
@@ -23,8 +23,16 @@ def trends_statuses(
     limit: int = 10,
     offset: int | None = None,
 ) -> list[schemas.Status]:
-    # We don't implement this yet
-    return []
+    ids = Trend.top(Trend.Kinds.statuses, limit, offset)
+    posts = (
+        Post.objects.not_hidden()
+        .select_related("author", "author__domain")
+        .prefetch_related("attachments", "mentions", "emojis")
+        .in_bulk(ids)
+    )
+    return schemas.Status.map_from_post(
+        [posts[pk] for pk in ids if pk in posts], request.identity
+    )
 
 
 @scope_required("read")
@@ -34,5 +42,4 @@ def trends_links(
     limit: int = 10,
     offset: int | None = None,
 ) -> list:
-    # We don't implement this yet
-    return []
+    return Trend.top(Trend.Kinds.links, limit, offset)
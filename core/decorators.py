@@ -2,7 +2,9 @@ from collections.abc import Callable
 from functools import partial, wraps
 from typing import ParamSpecArgs, ParamSpecKwargs
 
+from asgiref.sync import iscoroutinefunction, sync_to_async
 from django.http import HttpRequest
+from django.middleware.cache import CacheMiddleware
 from django.views.decorators.cache import cache_page as dj_cache_page
 
 from core.models import Config
@@ -32,31 +34,59 @@ def cache_page(
     timeout can either be the number of seconds or the name of a SystemOptions
     value.
     If public_only is True, requests with an identity are not cached.
+    Works on async views too (including an async dispatch() method).
     """
     _timeout = timeout
     _prefix = key_prefix
     if callable(vary_by):
         vary_by = [vary_by]
 
+    def get_cache_args(request, *args, **kwargs) -> tuple[int, str]:
+        prefix = [_prefix]
+
+        if isinstance(vary_by, list):
+            prefix.extend([vfunc(request, *args, **kwargs) for vfunc in vary_by])
+
+        if isinstance(_timeout, str):
+            timeout = getattr(Config.system, _timeout)
+        else:
+            timeout = _timeout
+
+        return timeout, "".join(prefix)
+
     def decorator(function):
+        if iscoroutinefunction(function):
+
+            @wraps(function)
+            async def ainner(request, *args, **kwargs):
+                if public_only:
+                    # request.user may need a query to load
+                    if await sync_to_async(lambda: request.user.is_authenticated)():
+                        return await function(request, *args, **kwargs)
+
+                timeout, prefix = get_cache_args(request, *args, **kwargs)
+                # Django's cache_page can't wrap async views, so drive its
+                # middleware by hand, with the cache calls in a thread
+                middleware = CacheMiddleware(
+                    function, page_timeout=timeout, key_prefix=prefix
+                )
+                response = await sync_to_async(middleware.process_request)(request)
+                if response is None:
+                    response = await function(request, *args, **kwargs)
+                    response = await sync_to_async(middleware.process_response)(
+                        request, response
+                    )
+                return response
+
+            return ainner
+
         @wraps(function)
         def inner(request, *args, **kwargs):
             if public_only:
                 if request.user.is_authenticated:
                     return function(request, *args, **kwargs)
 
-            prefix = [_prefix]
-
-            if isinstance(vary_by, list):
-                prefix.extend([vfunc(request, *args, **kwargs) for vfunc in vary_by])
-
-            prefix = "".join(prefix)
-
-            if isinstance(_timeout, str):
-                timeout = getattr(Config.system, _timeout)
-            else:
-                timeout = _timeout
-
+            timeout, prefix = get_cache_args(request, *args, **kwargs)
             return dj_cache_page(timeout=timeout, key_prefix=prefix)(function)(
                 request, *args, **kwargs
             )
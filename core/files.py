@@ -1,17 +1,59 @@
 import io
 
 import blurhash
-import httpx
 from django.conf import settings
 from django.core.files import File
 from django.core.files.base import ContentFile
 from PIL import Image, ImageOps
 
+from core.http import get_client
+
 
 class ImageFile(File):
     image: Image
 
 
+def transpose_image(img: Image.Image) -> Image.Image:
+    """
+    Applies any orientation EXIF data to a decoded image (and strips it)
+    """
+    try:
+        return ImageOps.exif_transpose(img)
+    except Exception:  # noqa
+        # exif_transpose can crash with different errors depending on
+        # the EXIF keys. Just ignore them all, better to have a rotated
+        # image than no image.
+        return img
+
+
+def render_image(
+    img: Image.Image,
+    *,
+    size: tuple[int, int],
+    cover=True,
+    format: str | None = None,
+) -> ImageFile:
+    """
+    Resizes an already-decoded image to fit inside the given size (cropping
+    one dimension to fit if cover is set), and encodes it as WebP or the
+    given format
+    """
+    if cover:
+        resized_image = ImageOps.fit(img, size, method=Image.Resampling.BILINEAR)
+    else:
+        resized_image = img.copy()
+        resized_image.thumbnail(size, resample=Image.Resampling.BILINEAR)
+    new_image_bytes = io.BytesIO()
+    if format:
+        resized_image.save(new_image_bytes, format=format)
+        file = ImageFile(new_image_bytes)
+    else:
+        resized_image.save(new_image_bytes, format="webp", save_all=True)
+        file = ImageFile(new_image_bytes, name="image.webp")
+    file.image = resized_image
+    return file
+
+
 def resize_image(
     image: File,
     *,
@@ -24,36 +66,55 @@ def resize_image(
     to fit if needed)
     """
     with Image.open(image) as img:
-        try:
-            # Take any orientation EXIF data, apply it, and strip the
-            # orientation data from the new image.
-            img = ImageOps.exif_transpose(img)
-        except Exception:  # noqa
-            # exif_transpose can crash with different errors depending on
-            # the EXIF keys. Just ignore them all, better to have a rotated
-            # image than no image.
-            pass
-
-        if cover:
-            resized_image = ImageOps.fit(img, size, method=Image.Resampling.BILINEAR)
-        else:
-            resized_image = img.copy()
-            resized_image.thumbnail(size, resample=Image.Resampling.BILINEAR)
-        new_image_bytes = io.BytesIO()
-        if keep_format:
-            resized_image.save(new_image_bytes, format=img.format)
-            file = ImageFile(new_image_bytes)
-        else:
-            resized_image.save(new_image_bytes, format="webp", save_all=True)
-            file = ImageFile(new_image_bytes, name="image.webp")
-        file.image = resized_image
-        return file
+        return render_image(
+            transpose_image(img),
+            size=size,
+            cover=cover,
+            format=img.format if keep_format else None,
+        )
+
+
+def process_image(image: File) -> tuple[ImageFile, ImageFile, str]:
+    """
+    Makes the display copy (within 2000x2000), the 400x225 thumbnail and the
+    blurhash for an uploaded image, decoding it only once for all three.
+    """
+    with Image.open(image) as img:
+        # Let JPEGs decode straight to the scale we need, if that's smaller
+        img.draft(img.mode, (2000, 2000))
+        img = transpose_image(img)
+        main_file = render_image(img, size=(2000, 2000), cover=False)
+        thumbnail_file = render_image(img, size=(400, 225), cover=True)
+    return main_file, thumbnail_file, blurhash_image(thumbnail_file.image)
+
+
+def thumbnail_image(image: File) -> tuple[ImageFile, tuple[int, int]]:
+    """
+    Makes the 400x225 thumbnail for an image, returning it along with the
+    full image's (upright) size
+    """
+    with Image.open(image) as img:
+        width, height = img.size
+        # Large JPEGs can decode straight to near the thumbnail size
+        img.draft(img.mode, (400, 225))
+        img = transpose_image(img)
+        if (img.width > img.height) != (width > height):
+            width, height = height, width
+        return render_image(img, size=(400, 225), cover=True), (width, height)
 
 
 def blurhash_image(file) -> str:
     """
-    Returns the blurhash for an image
+    Returns the blurhash for an image (a file, or an already-decoded image)
     """
+    if isinstance(file, Image.Image):
+        # Blurhash only needs a handful of pixels; hand it a small,
+        # uncompressed copy rather than encoding and decoding it again
+        small = file.convert("RGB")
+        small.thumbnail((100, 100))
+        file = io.BytesIO()
+        small.save(file, format="bmp")
+        file.seek(0)
     return blurhash.encode(file, 4, 4)
 
 
@@ -66,25 +127,21 @@ def get_remote_file(
     """
     Download a URL and return the File and content-type.
     """
-    headers = {
-        "User-Agent": settings.TAKAHE_USER_AGENT,
-    }
-
-    with httpx.Client(headers=headers) as client:
-        with client.stream(
-            "GET", url, timeout=timeout, follow_redirects=True
-        ) as stream:
-            allow_download = max_size is None
-            if max_size:
-                try:
-                    content_length = int(stream.headers["content-length"])
-                    allow_download = content_length <= max_size
-                except (KeyError, TypeError):
-                    pass
-            if allow_download:
-                file = ContentFile(stream.read(), name=url)
-                return file, stream.headers.get(
-                    "content-type", "application/octet-stream"
-                )
-
-    return None, None
+    with get_client().stream(
+        "GET", url, timeout=timeout, follow_redirects=True
+    ) as stream:
+        if max_size:
+            try:
+                if int(stream.headers["content-length"]) > max_size:
+                    return None, None
+            except (KeyError, TypeError, ValueError):
+                pass
+        # Count what actually arrives too, in case there was no (or a wrong)
+        # content-length
+        content = bytearray()
+        for chunk in stream.iter_bytes():
+            content += chunk
+            if max_size and len(content) > max_size:
+                return None, None
+        file = ContentFile(bytes(content), name=url)
+        return file, stream.headers.get("content-type", "application/octet-stream")
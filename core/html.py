@@ -1,7 +1,12 @@
+import hashlib
 import html
 import re
+from collections.abc import Callable, Iterable
 from html.parser import HTMLParser
+from typing import Any
 
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.safestring import mark_safe
 
 
@@ -321,31 +326,133 @@ class FediverseHtmlParser(HTMLParser):
         return self.text_output.strip()
 
 
+class LinkFinder(HTMLParser):
+    """
+    Collects the targets of ordinary links (not mentions or hashtags) in
+    some HTML, in order and without duplicates.
+    """
+
+    def __init__(self, html: str):
+        super().__init__()
+        self.links: list[str] = []
+        self.feed(html)
+        self.close()
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag != "a":
+            return
+        attributes = dict(attrs)
+        href = (attributes.get("href") or "").split("#")[0]
+        classes = (attributes.get("class") or "").split()
+        if (
+            not href.startswith(("http://", "https://"))
+            or "mention" in classes
+            or "hashtag" in classes
+            or attributes.get("rel") == "tag"
+            or href in self.links
+        ):
+            return
+        self.links.append(href)
+
+
 class ContentRenderer:
     """
     Renders HTML for posts, identity fields, and more.
 
     The `local` parameter affects whether links are absolute (False) or relative (True)
+
+    Rendered HTML is kept on the object it belongs to (and in the cache, if
+    one is configured), keyed by a hash of the source HTML and the object's
+    `updated` time, so it's only parsed again when the object is saved.
+    Things it doesn't own that change its rendering (a mentioned identity
+    moving, say, or an emoji being approved) show up when the cache expires.
     """
 
     def __init__(self, local: bool):
         self.local = local
 
+    @classmethod
+    def cache_key(cls, kind: str, obj, html: str, local: bool) -> str:
+        # Only uses what's on the object, so working out a key never queries
+        version = obj.updated.isoformat() if obj.updated else ""
+        digest = hashlib.sha256(f"{html}\0{version}".encode("utf8")).hexdigest()[:32]
+        mode = "local" if local else "remote"
+        return f"rendered:{kind}:{obj._meta.label_lower}:{obj.pk}:{mode}:{digest}"
+
+    def cached(self, kind: str, obj, html: str, render: Callable[[], str]) -> str:
+        """
+        Returns the rendered form of `html` for `obj`, only calling `render`
+        if we don't already have it.
+        """
+        if obj.pk is None:
+            return render()
+        key = self.cache_key(kind, obj, html, self.local)
+        rendered = obj.__dict__.setdefault("_rendered_content", {})
+        if key not in rendered:
+            timeout = settings.SETUP.CONTENT_CACHE_TTL
+            result = cache.get(key) if timeout else None
+            if result is None:
+                result = render()
+                if timeout:
+                    cache.set(key, result, timeout=timeout)
+            rendered[key] = mark_safe(result)
+        return rendered[key]
+
+    def prefetch(self, kind: str, items: Iterable[tuple[Any, str]]):
+        """
+        Loads any already-rendered HTML for several (object, html) pairs
+        from the cache in one go.
+        """
+        if not settings.SETUP.CONTENT_CACHE_TTL:
+            return
+        wanted = {}
+        for obj, content in items:
+            if obj.pk is None or not content:
+                continue
+            rendered = obj.__dict__.setdefault("_rendered_content", {})
+            key = self.cache_key(kind, obj, content, self.local)
+            if key not in rendered:
+                wanted[key] = rendered
+        for key, result in cache.get_many(list(wanted)).items():
+            wanted[key][key] = mark_safe(result)
+
+    @classmethod
+    def invalidate(cls, obj, contents: Iterable[tuple[str, str | None]]):
+        """
+        Forgets the rendered HTML for the given (kind, html) pairs of `obj`;
+        call it before changing the object.
+        """
+        obj.__dict__.pop("_rendered_content", None)
+        if obj.pk is None or not settings.SETUP.CONTENT_CACHE_TTL:
+            return
+        cache.delete_many(
+            [
+                cls.cache_key(kind, obj, content, local)
+                for kind, content in contents
+                if content
+                for local in [True, False]
+            ]
+        )
+
     def render_post(self, html: str, post) -> str:
         """
         Given post HTML, normalises it and renders it for presentation.
         """
         if not html:
             return ""
-        parser = FediverseHtmlParser(
-            html,
-            mentions=post.mentions.all(),
-            uri_domain=(None if self.local else post.author.domain.uri_domain),
-            find_hashtags=True,
-            find_emojis=self.local,
-            emoji_domain=post.author.domain,
-        )
-        return mark_safe(parser.html)
+
+        def render():
+            parser = FediverseHtmlParser(
+                html,
+                mentions=post.mentions.all(),
+                uri_domain=(None if self.local else post.author.domain.uri_domain),
+                find_hashtags=True,
+                find_emojis=self.local,
+                emoji_domain=post.author.domain,
+            )
+            return parser.html
+
+        return self.cached("post", post, html, render)
 
     def render_identity_summary(self, html: str, identity) -> str:
         """
@@ -353,14 +460,18 @@ class ContentRenderer:
         """
         if not html:
             return ""
-        parser = FediverseHtmlParser(
-            html,
-            uri_domain=(None if self.local else identity.domain.uri_domain),
-            find_hashtags=True,
-            find_emojis=self.local,
-            emoji_domain=identity.domain,
-        )
-        return mark_safe(parser.html)
+
+        def render():
+            parser = FediverseHtmlParser(
+                html,
+                uri_domain=(None if self.local else identity.domain.uri_domain),
+                find_hashtags=True,
+                find_emojis=self.local,
+                emoji_domain=identity.domain,
+            )
+            return parser.html
+
+        return self.cached("summary", identity, html, render)
 
     def render_identity_data(self, html: str, identity, strip: bool = False) -> str:
         """
@@ -368,14 +479,15 @@ class ContentRenderer:
         """
         if not html:
             return ""
-        parser = FediverseHtmlParser(
-            html,
-            uri_domain=(None if self.local else identity.domain.uri_domain),
-            find_hashtags=False,
-            find_emojis=self.local,
-            emoji_domain=identity.domain,
-        )
-        if strip:
-            return mark_safe(parser.html)
-        else:
-            return mark_safe(parser.html)
+
+        def render():
+            parser = FediverseHtmlParser(
+                html,
+                uri_domain=(None if self.local else identity.domain.uri_domain),
+                find_hashtags=False,
+                find_emojis=self.local,
+                emoji_domain=identity.domain,
+            )
+            return parser.html
+
+        return self.cached("data", identity, html, render)
@@ -0,0 +1,321 @@
+import asyncio
+import os
+import threading
+import weakref
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Callable
+
+import httpx
+from django.conf import settings
+
+
+class PoolStats:
+    """
+    Counts how often outbound requests reused a pooled connection (a hit)
+    versus having to open a new one (a miss).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.misses = 0
+        self.host_waits = 0
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def trace(self, event: str, info: dict):
+        """
+        httpcore trace callback (see httpx's "trace" request extension);
+        a TCP connect only happens when the pool had nothing to reuse.
+        """
+        if event == "connection.connect_tcp.started":
+            self.record_miss()
+
+    async def atrace(self, event: str, info: dict):
+        self.trace(event, info)
+
+    def record_host_wait(self):
+        with self.lock:
+            self.host_waits += 1
+
+    @property
+    def hits(self) -> int:
+        return max(self.requests - self.misses, 0)
+
+    def take(self) -> dict[str, int]:
+        """
+        Returns the counts so far and starts them again from zero, for a
+        Stator runner to add to the running totals on /metrics.
+        """
+        with self.lock:
+            counts = {
+                "requests": self.requests,
+                "misses": self.misses,
+                "host_waits": self.host_waits,
+            }
+            self.requests = 0
+            self.misses = 0
+            self.host_waits = 0
+        return counts
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.misses = 0
+            self.host_waits = 0
+
+
+pool_stats = PoolStats()
+
+
+class ReleasingStream(httpx.SyncByteStream):
+    """
+    Wraps a response stream so a callback runs (once) when it's closed.
+    """
+
+    def __init__(self, stream: httpx.SyncByteStream, on_close: Callable[[], None]):
+        self.stream = stream
+        self.on_close: Callable[[], None] | None = on_close
+
+    def __iter__(self):
+        yield from self.stream
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+                self.on_close = None
+
+
+class HostLimitedTransport(httpx.BaseTransport):
+    """
+    Caps how many requests may be in flight to any single host, on top of
+    the overall limits of the wrapped transport. A slot is held until the
+    response is closed, so streamed downloads count for their whole length.
+    """
+
+    def __init__(self, transport: httpx.BaseTransport, max_per_host: int):
+        self.transport = transport
+        self.max_per_host = max_per_host
+        self.semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self.lock = threading.Lock()
+
+    def semaphore_for(self, host: str) -> threading.BoundedSemaphore:
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.semaphores[host]
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        semaphore = self.semaphore_for(request.url.host)
+        if not semaphore.acquire(blocking=False):
+            pool_stats.record_host_wait()
+            timeout = request.extensions.get("timeout", {}).get("pool")
+            if not semaphore.acquire(timeout=timeout):
+                raise httpx.PoolTimeout(
+                    f"Too many open requests to {request.url.host}",
+                    request=request,
+                )
+        pool_stats.record_request()
+        if "trace" not in request.extensions:
+            request.extensions = {**request.extensions, "trace": pool_stats.trace}
+        try:
+            response = self.transport.handle_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        if response.is_closed:
+            # Already fully read (e.g. in-memory responses), nothing to hold
+            semaphore.release()
+        else:
+            response.stream = ReleasingStream(
+                response.stream, semaphore.release  # type: ignore
+            )
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncReleasingStream(httpx.AsyncByteStream):
+    """
+    The asyncio version of ReleasingStream.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[], None]):
+        self.stream = stream
+        self.on_close: Callable[[], None] | None = on_close
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+                self.on_close = None
+
+
+class AsyncHostLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    The asyncio version of HostLimitedTransport. Its semaphores belong to
+    one event loop, as does the client using it.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_per_host: int):
+        self.transport = transport
+        self.max_per_host = max_per_host
+        self.semaphores: dict[str, asyncio.Semaphore] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        semaphore = self.semaphores[host]
+        if semaphore.locked():
+            pool_stats.record_host_wait()
+            timeout = request.extensions.get("timeout", {}).get("pool")
+            try:
+                await asyncio.wait_for(semaphore.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise httpx.PoolTimeout(
+                    f"Too many open requests to {request.url.host}",
+                    request=request,
+                )
+        else:
+            await semaphore.acquire()
+        pool_stats.record_request()
+        if "trace" not in request.extensions:
+            request.extensions = {**request.extensions, "trace": pool_stats.atrace}
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        if response.is_closed:
+            semaphore.release()
+        else:
+            response.stream = AsyncReleasingStream(
+                response.stream, semaphore.release  # type: ignore
+            )
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def transport_options() -> dict:
+    """
+    Returns the connection pool options for a transport, from our settings.
+    """
+    http2 = settings.SETUP.HTTP_POOL_HTTP2
+    if http2:
+        try:
+            import h2  # noqa
+        except ImportError:
+            http2 = False
+    return {
+        "http2": http2,
+        "limits": httpx.Limits(
+            max_connections=settings.SETUP.HTTP_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.SETUP.HTTP_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=settings.SETUP.HTTP_POOL_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+
+def client_options() -> dict:
+    """
+    Returns the options every outbound client is made with.
+    """
+    return {
+        "timeout": settings.SETUP.REMOTE_TIMEOUT,
+        "headers": {"User-Agent": settings.TAKAHE_USER_AGENT},
+        # Never carry cookies from one remote server's response to the next
+        "cookies": CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+    }
+
+
+def build_client() -> httpx.Client:
+    """
+    Makes a new pooled client set up from our settings.
+    """
+    return httpx.Client(
+        transport=HostLimitedTransport(
+            httpx.HTTPTransport(**transport_options()),
+            settings.SETUP.HTTP_POOL_MAX_PER_HOST,
+        ),
+        **client_options(),
+    )
+
+
+def build_async_client() -> httpx.AsyncClient:
+    """
+    Makes a new pooled asyncio client set up from our settings.
+    """
+    return httpx.AsyncClient(
+        transport=AsyncHostLimitedTransport(
+            httpx.AsyncHTTPTransport(**transport_options()),
+            settings.SETUP.HTTP_POOL_MAX_PER_HOST,
+        ),
+        **client_options(),
+    )
+
+
+_client: httpx.Client | None = None
+_client_pid: int | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> httpx.Client:
+    """
+    Returns the process-wide pooled client used for all outbound requests.
+    It's rebuilt after a fork, as connections can't be shared between
+    processes.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = build_client()
+                _client_pid = pid
+    return _client
+
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns the pooled client for outbound requests from coroutines. Async
+    connections belong to the event loop that opened them, so there is one
+    client per running loop; close it with close_async_client().
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = build_async_client()
+    return client
+
+
+async def close_async_client():
+    """
+    Closes the running event loop's pooled client, if it has one.
+    """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -1,8 +1,12 @@
 import datetime
+import hashlib
+import json
 import logging
 import os
+import threading
 import urllib.parse as urllib_parse
 
+from cachetools import LRUCache
 from dateutil import parser
 from pyld import jsonld
 
@@ -628,7 +632,19 @@ DATETIME_TZ_FORMAT = "%Y-%m-%dT%H:%M:%S+00:00"
 DATETIME_MS_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
 
+#: Canonicalised forms of recently seen documents, keyed by a hash of the
+#: input with its context filled in
+canonical_cache: LRUCache = LRUCache(maxsize=256)
+canonical_cache_lock = threading.Lock()
+
+
 def builtin_document_loader(url: str, options={}):
+    # Tagging our bundled contexts as static lets pyld keep their processed
+    # form in its shared cache, rather than reprocessing them every call
+    return {**builtin_schema(url), "tag": "static"}
+
+
+def builtin_schema(url: str):
     # Get URL without scheme
     pieces = urllib_parse.urlparse(url)
     if pieces.hostname is None:
@@ -686,7 +702,25 @@ def canonicalise(json_data: dict, include_security: bool = False) -> dict:
 
     json_data["@context"] = context
 
-    return jsonld.compact(jsonld.expand(json_data), context)
+    # Documents we've already seen (repeat deliveries, already-compacted
+    # documents, local objects rendered again) come out the same every time,
+    # so skip the round-trip for them
+    try:
+        cache_key = hashlib.sha256(json.dumps(json_data).encode("utf8")).digest()
+    except (TypeError, ValueError):
+        cache_key = None
+    if cache_key is not None:
+        with canonical_cache_lock:
+            cached = canonical_cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+    # compact() would expand its input again otherwise
+    result = jsonld.compact(jsonld.expand(json_data), context, {"skipExpansion": True})
+    if cache_key is not None:
+        with canonical_cache_lock:
+            canonical_cache[cache_key] = json.dumps(result)
+    return result
 
 
 def get_list(container, key) -> list:
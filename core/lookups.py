@@ -0,0 +1,100 @@
+import copy
+import threading
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any, ClassVar
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import cache
+
+MISSING = object()
+
+
+class LookupCache:
+    """
+    A size- and age-bounded in-process cache for things looked up on every
+    request (domains, identities, settings), or, if LOOKUP_CACHE_SHARED is
+    set, a cache of them shared between processes through the Django cache.
+
+    Callers get a copy of the cached value, so changing it can't leak into
+    other requests. Whatever changes the underlying rows must call
+    `invalidate` (queryset updates included). In-process, that only reaches
+    this process, and other processes' copies last up to LOOKUP_CACHE_TTL
+    seconds, so don't cache anything security sensitive that way.
+    """
+
+    instances: ClassVar[list["LookupCache"]] = []
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.local: TTLCache = TTLCache(
+            maxsize=settings.SETUP.LOOKUP_CACHE_SIZE,
+            ttl=settings.SETUP.LOOKUP_CACHE_TTL,
+        )
+        self.instances.append(self)
+
+    def cache_key(self, key: Hashable) -> str:
+        return f"lookup:{self.name}:{key}"
+
+    def get(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        """
+        Returns the value for key, calling load() to fetch it if it's not
+        cached (a None result is cached too)
+        """
+        if settings.SETUP.LOOKUP_CACHE_SHARED:
+            value = cache.get(self.cache_key(key), MISSING)
+            if value is MISSING:
+                value = load()
+                cache.set(self.cache_key(key), value, settings.SETUP.LOOKUP_CACHE_TTL)
+        else:
+            with self.lock:
+                value = self.local.get(key, MISSING)
+            if value is MISSING:
+                value = load()
+                with self.lock:
+                    self.local[key] = value
+        return copy.copy(value)
+
+    async def aget(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Async version of get(), where load is a coroutine function
+        """
+        if settings.SETUP.LOOKUP_CACHE_SHARED:
+            value = await cache.aget(self.cache_key(key), MISSING)
+            if value is MISSING:
+                value = await load()
+                await cache.aset(
+                    self.cache_key(key), value, settings.SETUP.LOOKUP_CACHE_TTL
+                )
+        else:
+            with self.lock:
+                value = self.local.get(key, MISSING)
+            if value is MISSING:
+                value = await load()
+                with self.lock:
+                    self.local[key] = value
+        return copy.copy(value)
+
+    def invalidate(self, *keys: Hashable | None):
+        """
+        Forgets the values for keys, here and in the shared cache
+        """
+        keys = tuple(key for key in keys if key is not None)
+        with self.lock:
+            for key in keys:
+                self.local.pop(key, None)
+        if keys and settings.SETUP.LOOKUP_CACHE_SHARED:
+            cache.delete_many([self.cache_key(key) for key in keys])
+
+    def clear(self):
+        with self.lock:
+            self.local.clear()
+
+    @classmethod
+    def clear_all(cls):
+        """
+        Empties every in-process lookup cache (for tests)
+        """
+        for instance in cls.instances:
+            instance.clear()
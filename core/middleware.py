@@ -1,7 +1,10 @@
 from time import time
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.conf import settings
 from django.core.exceptions import MiddlewareNotUsed
+from django.utils.deprecation import MiddlewareMixin
+from whitenoise.middleware import WhiteNoiseMiddleware
 
 from core import sentry
 from core.models import Config
@@ -68,6 +71,114 @@ class SentryTaggingMiddleware:
         return response
 
 
+class AsyncMiddlewareMixin(MiddlewareMixin):
+    """
+    Like Django's MiddlewareMixin, but when running async it calls the hooks
+    directly rather than switching to a thread for each one. The hooks must
+    not block; implement aprocess_request to await anything that would.
+    """
+
+    async def __acall__(self, request):
+        response = None
+        if hasattr(self, "aprocess_request"):
+            response = await self.aprocess_request(request)
+        elif hasattr(self, "process_request"):
+            response = self.process_request(request)
+        response = response or await self.get_response(request)
+        if hasattr(self, "process_response"):
+            response = self.process_response(request, response)
+        return response
+
+
+class AsyncHeadersMiddleware(AsyncMiddlewareMixin):
+    """
+    HeadersMiddleware, for running natively async under ASGI.
+    """
+
+    def process_request(self, request):
+        accept = request.headers.get("accept", "text/html").lower()
+        request.ap_json = (
+            "application/json" in accept
+            or "application/ld" in accept
+            or "application/activity" in accept
+        )
+
+    def process_response(self, request, response):
+        if "Cache-Control" not in response.headers:
+            response.headers["Cache-Control"] = "no-store, max-age=0"
+        return response
+
+
+class AsyncConfigLoadingMiddleware(AsyncMiddlewareMixin):
+    """
+    ConfigLoadingMiddleware, for running natively async under ASGI.
+    """
+
+    refresh_interval: float = 5.0
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.config_ts: float = 0.0
+
+    def needs_refresh(self) -> bool:
+        # Allow test fixtures to force and lock the config
+        if getattr(Config, "__forced__", False):
+            return False
+        return (
+            not getattr(Config, "system", None)
+            or (time() - self.config_ts) >= self.refresh_interval
+        )
+
+    def process_request(self, request):
+        if self.needs_refresh():
+            Config.system = Config.load_system()
+            self.config_ts = time()
+
+    async def aprocess_request(self, request):
+        if self.needs_refresh():
+            Config.system = await sync_to_async(Config.load_system)()
+            self.config_ts = time()
+
+
+class AsyncSentryTaggingMiddleware(AsyncMiddlewareMixin):
+    """
+    SentryTaggingMiddleware, for running natively async under ASGI.
+    """
+
+    def __init__(self, get_response):
+        if not sentry.SENTRY_ENABLED:
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+
+    def process_request(self, request):
+        sentry.set_takahe_app("web")
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise, able to run in an async middleware chain as well (the file
+    lookup is in memory unless autorefresh is on, as it is in development).
+    """
+
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+
 def show_toolbar(request):
     """
     Determines whether to show the debug toolbar on a given page.
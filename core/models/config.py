@@ -6,6 +6,7 @@ from django.core.files import File
 from django.db import models
 from django.utils.functional import lazy
 
+from core.lookups import LookupCache
 from core.uploads import upload_namer
 from core.uris import StaticAbsoluteUrl
 from takahe import __version__
@@ -64,6 +65,10 @@ class Config(models.Model):
 
     system: ClassVar["Config.ConfigOptions"]  # type: ignore
 
+    # Loaded user and identity options, by user/identity pk
+    user_cache = LookupCache("config_user")
+    identity_cache = LookupCache("config_identity")
+
     @classmethod
     def lazy_system_value(cls, key: str):
         """
@@ -99,21 +104,27 @@ class Config(models.Model):
     @classmethod
     def load_user(cls, user):
         """
-        Loads a user config options object
+        Loads a user config options object (cached)
         """
-        return cls.load_values(
-            cls.UserOptions,
-            {"identity__isnull": True, "user": user, "domain__isnull": True},
+        return cls.user_cache.get(
+            user.pk,
+            lambda: cls.load_values(
+                cls.UserOptions,
+                {"identity__isnull": True, "user": user, "domain__isnull": True},
+            ),
         )
 
     @classmethod
     def load_identity(cls, identity):
         """
-        Loads an identity config options object
+        Loads an identity config options object (cached)
         """
-        return cls.load_values(
-            cls.IdentityOptions,
-            {"identity": identity, "user__isnull": True, "domain__isnull": True},
+        return cls.identity_cache.get(
+            identity.pk,
+            lambda: cls.load_values(
+                cls.IdentityOptions,
+                {"identity": identity, "user__isnull": True, "domain__isnull": True},
+            ),
         )
 
     @classmethod
@@ -168,6 +179,7 @@ class Config(models.Model):
             cls.UserOptions,
             {"identity__isnull": True, "user": user, "domain__isnull": True},
         )
+        cls.user_cache.invalidate(user.pk)
 
     @classmethod
     def set_identity(cls, identity, key, value):
@@ -177,6 +189,7 @@ class Config(models.Model):
             cls.IdentityOptions,
             {"identity": identity, "user__isnull": True, "domain__isnull": True},
         )
+        cls.identity_cache.invalidate(identity.pk)
 
     @classmethod
     def set_domain(cls, domain, key, value):
@@ -1,8 +1,12 @@
 import base64
+import hashlib
 import json
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from ssl import SSLCertVerificationError, SSLError
-from typing import Literal, TypedDict, cast
+from typing import Any, Literal, TypedDict, cast
 from urllib.parse import urlparse
 
 import httpx
@@ -17,6 +21,7 @@ from httpx._types import TimeoutTypes
 from idna.core import InvalidCodepoint
 from pyld import jsonld
 
+from core.http import get_async_client, get_client
 from core.ld import format_ld_date
 
 logger = logging.getLogger(__name__)
@@ -38,7 +43,104 @@ class VerificationFormatError(VerificationError):
     pass
 
 
+class KeyCache:
+    """
+    A bounded, thread-safe LRU of parsed RSA key objects, keyed by the key
+    ID and a hash of the PEM (so a changed key can never be served stale).
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.keys: OrderedDict[tuple[str, str, bytes], Any] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def take(self) -> dict[str, int]:
+        """
+        Returns the hit and miss counts so far and starts them again from
+        zero, for a Stator runner to add to the running totals on /metrics.
+        """
+        with self.lock:
+            counts = {"hits": self.hits, "misses": self.misses}
+            self.hits = 0
+            self.misses = 0
+        return counts
+
+    def get(self, kind: str, pem: str, key_id: str | None, loader) -> Any:
+        cache_key = (kind, key_id or "", hashlib.sha256(pem.encode("ascii")).digest())
+        with self.lock:
+            if cache_key in self.keys:
+                self.hits += 1
+                self.keys.move_to_end(cache_key)
+                return self.keys[cache_key]
+            self.misses += 1
+        key = loader(pem.encode("ascii"))
+        with self.lock:
+            self.keys[cache_key] = key
+            while len(self.keys) > self.maxsize:
+                self.keys.popitem(last=False)
+        return key
+
+    def forget(self, key_id: str):
+        """
+        Drops every cached key for the given key ID
+        """
+        with self.lock:
+            for cache_key in [k for k in self.keys if k[1] == key_id]:
+                del self.keys[cache_key]
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+
 class RsaKeys:
+
+    #: Parsed keys, shared by everything that signs or verifies in this process
+    cache = KeyCache(maxsize=1000)
+
+    @classmethod
+    def load_private_key(
+        cls, private_key: str, key_id: str | None = None
+    ) -> rsa.RSAPrivateKey:
+        """
+        Returns the parsed private key for a PEM string, from cache if we can
+        """
+        return cast(
+            rsa.RSAPrivateKey,
+            cls.cache.get(
+                "private",
+                private_key,
+                key_id,
+                lambda pem: serialization.load_pem_private_key(pem, password=None),
+            ),
+        )
+
+    @classmethod
+    def load_public_key(
+        cls, public_key: str, key_id: str | None = None
+    ) -> rsa.RSAPublicKey:
+        """
+        Returns the parsed public key for a PEM string, from cache if we can
+        """
+        return cast(
+            rsa.RSAPublicKey,
+            cls.cache.get(
+                "public", public_key, key_id, serialization.load_pem_public_key
+            ),
+        )
+
+    @classmethod
+    def forget(cls, key_id: str | None):
+        """
+        Evicts any parsed keys for a key ID that's being replaced
+        """
+        if key_id:
+            cls.cache.forget(key_id)
+
     @classmethod
     def generate_keypair(cls) -> tuple[str, str]:
         """
@@ -135,11 +237,9 @@ class HttpSignature:
         signature: bytes,
         cleartext: str,
         public_key: str,
+        key_id: str | None = None,
     ):
-        public_key_instance: rsa.RSAPublicKey = cast(
-            rsa.RSAPublicKey,
-            serialization.load_pem_public_key(public_key.encode("ascii")),
-        )
+        public_key_instance = RsaKeys.load_public_key(public_key, key_id)
         try:
             public_key_instance.verify(
                 signature,
@@ -151,7 +251,7 @@ class HttpSignature:
             raise VerificationError("Signature mismatch")
 
     @classmethod
-    def verify_request(cls, request, public_key, skip_date=False):
+    def verify_request(cls, request, public_key, skip_date=False, key_id=None):
         """
         Verifies that the request has a valid signature for its body
         """
@@ -183,10 +283,11 @@ class HttpSignature:
             signature_details["signature"],
             headers_string,
             public_key,
+            key_id,
         )
 
     @classmethod
-    def signed_request(
+    def sign_request(
         cls,
         uri: str,
         body: dict | None,
@@ -194,11 +295,10 @@ class HttpSignature:
         key_id: str,
         content_type: str = "application/activity+json",
         method: Literal["get", "post"] = "post",
-        timeout: TimeoutTypes = settings.SETUP.REMOTE_TIMEOUT,
-    ):
+    ) -> tuple[dict[str, str], bytes]:
         """
-        Performs an async request to the given path, with a document, signed
-        as an identity.
+        Returns the signed headers and encoded body for a request to the
+        given path, with a document, as an identity.
         """
         if "://" not in uri:
             raise ValueError("URI does not contain a scheme")
@@ -224,13 +324,7 @@ class HttpSignature:
         signed_string = "\n".join(
             f"{name.lower()}: {value}" for name, value in headers.items()
         )
-        private_key_instance: rsa.RSAPrivateKey = cast(
-            rsa.RSAPrivateKey,
-            serialization.load_pem_private_key(
-                private_key.encode("ascii"),
-                password=None,
-            ),
-        )
+        private_key_instance = RsaKeys.load_private_key(private_key, key_id)
         signature = private_key_instance.sign(
             signed_string.encode("utf8"),
             padding.PKCS1v15(),
@@ -250,33 +344,96 @@ class HttpSignature:
 
         # Send the request with all those headers except the pseudo one
         del headers["(request-target)"]
-        with httpx.Client(timeout=timeout) as client:
-            try:
-                response = client.request(
-                    method,
-                    uri,
-                    headers=headers,
-                    content=body_bytes,
-                    follow_redirects=method == "get",
-                )
-            except SSLError as invalid_cert:
-                # Not our problem if the other end doesn't have proper SSL
-                logger.info("Invalid cert on %s %s", uri, invalid_cert)
-                raise SSLCertVerificationError(invalid_cert) from invalid_cert
-            except InvalidCodepoint as ex:
-                # Convert to a more generic error we handle
-                raise httpx.HTTPError(f"InvalidCodepoint: {str(ex)}") from None
-
-            if (
-                method == "post"
-                and response.status_code >= 400
-                and response.status_code < 500
-                and response.status_code != 404
-            ):
-                raise ValueError(
-                    f"POST error to {uri}: {response.status_code} {response.content!r}"
-                )
-            return response
+        return cast(dict[str, str], headers), body_bytes
+
+    @classmethod
+    @contextmanager
+    def request_errors(cls, uri: str):
+        """
+        Converts the errors a signed request can raise into ones we handle.
+        """
+        try:
+            yield
+        except SSLError as invalid_cert:
+            # Not our problem if the other end doesn't have proper SSL
+            logger.info("Invalid cert on %s %s", uri, invalid_cert)
+            raise SSLCertVerificationError(invalid_cert) from invalid_cert
+        except InvalidCodepoint as ex:
+            # Convert to a more generic error we handle
+            raise httpx.HTTPError(f"InvalidCodepoint: {str(ex)}") from None
+
+    @classmethod
+    def check_response(
+        cls, uri: str, method: str, response: httpx.Response
+    ) -> httpx.Response:
+        if (
+            method == "post"
+            and response.status_code >= 400
+            and response.status_code < 500
+            and response.status_code != 404
+        ):
+            raise ValueError(
+                f"POST error to {uri}: {response.status_code} {response.content!r}"
+            )
+        return response
+
+    @classmethod
+    def signed_request(
+        cls,
+        uri: str,
+        body: dict | None,
+        private_key: str,
+        key_id: str,
+        content_type: str = "application/activity+json",
+        method: Literal["get", "post"] = "post",
+        timeout: TimeoutTypes = settings.SETUP.REMOTE_TIMEOUT,
+    ):
+        """
+        Performs a request to the given path, with a document, signed
+        as an identity.
+        """
+        headers, body_bytes = cls.sign_request(
+            uri, body, private_key, key_id, content_type, method
+        )
+        with cls.request_errors(uri):
+            response = get_client().request(
+                method,
+                uri,
+                headers=headers,
+                content=body_bytes,
+                follow_redirects=method == "get",
+                timeout=timeout,
+            )
+        return cls.check_response(uri, method, response)
+
+    @classmethod
+    async def asigned_request(
+        cls,
+        uri: str,
+        body: dict | None,
+        private_key: str,
+        key_id: str,
+        content_type: str = "application/activity+json",
+        method: Literal["get", "post"] = "post",
+        timeout: TimeoutTypes = settings.SETUP.REMOTE_TIMEOUT,
+    ):
+        """
+        Performs an async request to the given path, with a document, signed
+        as an identity, using the running event loop's pooled client.
+        """
+        headers, body_bytes = cls.sign_request(
+            uri, body, private_key, key_id, content_type, method
+        )
+        with cls.request_errors(uri):
+            response = await get_async_client().request(
+                method,
+                uri,
+                headers=headers,
+                content=body_bytes,
+                follow_redirects=method == "get",
+                timeout=timeout,
+            )
+        return cls.check_response(uri, method, response)
 
 
 class HttpSignatureDetails(TypedDict):
@@ -292,7 +449,9 @@ class LDSignature:
     """
 
     @classmethod
-    def verify_signature(cls, document: dict, public_key: str) -> None:
+    def verify_signature(
+        cls, document: dict, public_key: str, key_id: str | None = None
+    ) -> None:
         """
         Verifies a document
         """
@@ -314,10 +473,7 @@ class LDSignature:
         # Get the normalised hash of each document
         final_hash = cls.normalized_hash(options) + cls.normalized_hash(document)
         # Verify the signature
-        public_key_instance: rsa.RSAPublicKey = cast(
-            rsa.RSAPublicKey,
-            serialization.load_pem_public_key(public_key.encode("ascii")),
-        )
+        public_key_instance = RsaKeys.load_public_key(public_key, key_id)
         try:
             public_key_instance.verify(
                 base64.b64decode(signature["signatureValue"]),
@@ -344,13 +500,7 @@ class LDSignature:
         # Get the normalised hash of each document
         final_hash = cls.normalized_hash(options) + cls.normalized_hash(document)
         # Create the signature
-        private_key_instance: rsa.RSAPrivateKey = cast(
-            rsa.RSAPrivateKey,
-            serialization.load_pem_private_key(
-                private_key.encode("ascii"),
-                password=None,
-            ),
-        )
+        private_key_instance = RsaKeys.load_private_key(private_key, key_id)
         signature = base64.b64encode(
             private_key_instance.sign(
                 final_hash,
@@ -5,6 +5,7 @@ from django.conf import settings
 from django.http import HttpResponse
 from django.shortcuts import redirect
 from django.utils.decorators import method_decorator
+from django.utils.functional import classproperty
 from django.utils.safestring import mark_safe
 from django.views.generic import TemplateView, View
 from django.views.static import serve
@@ -39,6 +40,41 @@ class About(TemplateView):
         }
 
 
+class AsyncCapableView(View):
+    """
+    A view with sync handlers (get, post...) and async versions of them
+    (aget, apost...). With TAKAHE_ASGI set the async ones are used, so
+    waiting on the database or other servers doesn't tie up a thread;
+    otherwise the sync ones are, so requests don't pay for an event loop.
+
+    dispatch() is only async in the former case, so decorators that care
+    (like cache_page) go on the handlers instead.
+    """
+
+    @classproperty
+    def view_is_async(cls):
+        return settings.ASGI
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.view_is_async:
+            return self.adispatch(request, *args, **kwargs)
+        return super().dispatch(request, *args, **kwargs)
+
+    async def adispatch(self, request, *args, **kwargs):
+        method = request.method.lower()
+        handler = None
+        if method in self.http_method_names:
+            handler = getattr(self, f"a{method}", None)
+            if method == "head" and handler is None:
+                handler = getattr(self, "aget", None)
+        if handler is None:
+            # Both return something to await on async views
+            if method == "options":
+                return await self.options(request, *args, **kwargs)
+            return await self.http_method_not_allowed(request, *args, **kwargs)
+        return await handler(request, *args, **kwargs)
+
+
 class StaticContentView(View):
     """
     A view that returns a bit of static content.
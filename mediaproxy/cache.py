@@ -0,0 +1,477 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections.abc import Iterator
+from email.utils import parsedate_to_datetime
+
+import httpx
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+
+from core.http import get_client
+
+CHUNK_SIZE = 64 * 1024
+
+# Used when the remote server doesn't say how long to keep something
+DEFAULT_CACHE_CONTROL = "public, max-age=3600"
+
+# The largest share of the cache one file may take; bigger ones are refused
+MAX_OBJECT_FRACTION = 0.1
+
+# How often followers (and the fetcher's own reader) check an in-progress
+# download for more data
+POLL_INTERVAL = 0.05
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class ProxyFetchError(Exception):
+    """
+    The remote server couldn't give us the file, and we have nothing cached
+    """
+
+
+def max_age(cache_control: str) -> int:
+    """
+    Returns how many seconds a response may be served without revalidating
+    """
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+    match = MAX_AGE_RE.search(cache_control)
+    if match:
+        return int(match.group(1))
+    return int(MAX_AGE_RE.search(DEFAULT_CACHE_CONTROL).group(1))  # type: ignore
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Returns the (start, end) inclusive byte offsets for a single-range Range
+    header, or None if it's not one we can serve. Raises ValueError if it's
+    out of bounds.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+class ProxyCache:
+    """
+    A size-capped on-disk LRU cache of remote media, shared by every process
+    pointed at the same directory.
+
+    Each URL is stored as a body file plus a JSON file of its headers. Only
+    one process fetches a given URL at a time: it claims a `.part` file and
+    downloads into it in a background thread, while it and anyone else who
+    asks for the same URL stream from that file as it grows. Finished
+    downloads are moved into place; the least recently served files are
+    deleted once the total goes over MEDIA_PROXY_CACHE_SIZE. Files bigger
+    than a tenth of that aren't proxied at all.
+    """
+
+    def __init__(self, root: str, max_size: int):
+        self.root = root
+        self.max_size = max_size
+        self.max_object_size = int(max_size * MAX_OBJECT_FRACTION)
+        self.lock = threading.Lock()
+        # Our running estimate of the total size, and when we last checked
+        self.total_size: int | None = None
+        self.scanned = 0.0
+
+    def paths(self, url: str) -> tuple[str, str]:
+        key = hashlib.sha256(url.encode("utf8")).hexdigest()
+        directory = os.path.join(self.root, key[:2])
+        return directory, os.path.join(directory, key)
+
+    def read_meta(self, path: str, url: str) -> dict | None:
+        try:
+            with open(path + ".json") as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url:
+            return None
+        return meta
+
+    def write_meta(self, path: str, meta: dict):
+        """
+        Writes a JSON headers file atomically
+        """
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, "w") as fh:
+            json.dump(meta, fh)
+        os.replace(temporary, path)
+
+    def fresh(self, meta: dict) -> bool:
+        return meta["expires"] > time.time()
+
+    def serve(self, request: HttpRequest, url: str) -> HttpResponse:
+        """
+        Returns a response for url, from the cache if we can
+        """
+        try:
+            meta, path, downloading = self.fetch(url)
+        except ProxyFetchError:
+            return HttpResponse(status=502)
+        if downloading:
+            # Stream it as it arrives (without ranges, as we can't seek yet)
+            response = StreamingHttpResponse(
+                self.follow(path), headers=self.headers(meta)
+            )
+            if meta.get("content_length") is not None:
+                response["Content-Length"] = meta["content_length"]
+            return response
+        try:
+            fh = open(path, "rb")
+        except OSError:
+            # Evicted between reading the headers and opening it
+            return HttpResponse(status=502)
+        size = os.fstat(fh.fileno()).st_size
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        response = StreamingHttpResponse(headers=self.headers(meta))
+        response["Accept-Ranges"] = "bytes"
+        last_modified = None
+        if meta.get("last_modified"):
+            try:
+                last_modified = parsedate_to_datetime(meta["last_modified"]).timestamp()
+            except (TypeError, ValueError):
+                pass
+        conditional = get_conditional_response(
+            request, etag=meta.get("etag"), last_modified=last_modified
+        )
+        if conditional is not None:
+            fh.close()
+            for header in ["ETag", "Last-Modified", "Cache-Control"]:
+                if header in response:
+                    conditional[header] = response[header]
+            return conditional
+        start, end = 0, size - 1
+        range_header = request.headers.get("Range")
+        if range_header and size:
+            try:
+                requested = parse_range(range_header, size)
+            except ValueError:
+                fh.close()
+                return HttpResponse(
+                    status=416, headers={"Content-Range": f"bytes */{size}"}
+                )
+            if requested:
+                start, end = requested
+                response.status_code = 206
+                response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = end - start + 1
+        response.streaming_content = self.read_file(fh, start, end - start + 1)
+        return response
+
+    def headers(self, meta: dict) -> dict[str, str]:
+        headers = {
+            "Content-Type": meta["content_type"],
+            "Cache-Control": meta["cache_control"],
+        }
+        if meta.get("etag"):
+            headers["ETag"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["Last-Modified"] = meta["last_modified"]
+        return headers
+
+    def read_file(self, fh, start: int, length: int) -> Iterator[bytes]:
+        with fh:
+            fh.seek(start)
+            while length > 0:
+                chunk = fh.read(min(CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+    def fetch(self, url: str) -> tuple[dict, str, bool]:
+        """
+        Returns (headers, path, downloading) for url, where path is either
+        the complete cached file or, if downloading, the part file it's
+        being written to.
+        """
+        directory, path = self.paths(url)
+        part = path + ".part"
+        deadline = time.monotonic() + self.fetch_timeout()
+        while True:
+            meta = self.read_meta(path, url)
+            if meta and self.fresh(meta):
+                return meta, path, False
+            os.makedirs(directory, exist_ok=True)
+            try:
+                fd = os.open(part, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                pass
+            else:
+                # It may have just been finished by someone else
+                meta = self.read_meta(path, url)
+                if meta and self.fresh(meta):
+                    os.close(fd)
+                    self.remove(part)
+                    return meta, path, False
+                return self.download(url, path, fd, meta)
+            # Someone else is fetching it; wait for their headers (or for
+            # them to give up, or to finish revalidating)
+            part_meta = self.read_meta(part, url)
+            if part_meta:
+                return part_meta, part, True
+            try:
+                claimed = os.stat(part).st_mtime
+            except FileNotFoundError:
+                continue
+            if time.time() - claimed > self.fetch_timeout():
+                # Whoever claimed it has died; take over
+                self.remove(part + ".json")
+                self.remove(part)
+                continue
+            if time.monotonic() > deadline:
+                if meta:
+                    return meta, path, False
+                raise ProxyFetchError(url)
+            time.sleep(POLL_INTERVAL)
+
+    def fetch_timeout(self) -> float:
+        timeout = settings.SETUP.REMOTE_TIMEOUT
+        if isinstance(timeout, tuple):
+            return sum(timeout)
+        return timeout * 4
+
+    def download(self, url: str, path: str, fd: int, stale: dict | None):
+        """
+        Requests url from its server, having claimed the part file. Returns
+        as soon as the headers are in, leaving a thread to fetch the body;
+        if that doesn't happen, for whatever reason, the claim is let go.
+        """
+        part = path + ".part"
+        headers = {}
+        if stale and stale.get("etag"):
+            headers["If-None-Match"] = stale["etag"]
+        if stale and stale.get("last_modified"):
+            headers["If-Modified-Since"] = stale["last_modified"]
+        client = get_client()
+        remote_response: httpx.Response | None = None
+        receiving = False
+        try:
+            try:
+                remote_response = client.send(
+                    client.build_request("GET", url, headers=headers),
+                    stream=True,
+                    follow_redirects=True,
+                )
+            except httpx.RequestError:
+                return self.abandon(url, path, stale)
+            cache_control = remote_response.headers.get(
+                "Cache-Control", DEFAULT_CACHE_CONTROL
+            )
+            if remote_response.status_code == 304 and stale:
+                stale["expires"] = time.time() + max_age(cache_control)
+                stale["cache_control"] = cache_control
+                self.write_meta(path + ".json", stale)
+                return stale, path, False
+            if remote_response.status_code >= 400 or remote_response.status_code == 304:
+                return self.abandon(url, path, stale)
+            meta = {
+                "url": url,
+                "content_type": remote_response.headers.get(
+                    "Content-Type", "application/octet-stream"
+                ),
+                "cache_control": cache_control,
+                "etag": remote_response.headers.get("ETag"),
+                "last_modified": remote_response.headers.get("Last-Modified"),
+                "content_length": None,
+                "expires": time.time() + max_age(cache_control),
+            }
+            content_length = remote_response.headers.get("Content-Length", "")
+            if content_length.isdigit():
+                if int(content_length) > self.max_object_size:
+                    return self.abandon(url, path, stale)
+                if "Content-Encoding" not in remote_response.headers:
+                    meta["content_length"] = content_length
+            self.write_meta(part + ".json", meta)
+            threading.Thread(
+                target=self.receive,
+                args=(remote_response, path, fd, meta),
+                daemon=True,
+            ).start()
+            receiving = True
+            return meta, part, True
+        finally:
+            if not receiving:
+                if remote_response is not None:
+                    remote_response.close()
+                os.close(fd)
+                self.remove(part)
+                self.remove(part + ".json")
+
+    def abandon(self, url: str, path: str, stale: dict | None):
+        """
+        Gives up a failed fetch, falling back to any stale copy
+        """
+        if stale:
+            return stale, path, False
+        raise ProxyFetchError(url)
+
+    def receive(self, remote_response: httpx.Response, path: str, fd: int, meta):
+        """
+        Writes the remote body into the part file, then moves it into place
+        """
+        part = path + ".part"
+        size = 0
+        received = False
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                for chunk in remote_response.iter_bytes(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_object_size:
+                        raise ProxyFetchError(f"Too large to cache: {meta['url']}")
+                    fh.write(chunk)
+                    fh.flush()
+            received = True
+        except (httpx.HTTPError, OSError, ProxyFetchError):
+            # Anyone following the download just gets a short body
+            pass
+        finally:
+            remote_response.close()
+            if not received:
+                # Followers stop once the headers file goes, so it goes last
+                self.remove(part)
+                self.remove(part + ".json")
+        if not received:
+            return
+        meta["size"] = size
+        # Put the body and then its headers in place before letting go of
+        # the part file, so nobody else starts fetching it in between
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        os.link(part, temporary)
+        os.replace(temporary, path)
+        self.write_meta(path + ".json", meta)
+        self.added(size)
+        # Readers stop following once this goes
+        self.remove(part + ".json")
+        self.remove(part)
+
+    def follow(self, part: str) -> Iterator[bytes]:
+        """
+        Streams a file that's still being downloaded, until it's done
+        """
+        try:
+            fh = open(part, "rb")
+        except FileNotFoundError:
+            try:
+                # Finished before we got here
+                fh = open(part.removesuffix(".part"), "rb")
+            except FileNotFoundError:
+                return
+        with fh:
+            stalled = time.monotonic()
+            while True:
+                chunk = fh.read(CHUNK_SIZE)
+                if chunk:
+                    stalled = time.monotonic()
+                    yield chunk
+                    continue
+                if not os.path.exists(part + ".json"):
+                    # Finished or abandoned; drain what's left
+                    yield from iter(lambda: fh.read(CHUNK_SIZE), b"")
+                    return
+                if time.monotonic() - stalled > self.fetch_timeout():
+                    return
+                time.sleep(POLL_INTERVAL)
+
+    def remove(self, path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def added(self, size: int):
+        """
+        Counts a newly cached file, and evicts old ones if we're over size
+        """
+        with self.lock:
+            if self.total_size is None or time.time() - self.scanned > 60:
+                self.total_size = self.scan_size()
+            else:
+                self.total_size += size
+            if self.total_size > self.max_size:
+                self.total_size = self.evict()
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        """
+        Returns (last used, size, path) for every complete cached file
+        """
+        entries = []
+        try:
+            directories = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return []
+        for directory in directories:
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if "." in entry.name:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def scan_size(self) -> int:
+        self.scanned = time.time()
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self) -> int:
+        """
+        Deletes the least recently used files until we're back to 90% of
+        the size limit, returning the new total
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_size * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            self.remove(path + ".json")
+            self.remove(path)
+            total -= size
+        self.scanned = time.time()
+        return total
+
+
+_cache: ProxyCache | None = None
+
+
+def get_cache() -> ProxyCache | None:
+    """
+    Returns the media proxy cache, or None if it's not configured
+    """
+    global _cache
+    root = settings.SETUP.MEDIA_PROXY_CACHE_DIR
+    if not root:
+        return None
+    max_size = settings.SETUP.MEDIA_PROXY_CACHE_SIZE
+    if _cache is None or _cache.root != root or _cache.max_size != max_size:
+        _cache = ProxyCache(root, max_size)
+    return _cache
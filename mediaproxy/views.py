@@ -1,18 +1,22 @@
+from collections.abc import Iterator
 from urllib.parse import urlparse
 
 import httpx
-from django.conf import settings
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.views.generic import View
 
 from activities.models import Emoji, PostAttachment
+from core.http import get_client
+from mediaproxy.cache import CHUNK_SIZE, DEFAULT_CACHE_CONTROL, get_cache
 from users.models import Identity
 
 
 class BaseProxyView(View):
     """
-    Base class for proxying remote content.
+    Base class for proxying remote content, through nginx if it's in front
+    of us, otherwise via the on-disk cache (or straight through if that's
+    not configured).
     """
 
     def get(self, request, **kwargs):
@@ -34,29 +38,46 @@ class BaseProxyView(View):
                     "Cache-Control": "public",
                 },
             )
-        else:
-            try:
-                remote_response = httpx.get(
-                    remote_url,
-                    headers={"User-Agent": settings.TAKAHE_USER_AGENT},
-                    follow_redirects=True,
-                    timeout=settings.SETUP.REMOTE_TIMEOUT,
-                )
-            except httpx.RequestError:
-                return HttpResponse(status=502)
-            if remote_response.status_code >= 400:
-                return HttpResponse(status=502)
-            return HttpResponse(
-                remote_response.content,
-                headers={
-                    "Content-Type": remote_response.headers.get(
-                        "Content-Type", "application/octet-stream"
-                    ),
-                    "Cache-Control": remote_response.headers.get(
-                        "Cache-Control", "public, max-age=3600"
-                    ),
-                },
+        cache = get_cache()
+        if cache is not None:
+            return cache.serve(request, remote_url)
+        # No cache; stream it straight through
+        client = get_client()
+        try:
+            remote_response = client.send(
+                client.build_request("GET", remote_url),
+                stream=True,
+                follow_redirects=True,
             )
+        except httpx.RequestError:
+            return HttpResponse(status=502)
+        if remote_response.status_code >= 400:
+            remote_response.close()
+            return HttpResponse(status=502)
+        response = StreamingHttpResponse(
+            self.stream(remote_response),
+            headers={
+                "Content-Type": remote_response.headers.get(
+                    "Content-Type", "application/octet-stream"
+                ),
+                "Cache-Control": remote_response.headers.get(
+                    "Cache-Control", DEFAULT_CACHE_CONTROL
+                ),
+            },
+        )
+        for header in ["ETag", "Last-Modified"]:
+            if header in remote_response.headers:
+                response[header] = remote_response.headers[header]
+        return response
+
+    def stream(self, remote_response: httpx.Response) -> Iterator[bytes]:
+        try:
+            yield from remote_response.iter_bytes(CHUNK_SIZE)
+        except httpx.HTTPError:
+            # Too late to change the status; the client sees a short body
+            pass
+        finally:
+            remote_response.close()
 
     def get_remote_url(self) -> str:
         raise NotImplementedError()
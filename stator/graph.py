@@ -1,4 +1,4 @@
-from collections.abc import Callable
+from collections.abc import Awaitable, Callable
 from typing import Any, ClassVar
 
 
@@ -159,3 +159,11 @@ class State:
         if self.handler_name is None:
             raise AttributeError("No handler defined")
         return getattr(self.graph, self.handler_name)
+
+    @property
+    def async_handler(self) -> Callable[[Any], Awaitable[str | None]] | None:
+        # An optional coroutine version of the handler, called a<handler_name>,
+        # which the asyncio runner uses in its place
+        if self.handler_name is None:
+            return None
+        return getattr(self.graph, f"a{self.handler_name}", None)
@@ -6,7 +6,7 @@ from django.core.management.base import BaseCommand
 
 from core.models import Config
 from stator.models import StatorModel
-from stator.runner import StatorRunner
+from stator.runner import AsyncStatorRunner, StatorRunner
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +19,19 @@ class Command(BaseCommand):
             "--concurrency",
             "-c",
             type=int,
-            default=15,
-            help="How many tasks to run at once",
+            default=None,
+            help="How many tasks to run at once (default 15, or 200 with --asyncio)",
+        )
+        parser.add_argument(
+            "--asyncio",
+            action="store_true",
+            help="Run tasks on a single asyncio event loop rather than in threads",
+        )
+        parser.add_argument(
+            "--db-pool-size",
+            type=int,
+            default=None,
+            help="How many database connections to use in asyncio mode",
         )
         parser.add_argument(
             "--liveness-file",
@@ -54,7 +65,9 @@ class Command(BaseCommand):
     def handle(
         self,
         model_labels: list[str],
-        concurrency: int,
+        concurrency: int | None,
+        asyncio: bool,
+        db_pool_size: int | None,
         liveness_file: str,
         schedule_interval: int,
         run_for: int,
@@ -86,13 +99,25 @@ class Command(BaseCommand):
             "Running for models: " + " ".join(m._meta.label_lower for m in models)
         )
         # Run a runner
-        runner = StatorRunner(
-            models,
-            concurrency=concurrency,
-            liveness_file=liveness_file,
-            schedule_interval=schedule_interval,
-            run_for=run_for,
-        )
+        runner: StatorRunner
+        if asyncio:
+            runner = AsyncStatorRunner(
+                models,
+                concurrency=concurrency or 200,
+                liveness_file=liveness_file,
+                schedule_interval=schedule_interval,
+                run_for=run_for,
+            )
+            if db_pool_size:
+                runner.db_pool_size = db_pool_size
+        else:
+            runner = StatorRunner(
+                models,
+                concurrency=concurrency or 15,
+                liveness_file=liveness_file,
+                schedule_interval=schedule_interval,
+                run_for=run_for,
+            )
         try:
             runner.run()
         except KeyboardInterrupt:
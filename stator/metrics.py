@@ -0,0 +1,198 @@
+import threading
+
+from django.conf import settings
+
+from stator.models import StatorMetric, StatorModel, Stats
+
+# Prometheus metric name, type and help for each StatorMetric name
+HISTOGRAMS = {
+    "duration": (
+        "stator_handler_duration_seconds",
+        "How long Stator transition attempts took to run",
+    ),
+    "wait": (
+        "stator_queue_wait_seconds",
+        "How long Stator tasks waited after becoming due before being picked up",
+    ),
+}
+OUTCOMES = ["success", "retry", "timeout"]
+# Prometheus metric name and help for the per-process counters (of the
+# outbound HTTP pool and the parsed key cache) that runners store as
+# StatorMetrics, by their label and name
+PROCESS_COUNTERS = {
+    ("core.http", "requests"): (
+        "stator_http_requests_total",
+        "Outbound HTTP requests made by Stator runners",
+    ),
+    ("core.http", "misses"): (
+        "stator_http_connections_opened_total",
+        "Outbound HTTP requests that opened a new connection instead of reusing one",
+    ),
+    ("core.http", "host_waits"): (
+        "stator_http_host_waits_total",
+        "Outbound HTTP requests that had to wait for a free slot to their host",
+    ),
+    ("core.signatures", "hits"): (
+        "stator_key_cache_hits_total",
+        "RSA key loads by Stator runners that reused an already-parsed key",
+    ),
+    ("core.signatures", "misses"): (
+        "stator_key_cache_misses_total",
+        "RSA key loads by Stator runners that had to parse the key",
+    ),
+}
+
+
+def bucket_for(value: float) -> str:
+    """
+    Returns the histogram bucket (its upper bound, as a string) a value
+    falls into
+    """
+    for bound in settings.SETUP.STATOR_METRICS_BUCKETS:
+        if value <= bound:
+            return str(float(bound))
+    return "+Inf"
+
+
+class MetricsCollector:
+    """
+    Gathers transition outcomes and timings in memory, from any runner
+    thread, until the next scheduling run adds them to StatorMetric.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: dict[str, dict[tuple[str, str], list]] = {}
+
+    def sample(self, model_label: str, state: str, name: str) -> list:
+        return self.samples.setdefault(model_label, {}).setdefault(
+            (state, name), [0, 0.0, {}]
+        )
+
+    def count(self, model_label: str, state: str, name: str):
+        """
+        Adds one to a counter
+        """
+        with self.lock:
+            self.sample(model_label, state, name)[0] += 1
+
+    def observe(self, model_label: str, state: str, name: str, value: float):
+        """
+        Adds a value to a histogram
+        """
+        bucket = bucket_for(value)
+        with self.lock:
+            sample = self.sample(model_label, state, name)
+            sample[0] += 1
+            sample[1] += value
+            sample[2][bucket] = sample[2].get(bucket, 0) + 1
+
+    def add_counts(self, label: str, state: str, counts: dict[str, int]):
+        """
+        Adds to several counters at once
+        """
+        with self.lock:
+            for name, number in counts.items():
+                if number:
+                    self.sample(label, state, name)[0] += number
+
+    def record_transition(self, instance: StatorModel, duration: float):
+        """
+        Records how a transition attempt went, and how long it took
+        """
+        label = instance._meta.label_lower
+        self.observe(label, instance.state, "duration", duration)
+        if instance.state_outcome:
+            self.count(label, instance.state, instance.state_outcome)
+        if instance.state_errored:
+            self.count(label, instance.state, "error")
+
+    def pop(self, model_label: str) -> dict[tuple[str, str], list]:
+        """
+        Removes and returns everything gathered for a model so far
+        """
+        with self.lock:
+            return self.samples.pop(model_label, {})
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheus_text() -> str:
+    """
+    Renders the stored Stator metrics, plus each model's queue depth and the
+    runners' HTTP pool and key cache counts, in the Prometheus text
+    exposition format.
+    """
+    metrics = list(StatorMetric.objects.order_by("model_label", "state", "name"))
+    bounds = [float(bound) for bound in settings.SETUP.STATOR_METRICS_BUCKETS]
+    lines = [
+        "# HELP stator_transitions_total Stator transition attempts, by outcome",
+        "# TYPE stator_transitions_total counter",
+    ]
+    for metric in metrics:
+        if metric.name in OUTCOMES:
+            lines.append(
+                f'stator_transitions_total{{model="{escape(metric.model_label)}",'
+                f'state="{escape(metric.state)}",outcome="{metric.name}"}} '
+                f"{metric.count}"
+            )
+    lines += [
+        "# HELP stator_errors_total Stator handlers that raised an exception",
+        "# TYPE stator_errors_total counter",
+    ]
+    for metric in metrics:
+        if metric.name == "error":
+            lines.append(
+                f'stator_errors_total{{model="{escape(metric.model_label)}",'
+                f'state="{escape(metric.state)}"}} {metric.count}'
+            )
+    for name, (metric_name, help_text) in HISTOGRAMS.items():
+        lines += [
+            f"# HELP {metric_name} {help_text}",
+            f"# TYPE {metric_name} histogram",
+        ]
+        for metric in metrics:
+            if metric.name != name:
+                continue
+            labels = (
+                f'model="{escape(metric.model_label)}",state="{escape(metric.state)}"'
+            )
+            # Stored buckets are counted under the first configured bound
+            # at or above them, in case the bounds have changed since
+            for bound in bounds:
+                cumulative = sum(
+                    number
+                    for stored, number in metric.buckets.items()
+                    if float(stored) <= bound
+                )
+                lines.append(
+                    f'{metric_name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+                )
+            lines += [
+                f'{metric_name}_bucket{{{labels},le="+Inf"}} {metric.count}',
+                f"{metric_name}_sum{{{labels}}} {metric.total}",
+                f"{metric_name}_count{{{labels}}} {metric.count}",
+            ]
+    lines += [
+        "# HELP stator_queue_depth Stator tasks waiting to run (estimated when large)",
+        "# TYPE stator_queue_depth gauge",
+    ]
+    stats = {stats.model_label: stats for stats in Stats.objects.all()}
+    for model in StatorModel.subclasses:
+        label = model._meta.label_lower
+        if label in stats:
+            stats[label].statistics.setdefault("queued", {})
+            lines.append(
+                f'stator_queue_depth{{model="{escape(label)}"}} '
+                f"{stats[label].most_recent_queued()}"
+            )
+    counts = {(metric.model_label, metric.name): metric.count for metric in metrics}
+    for key, (metric_name, help_text) in PROCESS_COUNTERS.items():
+        lines += [
+            f"# HELP {metric_name} {help_text}",
+            f"# TYPE {metric_name} counter",
+            f"{metric_name} {counts.get(key, 0)}",
+        ]
+    return "\n".join(lines) + "\n"
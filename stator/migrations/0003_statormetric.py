@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("stator", "0002_stats_delete_statorerror"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StatorMetric",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("model_label", models.CharField(max_length=200)),
+                ("state", models.CharField(max_length=100)),
+                ("name", models.CharField(max_length=50)),
+                ("count", models.BigIntegerField(default=0)),
+                ("total", models.FloatField(default=0)),
+                ("buckets", models.JSONField(default=dict)),
+                ("updated", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="statormetric",
+            constraint=models.UniqueConstraint(
+                fields=("model_label", "state", "name"), name="unique_stator_metric"
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stator", "0003_statormetric"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stats",
+            name="reconciled",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
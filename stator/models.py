@@ -1,9 +1,16 @@
+import asyncio
 import datetime
+import json
 import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
 from typing import ClassVar
 
-from asgiref.sync import async_to_sync, iscoroutinefunction
-from django.db import models, transaction
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db import connection, connections, models, transaction
 from django.db.models.signals import class_prepared
 from django.utils import timezone
 from django.utils.functional import classproperty
@@ -13,6 +20,23 @@ from stator.graph import State, StateGraph
 
 logger = logging.getLogger(__name__)
 
+# The asyncio runner's pool of database threads, for the task that's running
+db_executor: ContextVar[ThreadPoolExecutor | None] = ContextVar(
+    "db_executor", default=None
+)
+
+
+async def in_db_pool(func, *args, **kwargs):
+    """
+    Runs a synchronous (database-using) function from a coroutine handler.
+    Under the asyncio runner this is its bounded pool of database threads;
+    otherwise it's Django's usual sync thread.
+    """
+    executor = db_executor.get()
+    return await sync_to_async(
+        func, thread_sensitive=executor is None, executor=executor
+    )(*args, **kwargs)
+
 
 class StateField(models.CharField):
     """
@@ -81,6 +105,10 @@ class StatorModel(models.Model):
     CLEAN_BATCH_SIZE = 1000
     DELETE_BATCH_SIZE = 500
 
+    # How far behind now the reconcile watermark is kept, so changes stamped
+    # just before a run but committed after it are looked at by the next one
+    RECONCILE_GRACE = datetime.timedelta(minutes=5)
+
     state: StateField
 
     # When the state last actually changed, or the date of instance creation
@@ -96,6 +124,18 @@ class StatorModel(models.Model):
     # Collection of subclasses of us
     subclasses: ClassVar[list[type["StatorModel"]]] = []
 
+    # Optional priority lanes, as (name, filter) pairs in the order they
+    # should be picked up. Together they should cover every row.
+    state_lanes: ClassVar[list[tuple[str, models.Q]]] = []
+
+    # Which lane a locked instance was picked up from
+    state_lane = "default"
+
+    # How the last transition attempt went ("success", "retry" or "timeout"),
+    # and whether its handler raised an exception
+    state_outcome: str | None = None
+    state_errored = False
+
     class Meta:
         abstract = True
 
@@ -117,25 +157,88 @@ class StatorModel(models.Model):
     ) -> list["StatorModel"]:
         """
         Returns up to `number` tasks for execution, having locked them.
+        If the model has lanes, earlier lanes are drained first.
         """
-        with transaction.atomic():
-            # Query for `number` rows that:
-            #  - Have a next_attempt that's either null or in the past
-            #  - Have one of the states we care about
-            # Then, sort them by next_attempt NULLS FIRST, so that we handle the
-            # rows in a roughly FIFO order.
-            selected = list(
-                cls.objects.filter(
-                    models.Q(state_next_attempt__isnull=True)
-                    | models.Q(state_next_attempt__lte=timezone.now()),
-                    state__in=cls.state_graph.automatic_states,
-                    state_locked_until__isnull=True,
-                )[:number].select_for_update()
-            )
-            cls.objects.filter(pk__in=[i.pk for i in selected]).update(
-                state_locked_until=lock_expiry
-            )
-        return selected
+        claim = cls.transition_claim_sql(number, lock_expiry)
+        if number <= 0 or claim is None:
+            return []
+        return list(cls.objects.raw(*claim))
+
+    @classmethod
+    def transition_claim_filter(cls) -> models.Q:
+        """
+        Returns an extra filter for rows that are due but shouldn't be picked
+        up right now. Override to hold work back.
+        """
+        return models.Q()
+
+    def transition_retry_interval(self, state: State) -> float:
+        """
+        Returns how many seconds to wait before retrying this instance in
+        `state` after its handler made no progress.
+        """
+        return state.try_interval  # type: ignore
+
+    @classmethod
+    def transition_claim_sql(
+        cls, number: int, lock_expiry: datetime.datetime
+    ) -> tuple[str, list] | None:
+        """
+        Builds the single statement that picks and locks rows for
+        transition_get_with_lock.
+
+        Each lane is split into rows that have never been tried (taken first,
+        for rough FIFO order) and rows whose retry is due, rather than one OR
+        on state_next_attempt, so every part can use the state index. Rows
+        another runner is claiming at the same moment are skipped rather than
+        waited on, and the lock is set with UPDATE ... RETURNING so there's
+        only one round trip. Returns None if nothing could match.
+        """
+        connection = connections[cls.objects.db]
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        pk = qn(cls._meta.pk.column)
+        ready = cls.objects.filter(
+            cls.transition_claim_filter(),
+            state__in=cls.state_graph.automatic_states,
+            state_locked_until__isnull=True,
+        )
+        parts = [
+            models.Q(state_next_attempt__isnull=True),
+            models.Q(state_next_attempt__lte=timezone.now()),
+        ]
+        ctes: list[str] = []
+        selects: list[str] = []
+        params: list = []
+        lane_params: list = []
+        for lane, lane_filter in cls.state_lanes or [("default", models.Q())]:
+            for part in parts:
+                name = f"claim_{len(ctes)}"
+                try:
+                    part_sql, part_params = (
+                        ready.filter(lane_filter, part)
+                        .values("pk")[:number]
+                        .query.sql_with_params()
+                    )
+                except EmptyResultSet:
+                    continue
+                # Lane filters may span relations; only lock our own rows
+                ctes.append(f"{name} AS ({part_sql} FOR UPDATE OF {table} SKIP LOCKED)")
+                params.extend(part_params)
+                selects.append(f"SELECT {pk}, %s AS state_lane FROM {name}")
+                lane_params.append(lane)
+        if not ctes:
+            return None
+        # UNION ALL reads its parts in order and stops at the limit, so later
+        # parts are only locked if earlier ones run dry
+        sql = (
+            f"WITH {', '.join(ctes)}, "
+            f"claimed AS ({' UNION ALL '.join(selects)} LIMIT %s) "
+            f"UPDATE {table} SET {qn('state_locked_until')} = %s "
+            f"FROM claimed WHERE {table}.{pk} = claimed.{pk} "
+            f"RETURNING {table}.*, claimed.state_lane"
+        )
+        return sql, params + lane_params + [number, lock_expiry]
 
     @classmethod
     def transition_delete_due(cls) -> int | None:
@@ -163,14 +266,67 @@ class StatorModel(models.Model):
     @classmethod
     def transition_ready_count(cls) -> int:
         """
-        Returns how many instances are "queued"
+        Returns roughly how many instances are "queued": an exact count up to
+        STATOR_QUEUE_COUNT_LIMIT, and the query planner's estimate past that,
+        so a big backlog doesn't mean a big COUNT(*) on every scheduling run.
         """
-        return cls.objects.filter(
+        ready = cls.objects.filter(
             models.Q(state_next_attempt__isnull=True)
             | models.Q(state_next_attempt__lte=timezone.now()),
             state_locked_until__isnull=True,
             state__in=cls.state_graph.automatic_states,
-        ).count()
+        )
+        limit = settings.SETUP.STATOR_QUEUE_COUNT_LIMIT
+        count = ready[:limit].count()
+        if count < limit:
+            return count
+        plan = json.loads(ready.explain(format="json"))
+        return max(count, int(plan[0]["Plan"]["Plan Rows"]))
+
+    @classmethod
+    def transition_reconcile(
+        cls, since: datetime.datetime, until: datetime.datetime
+    ) -> datetime.datetime | None:
+        """
+        For models that need to periodically correct derived data: handles
+        the earliest batch of changes after `since` (and up to `until`),
+        returning the time it got up to, or None if there were none left.
+        """
+        return None
+
+    @classmethod
+    def transition_run_reconcile(cls):
+        """
+        Runs transition_reconcile in batches from wherever the last run got
+        to, until it's caught up. Only one runner reconciles each model at
+        once (others skip it), and the point reached is saved in its Stats
+        after every batch, so nothing is skipped if a run stops part way.
+        The saved point never gets closer to now than RECONCILE_GRACE, as
+        rows can commit a little after the time they were stamped with.
+        """
+        label = cls._meta.label_lower
+        lock_key = zlib.crc32(f"stator.reconcile:{label}".encode())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [lock_key])
+            if not cursor.fetchone()[0]:
+                return
+        try:
+            until = timezone.now()
+            settled = until - cls.RECONCILE_GRACE
+            stats, _ = Stats.objects.get_or_create(
+                model_label=label, defaults={"statistics": {}}
+            )
+            since = stats.reconciled or settled
+            while since < until:
+                reached = cls.transition_reconcile(since, until)
+                if reached is None:
+                    break
+                since = reached
+                Stats.objects.filter(pk=label).update(reconciled=min(since, settled))
+            Stats.objects.filter(pk=label).update(reconciled=settled)
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [lock_key])
 
     @classmethod
     def transition_clean_locks(cls):
@@ -203,21 +359,70 @@ class StatorModel(models.Model):
             else:
                 next_state = current_state.handler(self)
         except TryAgainLater:
-            pass
+            next_state = None
         except BaseException as e:
             logger.exception(e)
-        else:
-            if next_state:
-                # Ensure it's a State object
-                if isinstance(next_state, str):
-                    next_state = self.state_graph.states[next_state]
-                # Ensure it's a child
-                if next_state not in current_state.children:
-                    raise ValueError(
-                        f"Cannot transition from {current_state} to {next_state} - not a declared transition"
-                    )
-                self.transition_perform(next_state)
-                return next_state
+            self.state_errored = True
+            next_state = None
+        return self.transition_resolve(current_state, next_state)
+
+    async def atransition_attempt(
+        self, executor: ThreadPoolExecutor | None = None
+    ) -> State | None:
+        """
+        Async version of transition_attempt, used by the asyncio runner.
+
+        A state's async handler (or a coroutine handler) is awaited on the
+        event loop, and does its database work through in_db_pool; plain
+        synchronous handlers and the final state update run in `executor`,
+        which is what bounds the number of database connections in use.
+        """
+        current_state: State = self.state_graph.states[self.state]
+
+        if current_state.externally_progressed:
+            logger.warning(
+                f"Warning: trying to progress externally progressed state {self.state}!"
+            )
+            return None
+
+        # Tasks each run in their own context, so this is just for this one
+        db_executor.set(executor)
+        try:
+            if current_state.async_handler is not None:
+                next_state = await current_state.async_handler(self)
+            elif iscoroutinefunction(current_state.handler):
+                next_state = await current_state.handler(self)
+            else:
+                next_state = await in_db_pool(current_state.handler, self)
+        except TryAgainLater:
+            next_state = None
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            logger.exception(e)
+            self.state_errored = True
+            next_state = None
+        return await in_db_pool(self.transition_resolve, current_state, next_state)
+
+    def transition_resolve(
+        self, current_state: State, next_state: State | None
+    ) -> State | None:
+        """
+        Applies the result of a handler run: moves to the new state if there
+        is one, handles timeouts, and otherwise reschedules and unlocks.
+        """
+        if next_state:
+            # Ensure it's a State object
+            if isinstance(next_state, str):
+                next_state = self.state_graph.states[next_state]
+            # Ensure it's a child
+            if next_state not in current_state.children:
+                raise ValueError(
+                    f"Cannot transition from {current_state} to {next_state} - not a declared transition"
+                )
+            self.transition_perform(next_state)
+            self.state_outcome = "success"
+            return next_state
 
         # See if it timed out since its last state change
         if (
@@ -226,15 +431,20 @@ class StatorModel(models.Model):
             <= (timezone.now() - self.state_changed).total_seconds()
         ):
             self.transition_perform(current_state.timeout_state)  # type: ignore
+            self.state_outcome = "timeout"
             return current_state.timeout_state
 
         # Nothing happened, set next execution and unlock it
         self.__class__.objects.filter(pk=self.pk).update(
             state_next_attempt=(
-                timezone.now() + datetime.timedelta(seconds=current_state.try_interval)  # type: ignore
+                timezone.now()
+                + datetime.timedelta(
+                    seconds=self.transition_retry_interval(current_state)
+                )
             ),
             state_locked_until=None,
         )
+        self.state_outcome = "retry"
         return None
 
     def transition_perform(self, state: State | str):
@@ -289,6 +499,9 @@ class Stats(models.Model):
 
     statistics = models.JSONField()
 
+    # How far transition_reconcile has got, for whichever runner does it next
+    reconciled = models.DateTimeField(null=True, blank=True)
+
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
@@ -303,7 +516,7 @@ class Stats(models.Model):
         if not instance.statistics:
             instance.statistics = {}
         # Ensure there are the right keys
-        for key in ["queued", "hourly", "daily", "monthly"]:
+        for key in ["queued", "hourly", "daily", "monthly", "latency"]:
             if key not in instance.statistics:
                 instance.statistics[key] = {}
         return instance
@@ -340,6 +553,22 @@ class Stats(models.Model):
             self.statistics["monthly"].get(month_timestamp, 0) + number
         )
 
+    def add_latency(self, lane: str, count: int, total: float, maximum: float):
+        """
+        Adds queue latency samples (seconds from when an instance became due
+        to when it was picked up) for a lane to the current hour.
+        """
+        hour_timestamp = str(
+            int(timezone.now().replace(minute=0, second=0, microsecond=0).timestamp())
+        )
+        lane_data = self.statistics["latency"].setdefault(lane, {})
+        current = lane_data.get(hour_timestamp, [0, 0.0, 0.0])
+        lane_data[hour_timestamp] = [
+            current[0] + count,
+            current[1] + total,
+            max(current[2], maximum),
+        ]
+
     def trim_data(self):
         """
         Removes excessively old data from the field
@@ -372,6 +601,10 @@ class Stats(models.Model):
             for ts, v in self.statistics["monthly"].items()
             if int(ts) >= monthly_horizon
         }
+        self.statistics["latency"] = {
+            lane: {ts: v for ts, v in values.items() if int(ts) >= hourly_horizon}
+            for lane, values in self.statistics["latency"].items()
+        }
 
     def most_recent_queued(self) -> int:
         """
@@ -398,3 +631,83 @@ class Stats(models.Model):
             self.statistics["daily"].get(day_timestamp, 0),
             self.statistics["monthly"].get(month_timestamp, 0),
         )
+
+    def most_recent_latency(self) -> dict[str, tuple[float, float]]:
+        """
+        Returns the average and maximum queue latency for each lane over
+        the current hour
+        """
+        hour_timestamp = str(
+            int(timezone.now().replace(minute=0, second=0, microsecond=0).timestamp())
+        )
+        result = {}
+        for lane, values in sorted(self.statistics["latency"].items()):
+            if hour_timestamp in values:
+                count, total, maximum = values[hour_timestamp]
+                result[lane] = (total / count if count else 0.0, maximum)
+        return result
+
+
+class StatorMetric(models.Model):
+    """
+    Running totals of how Stator's transitions went for each model and state,
+    which /metrics exports as Prometheus counters and histograms.
+    """
+
+    # appname.modelname (lowercased) label for the model this represents
+    model_label = models.CharField(max_length=200)
+
+    state = models.CharField(max_length=100)
+
+    # Counters: "success", "retry", "timeout" and "error"
+    # Histograms (in seconds): "duration" and "wait"
+    name = models.CharField(max_length=50)
+
+    count = models.BigIntegerField(default=0)
+
+    # Sum of all observed values, for histograms
+    total = models.FloatField(default=0)
+
+    # Histogram observations per bucket upper bound (not cumulative)
+    buckets = models.JSONField(default=dict)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["model_label", "state", "name"],
+                name="unique_stator_metric",
+            )
+        ]
+
+    @classmethod
+    def add_samples(cls, model_label: str, samples: dict[tuple[str, str], list]):
+        """
+        Adds samples from a runner, as {(state, name): [count, total, buckets]},
+        to the running totals for a model.
+        """
+        if not samples:
+            return
+        with transaction.atomic():
+            cls.objects.bulk_create(
+                [
+                    cls(model_label=model_label, state=state, name=name)
+                    for state, name in samples
+                ],
+                ignore_conflicts=True,
+            )
+            for metric in (
+                cls.objects.select_for_update()
+                .filter(model_label=model_label)
+                .order_by("pk")
+            ):
+                sample = samples.get((metric.state, metric.name))
+                if sample is None:
+                    continue
+                count, total, buckets = sample
+                metric.count += count
+                metric.total += total
+                for bound, number in buckets.items():
+                    metric.buckets[bound] = metric.buckets.get(bound, 0) + number
+                metric.save()
@@ -1,18 +1,25 @@
+import asyncio
 import datetime
 import logging
 import os
 import signal
+import threading
 import time
 import uuid
+from concurrent import futures
 from concurrent.futures import Future, ThreadPoolExecutor
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db import close_old_connections
+from django.db import close_old_connections, connections
 from django.utils import timezone
 
 from core import sentry
+from core.http import close_async_client, pool_stats
 from core.models import Config
-from stator.models import StatorModel, Stats
+from core.signatures import RsaKeys
+from stator.metrics import MetricsCollector
+from stator.models import StatorMetric, StatorModel, Stats
 
 logger = logging.getLogger(__name__)
 
@@ -59,8 +66,11 @@ class StatorRunner:
         liveness_file: str | None = None,
         schedule_interval: int = 60,
         delete_interval: int = 30,
+        reconcile_interval: int | None = None,
         lock_expiry: int = 300,
         run_for: int = 0,
+        model_weights: dict[str, int] | None = None,
+        model_min_slots: dict[str, int] | None = None,
     ):
         self.models = models
         self.runner_id = uuid.uuid4().hex
@@ -69,11 +79,33 @@ class StatorRunner:
         self.liveness_file = liveness_file
         self.schedule_interval = schedule_interval
         self.delete_interval = delete_interval
+        self.reconcile_interval = (
+            settings.SETUP.STATOR_RECONCILE_INTERVAL
+            if reconcile_interval is None
+            else reconcile_interval
+        )
         self.lock_expiry = lock_expiry
         self.run_for = run_for
         self.minimum_loop_delay = 0.5
         self.maximum_loop_delay = 5
         self.tasks: dict[tuple[str, str], Future] = {}
+        self.model_weights = (
+            settings.SETUP.STATOR_MODEL_WEIGHTS
+            if model_weights is None
+            else model_weights
+        )
+        self.model_min_slots = (
+            settings.SETUP.STATOR_MODEL_MIN_SLOTS
+            if model_min_slots is None
+            else model_min_slots
+        )
+        # Weighted round-robin credit per model, kept between loops so that
+        # shares even out even when only a slot or two frees up at a time
+        self.slot_credits: dict[str, int] = {}
+        # Queue latency per model and lane, as [count, total, max] seconds
+        self.latencies: dict[str, dict[str, list]] = {}
+        # Per-state outcomes and timings, written out on each scheduling run
+        self.metrics = MetricsCollector()
         # Set up SIGALRM handler
         signal.signal(signal.SIGALRM, self.alarm_handler)
 
@@ -81,10 +113,12 @@ class StatorRunner:
         sentry.set_takahe_app("stator")
         self.handled = {}
         self.started = time.monotonic()
+        self.last_scheduled = self.started
         self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
         self.loop_delay = self.minimum_loop_delay
         self.scheduling_timer = LoopingTimer(self.schedule_interval)
         self.deletion_timer = LoopingTimer(self.delete_interval)
+        self.reconcile_timer = LoopingTimer(self.reconcile_interval)
         # For the first time period, launch tasks
         logger.info("Running main task loop")
         try:
@@ -102,6 +136,8 @@ class StatorRunner:
                         self.load_config()
                         # Do scheduling (stale lock deletion and stats gathering)
                         self.run_scheduling()
+                        if self.reconcile_interval and self.reconcile_timer.check():
+                            self.run_reconcile()
 
                     # Clear the cleaning breadcrumbs/extra for the main part of the loop
                     sentry.scope_clear(scope)
@@ -161,9 +197,11 @@ class StatorRunner:
 
     def run_scheduling(self):
         """
-        Deletes stale locks for models, and submits their stats.
+        Deletes stale locks for models and submits their (and the process's)
+        stats
         """
         with sentry.start_transaction(op="task", name="stator.run_scheduling"):
+            self.log_throughput()
             for model in self.models:
                 with sentry.start_span(description=model._meta.label_lower):
                     num = self.handled.get(model._meta.label_lower, 0)
@@ -173,6 +211,40 @@ class StatorRunner:
                         )
                     self.submit_stats(model)
                     model.transition_clean_locks()
+            self.submit_process_stats()
+
+    def run_reconcile(self):
+        """
+        Lets models reconcile anything that's changed since they last did.
+        """
+        with sentry.start_transaction(op="task", name="stator.run_reconcile"):
+            for model in self.models:
+                with sentry.start_span(description=model._meta.label_lower):
+                    model.transition_run_reconcile()
+
+    def log_throughput(self):
+        """
+        Logs how many tasks per second we have started since the last
+        scheduling run, so the different runner modes can be compared.
+        """
+        now = time.monotonic()
+        elapsed = now - getattr(self, "last_scheduled", self.started)
+        self.last_scheduled = now
+        total = sum(self.handled.values())
+        if elapsed > 0 and (total or settings.DEBUG):
+            logger.info(
+                f"Throughput: {total} handled in {elapsed:.1f}s ({total / elapsed:.2f} tasks/s)"
+            )
+
+    def submit_process_stats(self):
+        """
+        Adds this process's outbound HTTP connection pool and parsed key
+        cache counts to the running totals in the database
+        """
+        self.metrics.add_counts("core.http", "pool", pool_stats.take())
+        self.metrics.add_counts("core.signatures", "keys", RsaKeys.cache.take())
+        for label in ["core.http", "core.signatures"]:
+            StatorMetric.add_samples(label, self.metrics.pop(label))
 
     def submit_stats(self, model: type[StatorModel]):
         """
@@ -182,9 +254,80 @@ class StatorRunner:
         if stats_instance.model_label in self.handled:
             stats_instance.add_handled(self.handled[stats_instance.model_label])
             del self.handled[stats_instance.model_label]
+        for lane, (count, total, maximum) in self.latencies.pop(
+            stats_instance.model_label, {}
+        ).items():
+            stats_instance.add_latency(lane, count, total, maximum)
         stats_instance.set_queued(model.transition_ready_count())
         stats_instance.trim_data()
         stats_instance.save()
+        StatorMetric.add_samples(
+            stats_instance.model_label, self.metrics.pop(stats_instance.model_label)
+        )
+
+    def allocate_slots(
+        self,
+        space: int,
+        capacity: dict[str, int],
+        running: dict[str, int] | None = None,
+    ) -> dict[str, int]:
+        """
+        Shares `space` task slots out between the models in `capacity`, giving
+        each no more than its capacity. If `running` is passed, each model is
+        first topped up to its minimum slots; the rest are handed out one at a
+        time by smooth weighted round-robin.
+        """
+        slots = {label: 0 for label in capacity}
+        if running is not None:
+            for label, limit in capacity.items():
+                wanted = self.model_min_slots.get(label, 0) - running.get(label, 0)
+                given = max(min(wanted, limit, space), 0)
+                slots[label] += given
+                space -= given
+        while space > 0:
+            weights = {
+                label: self.model_weights.get(label, 1)
+                for label, limit in capacity.items()
+                if slots[label] < limit and self.model_weights.get(label, 1) > 0
+            }
+            if not weights:
+                break
+            for label, weight in weights.items():
+                self.slot_credits[label] = self.slot_credits.get(label, 0) + weight
+            chosen = max(weights, key=lambda label: self.slot_credits[label])
+            self.slot_credits[chosen] -= sum(weights.values())
+            slots[chosen] += 1
+            space -= 1
+        return slots
+
+    def running_counts(self) -> dict[str, int]:
+        """
+        Returns how many transition tasks are in flight for each model
+        """
+        counts: dict[str, int] = {}
+        for label, key in self.tasks:
+            if key != "__delete__":
+                counts[label] = counts.get(label, 0) + 1
+        return counts
+
+    def record_pickup(self, model: type[StatorModel], instance: StatorModel):
+        """
+        Counts a locked instance as handled, and records how long it waited
+        after becoming due.
+        """
+        label = model._meta.label_lower
+        self.handled[label] = self.handled.get(label, 0) + 1
+        due = instance.state_next_attempt or instance.state_changed
+        if due is None:
+            return
+        latency = max((timezone.now() - due).total_seconds(), 0.0)
+        entry = self.latencies.setdefault(label, {}).setdefault(
+            instance.state_lane, [0, 0.0, 0.0]
+        )
+        entry[0] += 1
+        entry[1] += latency
+        entry[2] = max(entry[2], latency)
+        self.metrics.observe(label, instance.state, "wait", latency)
 
     def add_transition_tasks(self, call_inline=False):
         """
@@ -193,29 +336,47 @@ class StatorRunner:
         """
         # Calculate space left for tasks
         space_remaining = self.concurrency - len(self.tasks)
-        # Fetch new tasks
-        for model in self.models:
-            if space_remaining > 0:
-                for instance in model.transition_get_with_lock(
-                    number=min(space_remaining, self.concurrency_per_model),
+        capacity = {
+            model._meta.label_lower: self.concurrency_per_model for model in self.models
+        }
+        running: dict[str, int] | None = self.running_counts()
+        # Fetch new tasks, re-offering any share a model couldn't use to the
+        # models that still have work
+        while space_remaining > 0 and capacity:
+            slots = self.allocate_slots(space_remaining, capacity, running)
+            running = None
+            claimed = 0
+            for model in self.models:
+                label = model._meta.label_lower
+                if not slots.get(label):
+                    continue
+                instances = model.transition_get_with_lock(
+                    number=slots[label],
                     lock_expiry=(
                         timezone.now() + datetime.timedelta(seconds=self.lock_expiry)
                     ),
-                ):
-                    key = (model._meta.label_lower, instance.pk)
+                )
+                for instance in instances:
+                    key = (label, instance.pk)
                     # Don't run two threads for the same thing
                     if key in self.tasks:
                         continue
                     if call_inline:
-                        task_transition(instance, in_thread=False)
+                        task_transition(instance, in_thread=False, metrics=self.metrics)
                     else:
                         self.tasks[key] = self.executor.submit(
-                            task_transition, instance
+                            task_transition, instance, metrics=self.metrics
                         )
-                    self.handled[model._meta.label_lower] = (
-                        self.handled.get(model._meta.label_lower, 0) + 1
-                    )
+                    self.record_pickup(model, instance)
                     space_remaining -= 1
+                claimed += len(instances)
+                if len(instances) < slots[label]:
+                    # It's run out of work for now
+                    del capacity[label]
+                else:
+                    capacity[label] -= len(instances)
+            if not claimed:
+                break
 
     def add_deletion_tasks(self, call_inline=False):
         """
@@ -253,7 +414,220 @@ class StatorRunner:
         self.add_transition_tasks(call_inline=True)
 
 
-def task_transition(instance: StatorModel, in_thread: bool = True):
+class AsyncStatorRunner(StatorRunner):
+    """
+    A StatorRunner that runs each transition as a task on a single asyncio
+    event loop, rather than giving each one its own thread.
+
+    Coroutine handlers run directly on the loop, so hundreds of them can sit
+    waiting on remote servers at once. Everything synchronous (sync handlers,
+    locking, state updates) goes through a small thread pool instead, which
+    caps the number of database connections at `db_pool_size`.
+    """
+
+    def __init__(
+        self,
+        models: list[type[StatorModel]],
+        concurrency: int = 200,
+        concurrency_per_model: int = 50,
+        db_pool_size: int = getattr(settings, "STATOR_DB_POOL_SIZE", 4),
+        **kwargs,
+    ):
+        super().__init__(
+            models,
+            concurrency=concurrency,
+            concurrency_per_model=concurrency_per_model,
+            **kwargs,
+        )
+        self.db_pool_size = db_pool_size
+
+    def run(self):
+        sentry.set_takahe_app("stator")
+        asyncio.run(self.arun())
+
+    async def arun(self):
+        self.handled = {}
+        self.started = time.monotonic()
+        self.last_scheduled = self.started
+        self.executor = ThreadPoolExecutor(max_workers=self.db_pool_size)
+        self.loop_delay = self.minimum_loop_delay
+        self.scheduling_timer = LoopingTimer(self.schedule_interval)
+        self.deletion_timer = LoopingTimer(self.delete_interval)
+        self.reconcile_timer = LoopingTimer(self.reconcile_interval)
+        logger.info(
+            f"Running main task loop (asyncio, {self.db_pool_size} DB connections)"
+        )
+        try:
+            with sentry.configure_scope() as scope:
+                while True:
+                    if self.scheduling_timer.check():
+                        signal.alarm(self.schedule_interval * 2)
+                        if self.liveness_file:
+                            with open(self.liveness_file, "w") as fh:
+                                fh.write(str(int(time.time())))
+                        await self.in_pool(self.load_config)
+                        await self.in_pool(self.run_scheduling)
+                        if self.reconcile_interval and self.reconcile_timer.check():
+                            await self.in_pool(self.run_reconcile)
+
+                    sentry.scope_clear(scope)
+
+                    self.clean_tasks()
+
+                    if self.deletion_timer.check():
+                        self.add_deletion_tasks()
+
+                    await self.aadd_transition_tasks()
+
+                    if (
+                        self.run_for
+                        and (time.monotonic() - self.started) > self.run_for
+                    ):
+                        break
+
+                    if self.tasks:
+                        self.loop_delay = self.minimum_loop_delay
+                    else:
+                        self.loop_delay = min(
+                            self.loop_delay * 1.5,
+                            self.maximum_loop_delay,
+                        )
+                    await asyncio.sleep(self.loop_delay)
+
+                    sentry.scope_clear(scope)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # asyncio.run() delivers Ctrl-C as a cancellation of this task
+            pass
+        finally:
+            logger.info("Waiting for tasks to complete")
+            if self.tasks:
+                await asyncio.wait(self.tasks.values())
+            await close_async_client()
+            self.shutdown_pool()
+
+        logger.info("Complete")
+
+    async def in_pool(self, func, *args):
+        """
+        Runs a synchronous function in the database thread pool.
+        """
+        return await sync_to_async(
+            func, thread_sensitive=False, executor=self.executor
+        )(*args)
+
+    def shutdown_pool(self, timeout: float = 5):
+        """
+        Closes the database connection held by each pool thread, and then
+        the pool itself. Threads still busy after `timeout` (say, stuck in a
+        sync handler) are left alone rather than waited for.
+        """
+        # The barrier keeps each close call on a different thread, until it
+        # gives up waiting for the busy ones
+        barrier = threading.Barrier(self.db_pool_size, timeout=timeout)
+
+        def close_connections():
+            connections.close_all()
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+
+        futures.wait(
+            [self.executor.submit(close_connections) for _ in range(self.db_pool_size)],
+            timeout=timeout * 2,
+        )
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def aadd_transition_tasks(self):
+        """
+        Adds a transition task for as many instances as we can, given capacity
+        and batch size limits.
+        """
+        space_remaining = self.concurrency - len(self.tasks)
+        capacity = {
+            model._meta.label_lower: self.concurrency_per_model for model in self.models
+        }
+        running: dict[str, int] | None = self.running_counts()
+        while space_remaining > 0 and capacity:
+            slots = self.allocate_slots(space_remaining, capacity, running)
+            running = None
+            claimed = 0
+            for model in self.models:
+                label = model._meta.label_lower
+                if not slots.get(label):
+                    continue
+                instances = await self.in_pool(
+                    model.transition_get_with_lock,
+                    slots[label],
+                    timezone.now() + datetime.timedelta(seconds=self.lock_expiry),
+                )
+                for instance in instances:
+                    key = (label, instance.pk)
+                    if key in self.tasks:
+                        continue
+                    self.tasks[key] = asyncio.create_task(
+                        atask_transition(instance, self.executor, self.metrics)
+                    )
+                    self.record_pickup(model, instance)
+                    space_remaining -= 1
+                claimed += len(instances)
+                if len(instances) < slots[label]:
+                    del capacity[label]
+                else:
+                    capacity[label] -= len(instances)
+            if not claimed:
+                break
+
+    def add_deletion_tasks(self, call_inline=False):
+        """
+        Adds a deletion task for each model
+        """
+        for model in self.models:
+            if model.state_graph.deletion_states:
+                self.tasks[model._meta.label_lower, "__delete__"] = asyncio.create_task(
+                    self.atask_deletion(model)
+                )
+
+    async def atask_deletion(self, model: type[StatorModel]):
+        """
+        Runs one model deletion set, sleeping on the loop rather than in
+        a pool thread between batches.
+        """
+        while True:
+            deleted = await self.in_pool(model.transition_delete_due)
+            if not deleted:
+                break
+            logger.info(f"{model._meta.label_lower}: Deleted {deleted} stale items")
+            await asyncio.sleep(1)
+
+    def run_single_cycle(self):
+        """
+        Testing entrypoint to advance things just one cycle, and allow errors
+        to propagate out.
+        """
+
+        async def cycle():
+            self.executor = ThreadPoolExecutor(max_workers=self.db_pool_size)
+            try:
+                self.add_deletion_tasks()
+                await self.aadd_transition_tasks()
+                tasks, self.tasks = list(self.tasks.values()), {}
+                for task in tasks:
+                    await task
+            finally:
+                await close_async_client()
+                self.shutdown_pool()
+
+        if not hasattr(self, "handled"):
+            self.handled = {}
+        asyncio.run(cycle())
+
+
+def task_transition(
+    instance: StatorModel,
+    in_thread: bool = True,
+    metrics: MetricsCollector | None = None,
+):
     """
     Runs one state transition/action.
     """
@@ -279,6 +653,8 @@ def task_transition(instance: StatorModel, in_thread: bool = True):
             logger.info(
                 f"{instance._meta.label_lower}: {instance.pk}: {instance.state} unchanged  ({duration:.2f}s)"
             )
+        if metrics:
+            metrics.record_transition(instance, duration)
     if in_thread:
         close_old_connections()
 
@@ -296,3 +672,40 @@ def task_deletion(model: type[StatorModel], in_thread: bool = True):
         time.sleep(1)
     if in_thread:
         close_old_connections()
+
+
+async def atask_transition(
+    instance: StatorModel,
+    executor: ThreadPoolExecutor,
+    metrics: MetricsCollector | None = None,
+):
+    """
+    Runs one state transition/action on the event loop.
+    """
+    task_name = f"stator.task_transition:{instance._meta.label_lower}#{{id}} from {instance.state}"
+    started = time.monotonic()
+    with sentry.start_transaction(op="task", name=task_name):
+        sentry.set_context(
+            "instance",
+            {
+                "model": instance._meta.label_lower,
+                "pk": instance.pk,
+                "state": instance.state,
+                "state_age": instance.state_age,
+            },
+        )
+        result = await instance.atransition_attempt(executor)
+        duration = time.monotonic() - started
+        if result:
+            logger.info(
+                f"{instance._meta.label_lower}: {instance.pk}: {instance.state} -> {result} ({duration:.2f}s)"
+            )
+        else:
+            logger.info(
+                f"{instance._meta.label_lower}: {instance.pk}: {instance.state} unchanged  ({duration:.2f}s)"
+            )
+        if metrics:
+            metrics.record_transition(instance, duration)
+    await sync_to_async(
+        close_old_connections, thread_sensitive=False, executor=executor
+    )()
@@ -1,7 +1,9 @@
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
 from django.views import View
 
+from stator.metrics import prometheus_text
 from stator.models import StatorModel
 from stator.runner import StatorRunner
 
@@ -22,3 +24,25 @@ class RequestRunner(View):
         runner = StatorRunner(StatorModel.subclasses, run_for=2)
         handled = runner.run()
         return HttpResponse(f"Handled {handled}")
+
+
+class Metrics(View):
+    """
+    Exports Stator's metrics in Prometheus format, to requests bearing
+    METRICS_TOKEN or from admins.
+    """
+
+    def get(self, request):
+        # Scrapers send the token as a bearer token (so it stays out of
+        # access logs); logged-in admins can look without one
+        token = settings.SETUP.METRICS_TOKEN
+        authorization = request.headers.get("authorization", "")
+        if not (
+            (token and constant_time_compare(authorization, f"Bearer {token}"))
+            or (request.user.is_authenticated and request.user.admin)
+        ):
+            return HttpResponseForbidden("Invalid token")
+        return HttpResponse(
+            prometheus_text(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
@@ -57,6 +57,15 @@ class Settings(BaseSettings):
     #: The default database.
     DATABASE_SERVER: ImplicitHostname | None
 
+    #: If we're being served over ASGI (such as by Uvicorn workers), in which
+    #: case the federation endpoints and our middleware run async.
+    ASGI: bool = False
+
+    #: Under ASGI, how long (in seconds) to keep database connections open
+    #: between requests. Defaults to 0, as queries run on a new thread for
+    #: each request there, so connections can't be reused.
+    DATABASE_CONN_MAX_AGE: int | None = None
+
     #: The currently running environment, used for things such as sentry
     #: error reporting.
     ENVIRONMENT: Environments = "development"
@@ -131,10 +140,36 @@ class Settings(BaseSettings):
     #: served through the image proxy.
     EMOJI_MAX_IMAGE_FILESIZE_KB: int = 200
 
+    #: If remote image attachments should be downloaded in the background to
+    #: make local thumbnails (and blurhashes, if missing), so timelines don't
+    #: have to proxy full-size images. Images over this size are skipped;
+    #: thumbnails are kept for REMOTE_PRUNE_HORIZON days.
+    REMOTE_MEDIA_PREFETCH: bool = False
+    REMOTE_MEDIA_MAX_IMAGE_FILESIZE_KB: int = 10000
+
     #: Request timeouts to use when talking to other servers Either
     #: float or tuple of floats for (connect, read, write, pool)
     REMOTE_TIMEOUT: float | tuple[float, float, float, float] = 5.0
 
+    #: Size of the shared outbound connection pool: how many connections
+    #: each process may have open in total, how many of those to keep
+    #: alive when idle, and how many may go to any one host at once.
+    HTTP_POOL_MAX_CONNECTIONS: int = 100
+    HTTP_POOL_MAX_KEEPALIVE: int = 20
+    HTTP_POOL_MAX_PER_HOST: int = 10
+
+    #: Seconds an idle pooled connection is kept open for reuse
+    HTTP_POOL_KEEPALIVE_EXPIRY: float = 30.0
+
+    #: If outbound requests should negotiate HTTP/2 where the server offers it
+    HTTP_POOL_HTTP2: bool = True
+
+    #: Directory to cache proxied remote media in when not behind our nginx
+    #: (which has its own cache), and how many bytes it may use in total.
+    #: Leave the directory unset to stream media through uncached.
+    MEDIA_PROXY_CACHE_DIR: str | None = None
+    MEDIA_PROXY_CACHE_SIZE: int = 1024 * 1024 * 1024
+
     #: If search features like full text search should be enabled.
     #: (placeholder setting, no effect)
     SEARCH: bool = True
@@ -142,18 +177,100 @@ class Settings(BaseSettings):
     #: Default cache backend
     CACHES_DEFAULT: CacheBackendUrl | None = None
 
+    # How long, in seconds, rendered post and profile HTML is kept in the
+    # default cache. Set to zero to not share it between requests.
+    CONTENT_CACHE_TTL: int = 86400
+
+    # Domains, identities and settings looked up on every request are kept
+    # in each process for this many seconds (or until they change there), up
+    # to this many of each. Set LOOKUP_CACHE_SHARED to keep them (and API
+    # tokens) in the default cache instead, so changes apply everywhere.
+    LOOKUP_CACHE_TTL: int = 30
+    LOOKUP_CACHE_SIZE: int = 10000
+    LOOKUP_CACHE_SHARED: bool = False
+
+    # How often, in seconds, each process checks whether the set of blocked
+    # domains has changed elsewhere (changes made in-process apply at once).
+    DOMAIN_BLOCKLIST_REFRESH: int = 10
+
     # How long to wait, in days, until remote posts/profiles are pruned from
     # our database if nobody local has interacted with them.
     # Set to zero to disable.
     REMOTE_PRUNE_HORIZON: int = 90
 
+    # Outbound delivery retries: the first retry waits around
+    # DELIVERY_BACKOFF_BASE seconds, doubling each time up to
+    # DELIVERY_BACKOFF_MAX, and after DELIVERY_CIRCUIT_THRESHOLD failures in
+    # a row nothing more is sent to that server until the wait is over
+    DELIVERY_BACKOFF_BASE: int = 60
+    DELIVERY_BACKOFF_MAX: int = 60 * 60 * 6
+    DELIVERY_CIRCUIT_THRESHOLD: int = 5
+
+    # Trends: hours for a use, like or boost to count half as much
+    TRENDS_HALF_LIFE: float = 6
+    # How often (in seconds) the trending lists are recomputed
+    TRENDS_REFRESH_INTERVAL: int = 300
+    # How many items each trending list keeps
+    TRENDS_SIZE: int = 40
+
     # Stator tuning
     STATOR_CONCURRENCY: int = 20
     STATOR_CONCURRENCY_PER_MODEL: int = 4
+    # How many database connections the asyncio stator runner may hold
+    STATOR_DB_POOL_SIZE: int = 4
+    # Relative share of stator slots each model gets when they're all busy,
+    # keyed by model label (e.g. {"activities.fanout": 4}); unlisted models
+    # have a weight of 1, and 0 means "only its minimum"
+    STATOR_MODEL_WEIGHTS: dict[str, int] = {}
+    # Slots a model is offered before any are shared out by weight
+    STATOR_MODEL_MIN_SLOTS: dict[str, int] = {}
+    # Upper bounds (in seconds) of the handler duration and queue wait
+    # histogram buckets on /metrics
+    STATOR_METRICS_BUCKETS: list[float] = [
+        0.01,
+        0.05,
+        0.1,
+        0.5,
+        1,
+        5,
+        10,
+        30,
+        60,
+        300,
+        900,
+        3600,
+    ]
+    # How often (in seconds) each stator runner reconciles derived data such
+    # as post interaction counts; 0 turns it off for that runner
+    STATOR_RECONCILE_INTERVAL: int = 600
+    # Ready tasks counted exactly before the queue depth is estimated instead
+    STATOR_QUEUE_COUNT_LIMIT: int = 10000
+    # Token for scraping /metrics, sent as "Authorization: Bearer <token>";
+    # without one, only logged-in admins can see it
+    METRICS_TOKEN: str | None = None
+
+    # Inbox ingest tuning
+    # Defer canonicalisation, LD signatures and full block checks on incoming
+    # activities to Stator, only checking HTTP signatures up front (messages
+    # that then fail them are dropped, though the sender was told 202)
+    INBOX_DEFERRED: bool = False
+    # How many concurrent inbox requests' messages each web process writes
+    # in one batch, and the longest a request waits for others to join its
+    # batch before writing it anyway (1 = write each at once)
+    INBOX_BATCH_SIZE: int = 1
+    INBOX_BATCH_SECONDS: float = 0.1
+    # Answer 429 once this many inbox messages are waiting (0 = no limit)
+    INBOX_MAX_QUEUE: int = 0
+    INBOX_RETRY_AFTER: int = 60
 
     # If user migration is allowed (off by default until outbound is done)
     ALLOW_USER_MIGRATION: bool = False
 
+    # Follow imports are processed one server at a time, this many accounts
+    # per task, looking up to this many of them at once
+    IMPORT_FOLLOW_BATCH: int = 100
+    IMPORT_FOLLOW_CONCURRENCY: int = 4
+
     # Web Push keys
     # Generate via https://web-push-codelab.glitch.me/
     VAPID_PUBLIC_KEY: str | None = None
@@ -261,6 +378,23 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "takahe.wsgi.application"
 
+# Whether we're being served over ASGI, in which case views that have async
+# handlers use them (see core.views.AsyncCapableView)
+ASGI = SETUP.ASGI
+
+# Versions of middleware that run natively async, used under ASGI so that
+# requests aren't passed to a thread and back at every step
+ASYNC_MIDDLEWARE = {
+    "core.middleware.SentryTaggingMiddleware": "core.middleware.AsyncSentryTaggingMiddleware",
+    "whitenoise.middleware.WhiteNoiseMiddleware": "core.middleware.StaticFilesMiddleware",
+    "core.middleware.HeadersMiddleware": "core.middleware.AsyncHeadersMiddleware",
+    "core.middleware.ConfigLoadingMiddleware": "core.middleware.AsyncConfigLoadingMiddleware",
+    "api.middleware.ApiTokenMiddleware": "api.middleware.AsyncApiTokenMiddleware",
+    "users.middleware.DomainMiddleware": "users.middleware.AsyncDomainMiddleware",
+}
+if ASGI:
+    MIDDLEWARE = [ASYNC_MIDDLEWARE.get(name, name) for name in MIDDLEWARE]
+
 if SETUP.DATABASE_SERVER:
     DATABASES = {
         "default": dj_database_url.parse(SETUP.DATABASE_SERVER, conn_max_age=600)
@@ -277,6 +411,9 @@ else:
         }
     }
 
+if ASGI:
+    DATABASES["default"]["CONN_MAX_AGE"] = SETUP.DATABASE_CONN_MAX_AGE or 0
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework.authentication.BasicAuthentication",
@@ -347,6 +484,7 @@ AUTO_ADMIN_EMAIL = SETUP.AUTO_ADMIN_EMAIL
 STATOR_TOKEN = SETUP.STATOR_TOKEN
 STATOR_CONCURRENCY = SETUP.STATOR_CONCURRENCY
 STATOR_CONCURRENCY_PER_MODEL = SETUP.STATOR_CONCURRENCY_PER_MODEL
+STATOR_DB_POOL_SIZE = SETUP.STATOR_DB_POOL_SIZE
 
 ROBOTS_TXT_DISALLOWED_USER_AGENTS = SETUP.ROBOTS_TXT_DISALLOWED_USER_AGENTS
 
@@ -355,6 +355,7 @@ urlpatterns = [
     path("oauth/revoke", oauth.RevokeTokenView.as_view()),
     # Stator
     path(".stator/", stator.RequestRunner.as_view()),
+    path("metrics", stator.Metrics.as_view()),
     # Django admin
     path("djadmin/", djadmin.site.urls),
     # Media files
@@ -0,0 +1,130 @@
+import datetime
+
+import httpx
+import pytest
+from asgiref.sync import async_to_sync
+from django.utils import timezone
+from pytest_httpx import HTTPXMock
+
+from activities.models import FanOut, FanOutStates, Post
+from users.models import Domain, Identity
+
+
+def make_remote(domain: Domain, name: str, shared_inbox: str | None) -> Identity:
+    return Identity.objects.create(
+        actor_uri=f"https://{domain.domain}/{name}/",
+        inbox_uri=f"https://{domain.domain}/{name}/inbox/",
+        shared_inbox_uri=shared_inbox,
+        username=name,
+        domain=domain,
+        local=False,
+        state="updated",
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("use_async", [False, True])
+def test_fan_out_batched_delivery(
+    identity: Identity, httpx_mock: HTTPXMock, use_async: bool
+):
+    """
+    Tests that remote fan-outs for one post are sent once per inbox, and
+    that each row records its own outcome (from both the sync handler and
+    the async one the asyncio runner uses).
+    """
+    domain = Domain.objects.create(domain="remote.test", local=False, state="updated")
+    other_domain = Domain.objects.create(
+        domain="other.test", local=False, state="updated"
+    )
+    remote1 = make_remote(domain, "one", "https://remote.test/inbox/")
+    remote2 = make_remote(domain, "two", "https://remote.test/inbox/")
+    remote3 = make_remote(other_domain, "three", None)
+    post = Post.create_local(author=identity, content="<p>Hello</p>")
+    FanOut.objects.bulk_create(
+        [
+            FanOut(identity=target, type=FanOut.Types.post, subject_post=post)
+            for target in [remote1, remote2, remote3]
+        ]
+    )
+    fan_out1, fan_out2, fan_out3 = FanOut.objects.filter(
+        subject_post=post, identity__local=False
+    ).order_by("pk")
+
+    httpx_mock.add_response(url="https://remote.test/inbox/", status_code=202)
+    httpx_mock.add_exception(
+        httpx.ConnectError("Unreachable"),
+        url="https://other.test/three/inbox/",
+    )
+    if use_async:
+        assert async_to_sync(FanOutStates.ahandle_new)(fan_out1) == FanOutStates.sent
+    else:
+        assert FanOutStates.handle_new(fan_out1) == FanOutStates.sent
+
+    # One request per inbox, with the same body
+    requests = httpx_mock.get_requests()
+    assert sorted(str(request.url) for request in requests) == [
+        "https://other.test/three/inbox/",
+        "https://remote.test/inbox/",
+    ]
+    assert requests[0].content == requests[1].content
+
+    # The sibling sharing an inbox is sent, the unreachable one will retry
+    fan_out2.refresh_from_db()
+    fan_out3.refresh_from_db()
+    assert fan_out2.state == str(FanOutStates.sent)
+    assert fan_out3.state == str(FanOutStates.new)
+    assert fan_out3.state_locked_until is None
+    assert fan_out3.state_next_attempt is not None
+
+
+@pytest.mark.django_db
+def test_fan_out_circuit_breaker(
+    identity: Identity, httpx_mock: HTTPXMock, settings, monkeypatch
+):
+    """
+    Tests that failed deliveries back off, and that once a server has failed
+    too often its deliveries aren't picked up until it's due a retry.
+    """
+    monkeypatch.setattr(settings.SETUP, "DELIVERY_CIRCUIT_THRESHOLD", 2)
+    monkeypatch.setattr(settings.SETUP, "DELIVERY_BACKOFF_BASE", 100)
+    domain = Domain.objects.create(domain="remote.test", local=False, state="updated")
+    remote = make_remote(domain, "one", None)
+    post = Post.create_local(author=identity, content="<p>Hello</p>")
+    fan_out = FanOut.objects.create(
+        identity=remote, type=FanOut.Types.post, subject_post=post
+    )
+    fan_out.refresh_from_db()
+
+    # A server error counts as a failure, and the retry is backed off
+    httpx_mock.add_response(url="https://remote.test/one/inbox/", status_code=503)
+    fan_out.transition_attempt()
+    fan_out.refresh_from_db()
+    domain.refresh_from_db()
+    assert fan_out.state == str(FanOutStates.new)
+    assert domain.delivery_failures == 1
+    assert not domain.delivery_circuit_open
+    wait = (fan_out.state_next_attempt - timezone.now()).total_seconds()
+    assert 45 <= wait <= 100
+
+    # The second failure in a row opens the circuit
+    httpx_mock.add_exception(
+        httpx.ConnectError("Unreachable"), url="https://remote.test/one/inbox/"
+    )
+    FanOut.objects.filter(pk=fan_out.pk).update(state_next_attempt=None)
+    fan_out.refresh_from_db()
+    fan_out.transition_attempt()
+    domain.refresh_from_db()
+    assert domain.delivery_failures == 2
+    assert domain.delivery_circuit_open
+    FanOut.objects.filter(pk=fan_out.pk).update(state_next_attempt=None)
+    lock_expiry = timezone.now() + datetime.timedelta(seconds=60)
+    assert FanOut.transition_get_with_lock(10, lock_expiry) == []
+
+    # Once it's due again, a success closes it
+    Domain.objects.filter(pk=domain.pk).update(delivery_retry_after=timezone.now())
+    (fan_out,) = FanOut.transition_get_with_lock(10, lock_expiry)
+    httpx_mock.add_response(url="https://remote.test/one/inbox/", status_code=202)
+    assert fan_out.transition_attempt() == FanOutStates.sent
+    domain.refresh_from_db()
+    assert domain.delivery_failures == 0
+    assert domain.delivery_retry_after is None
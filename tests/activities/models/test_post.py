@@ -1,8 +1,10 @@
 import pytest
+from django.utils import timezone
 from pytest_httpx import HTTPXMock
 
-from activities.models import Hashtag, Post, PostStates
+from activities.models import Hashtag, HashtagStates, HashtagUsage, Post, PostStates
 from activities.models.post_types import QuestionData
+from activities.services import PostService
 from users.models import Identity, InboxMessage
 
 
@@ -85,6 +87,50 @@ def test_ensure_hashtag(identity: Identity, config_system, stator):
     ).exists()
 
 
+@pytest.mark.django_db
+def test_hashtag_usage(identity: Identity, config_system, stator):
+    """
+    Tests that hashtag usage is counted as local public posts are made,
+    edited and deleted, and that a rebuild agrees with it.
+    """
+    today = timezone.localdate()
+    first = Post.create_local(author=identity, content="Hello #one #two")
+    Post.create_local(author=identity, content="More #one")
+    # Replies and non-public posts don't count
+    Post.create_local(author=identity, content="Also #one", reply_to=first)
+    Post.create_local(
+        author=identity,
+        content="Quietly #one",
+        visibility=Post.Visibilities.followers,
+    )
+    stator.run_single_cycle()
+    one = Hashtag.objects.get(hashtag="one")
+    two = Hashtag.objects.get(hashtag="two")
+    assert one.usage_days() == {today: 2}
+    assert one.usage_months() == {today.replace(day=1): 2}
+    assert two.usage_total == 1
+
+    # Editing a tag out takes it off the count
+    first.edit_local(content="Hello #one")
+    assert two.usage_days() == {}
+
+    # As does deleting the post
+    PostService(first).delete()
+    stator.run_single_cycle()
+    assert one.usage_days() == {today: 1}
+
+    # A rebuild from posts comes to the same numbers
+    HashtagUsage.objects.all().delete()
+    HashtagStates.handle_outdated(one)
+    assert one.usage_days() == {today: 1}
+
+    # Aliases count towards the hashtag
+    HashtagUsage.add(["uno"], today)
+    one.aliases = ["uno"]
+    Hashtag.prefetch_usage_totals([one])
+    assert one.usage_total == 2
+
+
 @pytest.mark.django_db
 def test_linkify_mentions_remote(
     identity, identity2, remote_identity, remote_identity2
@@ -1,5 +1,12 @@
+import datetime
+import io
+
 import pytest
 from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image
+from pytest_httpx import HTTPXMock
 
 from activities.models import Post, PostAttachment, PostAttachmentStates
 from core.files import resize_image
@@ -109,3 +116,73 @@ def test_local_attachment(identity, config_system):
     # second attachment doesn't have a focal point
     assert ap["attachment"][1]["name"] == "Test attachment 2"
     assert "focalPoint" not in ap["attachment"][1]
+
+
+@pytest.mark.django_db
+def test_remote_attachment_prefetch(
+    remote_identity,
+    stator,
+    settings,
+    monkeypatch,
+    tmp_path,
+    httpx_mock: HTTPXMock,
+    django_capture_on_commit_callbacks,
+):
+    """
+    Tests that remote images get local thumbnails and blurhashes when
+    prefetching is on, and that they're removed again later
+    """
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.MEDIA_URL = "https://example.com/media/"
+    monkeypatch.setattr(settings.SETUP, "REMOTE_MEDIA_PREFETCH", True)
+    image = io.BytesIO()
+    Image.new("RGB", (1200, 800), (40, 40, 200)).save(image, format="jpeg")
+    httpx_mock.add_response(
+        url="https://remote.test/posts/1/attachment/1", content=image.getvalue()
+    )
+    post = Post.by_ap(
+        data={
+            "id": "https://remote.test/posts/1",
+            "type": "Note",
+            "content": "Hi World",
+            "attributedTo": remote_identity.actor_uri,
+            "published": "2022-12-23T10:50:54Z",
+            "attachment": {
+                "type": "Image",
+                "url": "https://remote.test/posts/1/attachment/1",
+                "mediaType": "image/jpeg",
+            },
+        },
+        create=True,
+    )
+    attachment = post.attachments.get()
+    assert attachment.state == PostAttachmentStates.fetching
+    stator.run_single_cycle()
+    attachment.refresh_from_db()
+    assert attachment.state == PostAttachmentStates.cached
+    assert attachment.blurhash
+    assert (attachment.width, attachment.height) == (1200, 800)
+    assert attachment.thumbnail_url().absolute.startswith("https://example.com/media/")
+    # The full image still comes through the proxy
+    assert "/proxy/" in attachment.full_url().absolute
+
+    # Past the horizon, the thumbnail goes but the post stays
+    monkeypatch.setattr(settings.SETUP, "REMOTE_PRUNE_HORIZON", 1)
+    thumbnail = attachment.thumbnail.name
+    PostAttachment.objects.filter(pk=attachment.pk).update(
+        created=timezone.now() - datetime.timedelta(days=2)
+    )
+    attachment.refresh_from_db()
+    assert (
+        PostAttachmentStates.handle_cached(attachment) == PostAttachmentStates.expired
+    )
+    assert not attachment.thumbnail
+    assert not default_storage.exists(thumbnail)
+
+    # Thumbnails are also removed along with their posts
+    attachment.cache_remote(ContentFile(image.getvalue()))
+    thumbnail = attachment.thumbnail.name
+    assert default_storage.exists(thumbnail)
+    with django_capture_on_commit_callbacks(execute=True):
+        post.delete()
+    assert not default_storage.exists(thumbnail)
@@ -1,6 +1,7 @@
 import pytest
 
-from activities.models import Post
+from activities.models import FanOut, Post
+from activities.models.fan_out import FanOutTarget
 from users.models import Block, Domain, Follow, Identity
 
 
@@ -179,3 +180,37 @@ def test_post_blocked(identity, other_identity, remote_identity):
     # The muted block should be in targets, the full block should not
     targets = post.get_targets()
     assert targets == {identity, other_identity}
+
+
+@pytest.mark.django_db
+def test_post_fan_out_targets(identity, other_identity, remote_identity, monkeypatch):
+    """
+    Tests that fan-out targets come back as plain rows with the inbox to
+    deliver to, and that FanOuts are made for them in chunks.
+    """
+    Follow.objects.create(source=other_identity, target=identity)
+    Follow.objects.create(source=remote_identity, target=identity)
+    post = Post.objects.create(
+        content="<p>Hello</p>",
+        author=identity,
+        local=True,
+        visibility=Post.Visibilities.public,
+    )
+    targets = sorted(post.get_fan_out_targets())
+    assert targets == sorted(
+        [
+            FanOutTarget(identity.pk, True, None),
+            FanOutTarget(other_identity.pk, True, None),
+            FanOutTarget(
+                remote_identity.pk,
+                False,
+                remote_identity.shared_inbox_uri or remote_identity.inbox_uri,
+            ),
+        ]
+    )
+
+    monkeypatch.setattr(FanOut, "TARGET_CHUNK_SIZE", 2)
+    FanOut.create_for_targets(targets, type=FanOut.Types.post, subject_post=post)
+    assert set(
+        FanOut.objects.filter(subject_post=post).values_list("identity_id", flat=True)
+    ) == {identity.pk, other_identity.pk, remote_identity.pk}
@@ -1,7 +1,13 @@
+import datetime
+
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from activities.models import Post, PostInteraction
+from activities.models import Post, PostInteraction, PostStates
 from activities.services import PostService
+from stator.models import Stats
 from users.models import Identity
 
 
@@ -37,6 +43,44 @@ def test_post_context(identity: Identity, config_system):
     assert descendants == []
 
 
+@pytest.mark.django_db
+def test_post_context_tree(identity: Identity, other_identity: Identity, config_system):
+    """
+    Tests that a branching thread is loaded in a fixed number of queries,
+    in walk order, leaving out hidden posts and everything under them
+    """
+    root = Post.create_local(author=identity, content="<p>root</p>")
+
+    def reply(parent, author=identity, **kwargs):
+        return Post.create_local(
+            author=author, content="<p>reply</p>", reply_to=parent, **kwargs
+        )
+
+    a = reply(root)
+    b = reply(root, author=other_identity)
+    a1 = reply(a)
+    a2 = reply(a)
+    reply(a2)
+    b1 = reply(b, author=other_identity, visibility=Post.Visibilities.followers)
+    reply(b1)
+    b2 = reply(b)
+    Post.objects.filter(pk=a2.pk).update(state=PostStates.deleted)
+
+    with CaptureQueriesContext(connection) as context:
+        ancestors, descendants = PostService(root).context(identity)
+    assert ancestors == []
+    assert descendants == [a, b, b2, a1]
+    # The two thread queries, the posts, and their prefetches
+    assert len(context.captured_queries) <= 6
+
+    # The author can see their followers-only reply
+    ancestors, descendants = PostService(b1).context(other_identity)
+    assert ancestors == [b, root]
+    assert len(descendants) == 1
+    ancestors, descendants = PostService(root).context(other_identity)
+    assert b1 in descendants
+
+
 @pytest.mark.django_db
 def test_pin_as(identity: Identity, identity2: Identity, config_system):
     post = Post.create_local(
@@ -110,3 +154,116 @@ def test_pin_as(identity: Identity, identity2: Identity, config_system):
         ).count()
         == 5
     )
+
+
+@pytest.mark.django_db
+def test_interaction_stats(identity: Identity, identity2: Identity, config_system):
+    """
+    Tests that likes, boosts and replies are counted as they happen, and that
+    reconciling corrects counts that have drifted.
+    """
+    since = timezone.now()
+    post = Post.create_local(author=identity, content="Hello world")
+    service = PostService(post)
+
+    service.like_as(identity2)
+    service.like_as(identity2)
+    service.boost_as(identity2)
+    Post.create_local(author=identity2, content="Reply", reply_to=post)
+    post.refresh_from_db()
+    assert post.stats == {"likes": 1, "boosts": 1, "replies": 1}
+
+    service.unlike_as(identity2)
+    service.unlike_as(identity2)
+    post.refresh_from_db()
+    assert post.stats == {"likes": 0, "boosts": 1, "replies": 1}
+
+    # Drift gets fixed by the next reconcile
+    Post.objects.filter(pk=post.pk).update(stats={"likes": 5})
+    Post.transition_reconcile(since, timezone.now())
+    post.refresh_from_db()
+    assert post.stats == {"likes": 0, "boosts": 1, "replies": 1}
+
+
+@pytest.mark.django_db
+def test_reconcile_batches(
+    identity: Identity, identity2: Identity, config_system, monkeypatch
+):
+    """
+    Tests that reconciling works through more changes than fit in a batch,
+    counts deleted replies, and only moves the shared watermark on as far as
+    it got.
+    """
+    monkeypatch.setattr(Post, "RECONCILE_BATCH_SIZE", 3)
+    monkeypatch.setattr(Post, "RECONCILE_GRACE", datetime.timedelta(0))
+    Stats.objects.update_or_create(
+        model_label="activities.post",
+        defaults={"statistics": {}, "reconciled": timezone.now()},
+    )
+    posts = [Post.create_local(author=identity, content=f"{i}") for i in range(8)]
+    for post in posts:
+        PostService(post).like_as(identity2)
+    reply = Post.create_local(author=identity2, content="Reply", reply_to=posts[0])
+    reply.transition_perform(PostStates.deleted)
+    Post.objects.filter(pk__in=[post.pk for post in posts]).update(stats={})
+
+    # A run that stops part way leaves the watermark where it got to
+    calls = []
+    reconcile = Post.transition_reconcile.__func__  # type: ignore
+
+    def one_batch(cls, since, until):
+        if calls:
+            raise RuntimeError("Stopped")
+        calls.append(since)
+        return reconcile(cls, since, until)
+
+    monkeypatch.setattr(Post, "transition_reconcile", classmethod(one_batch))
+    with pytest.raises(RuntimeError):
+        Post.transition_run_reconcile()
+    reconciled = Stats.objects.get(model_label="activities.post").reconciled
+    assert calls[0] < reconciled < timezone.now()
+    assert Post.objects.filter(stats={}).count() == 5
+
+    monkeypatch.setattr(Post, "transition_reconcile", classmethod(reconcile))
+    Post.transition_run_reconcile()
+    for post in posts:
+        post.refresh_from_db()
+        assert post.stats == {"likes": 1, "boosts": 0, "replies": 0}
+
+
+@pytest.mark.django_db
+def test_reconcile_grace(identity: Identity, identity2: Identity, config_system):
+    """
+    Tests that the reconcile watermark stays a grace window behind, so a like
+    stamped before a run but committed after it is still counted.
+    """
+    post = Post.create_local(author=identity, content="Hello world")
+    Post.transition_run_reconcile()
+    reconciled = Stats.objects.get(model_label="activities.post").reconciled
+    assert reconciled < timezone.now() - Post.RECONCILE_GRACE
+
+    # A like that was stamped in the past, and never counted
+    PostService(post).like_as(identity2)
+    PostInteraction.objects.filter(post=post).update(
+        state_changed=reconciled + datetime.timedelta(seconds=1)
+    )
+    Post.objects.filter(pk=post.pk).update(stats={})
+    Post.transition_run_reconcile()
+    post.refresh_from_db()
+    assert post.stats["likes"] == 1
+
+
+@pytest.mark.django_db
+def test_reply_delete_stats(identity: Identity, identity2: Identity, config_system):
+    """
+    Tests that deleting a reply takes it off its parent's reply count, once.
+    """
+    post = Post.create_local(author=identity, content="Hello world")
+    reply = Post.create_local(author=identity2, content="Reply", reply_to=post)
+    post.refresh_from_db()
+    assert post.stats["replies"] == 1
+
+    PostService(reply).delete()
+    PostService(reply).delete()
+    post.refresh_from_db()
+    assert post.stats["replies"] == 0
@@ -1,4 +1,8 @@
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from users.models import Block, Follow, Identity
 
 
 @pytest.mark.django_db
@@ -13,3 +17,79 @@ def test_account_search(api_client, identity):
     response = api_client.get("/api/v1/accounts/search?q=test").json()
     assert response[0]["id"] == str(identity.pk)
     assert response[0]["username"] == identity.username
+
+
+@pytest.mark.django_db
+def test_account_relationships(api_client, identity, identity2, other_identity):
+    """
+    Tests that relationships with several accounts are resolved correctly
+    in one request.
+    """
+    Follow.objects.create(source=identity, target=other_identity, state="accepted")
+    Follow.objects.create(source=other_identity, target=identity, state="accepted")
+    Block.objects.create(source=identity, target=identity2, mute=True)
+    Block.objects.create(source=identity2, target=identity, mute=False)
+
+    response = api_client.get(
+        "/api/v1/accounts/relationships",
+        {"id[]": [str(other_identity.pk), str(identity2.pk)]},
+    ).json()
+    assert [relationship["id"] for relationship in response] == [
+        str(other_identity.pk),
+        str(identity2.pk),
+    ]
+    assert response[0]["following"] and response[0]["followed_by"]
+    assert not response[0]["muting"] and not response[0]["blocked_by"]
+    assert response[1]["muting"] and response[1]["blocked_by"]
+    assert not response[1]["following"] and not response[1]["blocking"]
+
+
+@pytest.mark.django_db
+def test_familiar_followers(api_client, identity, identity2, other_identity):
+    """
+    Tests that familiar followers are found for each requested account.
+    """
+    Follow.objects.create(source=identity, target=other_identity, state="accepted")
+    Follow.objects.create(source=other_identity, target=identity2, state="accepted")
+
+    response = api_client.get(
+        "/api/v1/accounts/familiar_followers",
+        {"id[]": [str(identity2.pk), str(other_identity.pk)]},
+    ).json()
+    assert response[0]["id"] == str(identity2.pk)
+    assert [account["id"] for account in response[0]["accounts"]] == [
+        str(other_identity.pk)
+    ]
+    assert response[1]["accounts"] == []
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("count", [1, 20, 80])
+def test_relationships_query_count(api_client, identity, domain, count):
+    """
+    Tests that resolving relationships takes the same number of queries
+    however many accounts are asked about.
+    """
+    others = Identity.objects.bulk_create(
+        Identity(
+            actor_uri=f"https://example.com/@user{i}@example.com/",
+            username=f"user{i}",
+            domain=domain,
+            local=True,
+        )
+        for i in range(count)
+    )
+    Follow.objects.bulk_create(
+        Follow(source=identity, target=other, state="accepted") for other in others[::2]
+    )
+    params = {"id[]": [str(other.pk) for other in others]}
+    api_client.get("/api/v1/accounts/relationships", params)
+
+    with CaptureQueriesContext(connection) as context:
+        response = api_client.get("/api/v1/accounts/relationships", params)
+    assert len(response.json()) == count
+    assert sum(relationship["following"] for relationship in response.json()) == (
+        (count + 1) // 2
+    )
+    # Auth, the identities, follows and blocks
+    assert len(context.captured_queries) <= 6
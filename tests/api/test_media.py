@@ -0,0 +1,104 @@
+import io
+
+import pytest
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image
+
+from activities.models import PostAttachment, PostAttachmentStates
+
+
+@pytest.fixture(autouse=True)
+def media_storage(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.MEDIA_URL = "https://example.com/media/"
+
+
+def make_upload(size=(3000, 1500)) -> SimpleUploadedFile:
+    data = io.BytesIO()
+    Image.new("RGB", size, (200, 40, 40)).save(data, format="jpeg")
+    return SimpleUploadedFile("photo.jpg", data.getvalue(), content_type="image/jpeg")
+
+
+@pytest.mark.django_db
+def test_upload_media(api_client):
+    """
+    Tests that v1 uploads are processed straight away.
+    """
+    response = api_client.post("/api/v1/media", {"file": make_upload()})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["url"]
+    assert data["preview_url"]
+    assert data["blurhash"]
+    assert data["meta"]["original"]["size"] == "2000x1000"
+
+
+@pytest.mark.django_db
+def test_upload_media_async(api_client, stator):
+    """
+    Tests that v2 uploads are stored and processed by Stator, and can't be
+    posted until they're done.
+    """
+    response = api_client.post(
+        "/api/v2/media", {"file": make_upload(), "description": "A photo"}
+    )
+    assert response.status_code == 202
+    data = response.json()
+    assert data["url"] is None
+    assert data["description"] == "A photo"
+    assert api_client.get(f"/api/v1/media/{data['id']}").status_code == 206
+    response = api_client.post(
+        "/api/v1/statuses",
+        content_type="application/json",
+        data={"status": "Look", "media_ids": [data["id"]]},
+    )
+    assert response.status_code == 422
+
+    original = PostAttachment.objects.get(pk=data["id"]).file.name
+    stator.run_single_cycle()
+    attachment = PostAttachment.objects.get(pk=data["id"])
+    assert not attachment.file.storage.exists(original)
+    assert attachment.state == PostAttachmentStates.fetched
+    assert attachment.mimetype == "image/webp"
+    assert (attachment.width, attachment.height) == (2000, 1000)
+    assert attachment.thumbnail
+    response = api_client.get(f"/api/v1/media/{data['id']}")
+    assert response.status_code == 200
+    assert response.json()["url"]
+    assert response.json()["blurhash"]
+
+    # Not images at all are turned away
+    response = api_client.post(
+        "/api/v2/media",
+        {"file": SimpleUploadedFile("a.txt", b"hello", content_type="text/plain")},
+    )
+    assert response.status_code == 422
+
+
+@pytest.mark.django_db
+def test_upload_media_async_ordering(api_client, stator, monkeypatch):
+    """
+    Tests that Stator can't pick up an upload before its original is stored,
+    and leaves one without a file alone rather than failing it.
+    """
+    seen = []
+    save = FileSystemStorage._save
+
+    def slow_save(self, name, content):
+        # Stator runs while the original is still being stored
+        stator.run_single_cycle()
+        seen.append(PostAttachment.objects.count())
+        return save(self, name, content)
+
+    monkeypatch.setattr(FileSystemStorage, "_save", slow_save)
+    response = api_client.post("/api/v2/media", {"file": make_upload()})
+    assert response.status_code == 202
+    assert seen == [0]
+    monkeypatch.undo()
+
+    attachment = PostAttachment.objects.get()
+    assert attachment.file
+    attachment.file = None
+    attachment.save()
+    assert PostAttachmentStates.handle_processing(attachment) is None
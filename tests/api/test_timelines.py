@@ -0,0 +1,108 @@
+from datetime import timedelta
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from activities.models import Post, PostInteraction, TimelineEvent
+from core.ld import format_ld_date
+from users.models import Bookmark, Identity
+
+
+def make_statuses(
+    count: int, identity: Identity, authors: list[Identity], booster: Identity
+):
+    """
+    Makes `count` of each kind of status the list endpoints have to
+    serialize: replies, polls, boosts, likes and bookmarks, by authors with
+    custom emoji in their names.
+    """
+    for author in authors:
+        author.name = f"{author.username} :blob: :wave:"
+        author.save()
+    parent = Post.create_local(author=authors[0], content="<p>Parent</p>")
+    for i in range(count):
+        author = authors[i % len(authors)]
+        reply = Post.create_local(
+            author=author, content=f"<p>Reply {i} #tagged</p>", reply_to=parent
+        )
+        reply.local = True
+        reply.save()
+        poll = Post.create_local(
+            author=author,
+            content=f"<p>Poll {i} #tagged</p>",
+            question={
+                "type": "Question",
+                "mode": "oneOf",
+                "options": [
+                    {"name": "Yes", "type": "Note", "votes": 0},
+                    {"name": "No", "type": "Note", "votes": 0},
+                ],
+                "voter_count": 0,
+                "end_time": format_ld_date(timezone.now() + timedelta(1)),
+            },
+        )
+        boost = PostInteraction.objects.create(
+            identity=booster, post=reply, type=PostInteraction.Types.boost
+        )
+        for post in [reply, poll]:
+            TimelineEvent.objects.create(
+                identity=identity, type=TimelineEvent.Types.post, subject_post=post
+            )
+            PostInteraction.objects.create(
+                identity=identity, post=post, type=PostInteraction.Types.like
+            )
+            Bookmark.objects.create(identity=identity, post=post)
+        TimelineEvent.objects.create(
+            identity=identity,
+            type=TimelineEvent.Types.boost,
+            subject_post=reply,
+            subject_post_interaction=boost,
+        )
+        PostInteraction.objects.create(
+            identity=identity,
+            post=poll,
+            type=PostInteraction.Types.vote,
+            value="Yes",
+        )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "endpoint",
+    [
+        "/api/v1/timelines/home",
+        "/api/v1/timelines/public",
+        "/api/v1/timelines/public?local=true",
+        "/api/v1/timelines/tag/tagged",
+        "/api/v1/accounts/{author}/statuses",
+        "/api/v1/bookmarks",
+        "/api/v1/favourites",
+    ],
+)
+def test_status_list_query_count(
+    api_client, identity, other_identity, identity2, endpoint
+):
+    """
+    Tests that serializing a page of statuses takes the same number of
+    queries however many statuses there are on it.
+    """
+    url = endpoint.format(author=other_identity.pk)
+
+    def count_queries() -> tuple[int, int]:
+        with CaptureQueriesContext(connection) as context:
+            response = api_client.get(url, {"limit": 40})
+        assert response.status_code == 200
+        return len(response.json()), len(context.captured_queries)
+
+    # Both authors (and so both domains) need to be on the first page, so
+    # the per-domain emoji cache is warmed up for them
+    make_statuses(2, identity, [other_identity, identity2], identity)
+    count_queries()
+    few_statuses, few_queries = count_queries()
+    make_statuses(4, identity, [other_identity, identity2], identity)
+    many_statuses, many_queries = count_queries()
+
+    assert many_statuses > few_statuses
+    assert many_queries == few_queries
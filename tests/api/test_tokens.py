@@ -1,4 +1,10 @@
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api.models import Token
+from users.models import Domain, User
 
 
 @pytest.mark.django_db
@@ -9,3 +15,65 @@ def test_has_scope(api_token):
     assert api_token.has_scope("read")
     assert api_token.has_scope("read:statuses")
     assert not api_token.has_scope("destroyearth")
+
+
+@pytest.mark.django_db
+def test_request_lookups_cached(api_client, api_token):
+    """
+    Tests that repeat requests reuse the cached domain and settings, and
+    check the token (with its user and identity) in one query, so revoking
+    it or banning its user from another process takes effect straight away
+    """
+    with CaptureQueriesContext(connection) as cold:
+        assert api_client.get("/api/v1/accounts/verify_credentials").status_code == 200
+    with CaptureQueriesContext(connection) as warm:
+        assert api_client.get("/api/v1/accounts/verify_credentials").status_code == 200
+    assert len(warm) < len(cold)
+    assert sum('"api_token"' in query["sql"] for query in warm.captured_queries) == 1
+
+    # Updated without invalidating anything, as another process would look
+    User.objects.filter(pk=api_token.user_id).update(banned=True)
+    assert api_client.get("/api/v1/accounts/verify_credentials").status_code == 400
+    User.objects.filter(pk=api_token.user_id).update(banned=False)
+    assert api_client.get("/api/v1/accounts/verify_credentials").status_code == 200
+    Token.objects.filter(pk=api_token.pk).update(revoked=timezone.now())
+    assert api_client.get("/api/v1/accounts/verify_credentials").status_code == 400
+
+
+@pytest.mark.django_db
+def test_request_lookups_shared(api_client, api_token, settings, monkeypatch):
+    """
+    Tests that with a shared lookup cache, tokens are cached too, and
+    revoking one takes effect straight away
+    """
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    monkeypatch.setattr(settings.SETUP, "LOOKUP_CACHE_SHARED", True)
+    assert api_client.get("/api/v1/accounts/verify_credentials").status_code == 200
+    with CaptureQueriesContext(connection) as warm:
+        assert api_client.get("/api/v1/accounts/verify_credentials").status_code == 200
+    assert not any('"api_token"' in query["sql"] for query in warm.captured_queries)
+
+    api_token.revoked = timezone.now()
+    api_token.save()
+    assert api_client.get("/api/v1/accounts/verify_credentials").status_code == 400
+
+
+@pytest.mark.django_db
+def test_domain_lookup_invalidation(domain):
+    """
+    Tests that cached domains are forgotten when they change
+    """
+    assert Domain.get_domain("Example.com", cached=True) == domain
+    domain.service_domain = "service.example.com"
+    domain.save()
+    assert Domain.get_domain("service.example.com", cached=True) == domain
+    domain.delete()
+    assert Domain.get_domain("example.com", cached=True) is None
+
+    # Making a domain the default is seen by lookups of the old default
+    Domain.objects.create(domain="other.example.com", local=True, default=True)
+    assert Domain.get_domain("other.example.com", cached=True).default
+    Domain.objects.create(domain="new.example.com", local=True).make_default()
+    assert not Domain.get_domain("other.example.com", cached=True).default
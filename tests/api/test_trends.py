@@ -0,0 +1,75 @@
+import pytest
+from django.conf import settings
+
+from activities.models import Post, Trend, TrendScore
+from activities.services import PostService
+
+
+@pytest.mark.django_db
+def test_trends(api_client, identity, identity2, stator):
+    """
+    Tests that tags, links and statuses are scored as posts and interactions
+    come in, and served from the refreshed lists.
+    """
+    hot = Post.create_local(
+        author=identity, content="Look #hot https://example.org/page"
+    )
+    Post.create_local(author=identity2, content="Also #hot https://example.org/page")
+    Post.create_local(author=identity2, content="Meanwhile #cold")
+    cold = Post.create_local(author=identity2, content="Just a post")
+    # Non-public posts don't count
+    Post.create_local(
+        author=identity,
+        content="Quiet #secret",
+        visibility=Post.Visibilities.followers,
+    )
+    # Stator may take a few cycles to get through all the posts
+    for _ in range(3):
+        stator.run_single_cycle()
+    PostService(hot).like_as(identity2)
+    PostService(hot).boost_as(identity2)
+    PostService(cold).like_as(identity)
+
+    assert TrendScore.objects.get(kind="tags", key="hot").score == pytest.approx(2)
+    assert not TrendScore.objects.filter(key="secret").exists()
+    for trend in Trend.objects.all():
+        trend.refresh()
+
+    response = api_client.get("/api/v1/trends/tags").json()
+    assert [tag["name"] for tag in response] == ["hot", "cold"]
+    response = api_client.get("/api/v1/trends/tags?limit=1&offset=1").json()
+    assert [tag["name"] for tag in response] == ["cold"]
+
+    response = api_client.get("/api/v1/trends/statuses").json()
+    assert [status["id"] for status in response] == [str(hot.pk), str(cold.pk)]
+
+    response = api_client.get("/api/v1/trends/links").json()
+    assert [link["url"] for link in response] == ["https://example.org/page"]
+    assert response[0]["provider_name"] == "example.org"
+
+    # Deleted posts drop out on the next refresh
+    PostService(hot).delete()
+    Trend.objects.get(kind="statuses").refresh()
+    response = api_client.get("/api/v1/trends/statuses").json()
+    assert [status["id"] for status in response] == [str(cold.pk)]
+
+
+@pytest.mark.django_db
+def test_trend_score_decay(config_system, monkeypatch):
+    """
+    Tests that scores decay by half-life and faded ones are forgotten.
+    """
+    monkeypatch.setattr(settings.SETUP, "TRENDS_HALF_LIFE", 1)
+    TrendScore.add("tags", ["old"], 1)
+    TrendScore.add("tags", ["new"], 1)
+    TrendScore.objects.filter(key="old").update(
+        scored=TrendScore.objects.get(key="old").scored.replace(year=2000)
+    )
+    # Adding to an old score decays it first
+    TrendScore.add("tags", ["old"], 1)
+    assert TrendScore.objects.get(key="old").score == pytest.approx(1)
+    TrendScore.objects.filter(key="old").update(
+        scored=TrendScore.objects.get(key="old").scored.replace(year=2000)
+    )
+    Trend.objects.get_or_create(kind="tags")[0].refresh()
+    assert list(TrendScore.objects.values_list("key", flat=True)) == ["new"]
@@ -4,11 +4,35 @@ import pytest
 from django.test import Client
 
 from api.models import Application, Token
+from core.lookups import LookupCache
 from core.models import Config
 from stator.runner import StatorModel, StatorRunner
 from users.models import Domain, Identity, User
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        help="Also run the (slow) benchmarks marked with @pytest.mark.benchmark",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: timing comparisons, only run with --benchmark"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
 @pytest.fixture
 def keypair():
     """
@@ -69,6 +93,16 @@ def _test_settings(settings):
     settings.MAIN_DOMAIN = "example.com"
 
 
+@pytest.fixture(autouse=True)
+def _clear_lookup_caches():
+    # Cached rows must not outlive the test database transaction
+    LookupCache.clear_all()
+    Domain.blocklist.expire()
+    yield
+    LookupCache.clear_all()
+    Domain.blocklist.expire()
+
+
 @pytest.fixture
 def config_system(keypair):
     Config.system = Config.SystemOptions(
@@ -1,7 +1,10 @@
 import pytest
+from django.core.cache import cache
 from django.template.defaultfilters import linebreaks_filter
 
-from core.html import FediverseHtmlParser
+from activities.models import Post
+from core import html
+from core.html import ContentRenderer, FediverseHtmlParser
 
 
 @pytest.mark.django_db
@@ -152,3 +155,63 @@ def test_parser_same_name_mentions(remote_identity, remote_identity2):
         == '<span class="h-card"><a href="https://remote.test/@test/" class="u-url mention" rel="nofollow noopener noreferrer" target="_blank">@<span>test</span></a></span> <span class="h-card"><a href="https://remote2.test/@test/" class="u-url mention" rel="nofollow noopener noreferrer" target="_blank">@<span>test</span></a></span>'
     )
     assert parser.plain_text == "@test @test"
+
+
+@pytest.mark.django_db
+def test_renderer_cache(identity, settings, monkeypatch):
+    """
+    Tests that rendered post HTML is reused until the post is edited
+    """
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    parses = []
+
+    class CountingParser(FediverseHtmlParser):
+        def __init__(self, *args, **kwargs):
+            parses.append(args[0])
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(html, "FediverseHtmlParser", CountingParser)
+    post = Post.create_local(author=identity, content="<p>Hello #world</p>")
+    original = post.content
+
+    # Rendering twice (or from another copy of the post) only parses once
+    first = post.safe_content_remote()
+    assert post.safe_content_remote() == first
+    assert Post.objects.get(pk=post.pk).safe_content_remote() == first
+    assert "/tags/world/" in first
+    assert len(parses) == 1
+
+    # The two modes are kept apart
+    assert post.safe_content_local() != first
+    assert len(parses) == 2
+
+    # Editing forgets the old renderings
+    post.edit_local(content="Goodbye")
+    assert cache.get(ContentRenderer.cache_key("post", post, original, False)) is None
+    assert "Goodbye" in post.safe_content_remote()
+    assert len(parses) == 3
+
+
+@pytest.mark.django_db
+def test_renderer_cache_saved(
+    identity, remote_identity, settings, django_assert_num_queries
+):
+    """
+    Tests that rendered post HTML is keyed without any queries, and is
+    rendered again once the post is saved (say, with different mentions)
+    """
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    post = Post.create_local(author=identity, content="Hi @test@remote.test")
+    assert "https://remote.test/@test/" in post.safe_content_remote()
+
+    post = Post.objects.get(pk=post.pk)
+    with django_assert_num_queries(0):
+        ContentRenderer.cache_key("post", post, post.content, False)
+
+    post.mentions.remove(remote_identity)
+    post.save()
+    assert "h-card" not in Post.objects.get(pk=post.pk).safe_content_remote()
@@ -0,0 +1,70 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from core.http import HostLimitedTransport, build_client, get_client, pool_stats
+
+
+def test_host_limited_transport():
+    """
+    Tests that requests to one host are capped while a response is open,
+    without holding up other hosts.
+    """
+    pool_stats.reset()
+    transport = HostLimitedTransport(
+        httpx.MockTransport(
+            lambda request: httpx.Response(200, stream=httpx.ByteStream(b"ok"))
+        ),
+        max_per_host=1,
+    )
+    client = httpx.Client(transport=transport, timeout=httpx.Timeout(1, pool=0.1))
+    with client.stream("GET", "https://remote.test/one"):
+        # The one slot for this host is held until the response closes
+        with pytest.raises(httpx.PoolTimeout):
+            client.get("https://remote.test/two")
+        assert client.get("https://other.test/").status_code == 200
+    assert client.get("https://remote.test/two").status_code == 200
+    assert pool_stats.requests == 3
+    assert pool_stats.host_waits == 1
+
+
+def test_get_client_shared():
+    """
+    Tests that the pooled client is shared within a process.
+    """
+    assert get_client() is get_client()
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def test_pool_misses():
+    """
+    Tests that only requests that had to open a new connection count as
+    pool misses.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OkHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    pool_stats.reset()
+    try:
+        with build_client() as client:
+            for _ in range(3):
+                client.get(f"http://127.0.0.1:{server.server_port}/")
+    finally:
+        server.shutdown()
+    assert pool_stats.requests == 3
+    assert pool_stats.misses == 1
+    assert pool_stats.hits == 2
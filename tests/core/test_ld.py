@@ -1,8 +1,11 @@
+import copy
 import datetime
+import json
 
 from dateutil.tz import tzutc
+from pyld import jsonld
 
-from core.ld import canonicalise, parse_ld_date
+from core.ld import canonical_cache, canonicalise, parse_ld_date
 
 
 def test_parse_ld_date():
@@ -106,3 +109,30 @@ def test_canonicalise_multiple_attachment():
     assert attachment[1]["type"] == "PropertyValue"
     assert attachment[1]["name"] == "Attachment 2"
     assert attachment[1]["value"] == "Test 2"
+
+
+def test_canonicalise_cached():
+    """
+    Tests that repeat documents come back identical to a full pyld
+    round-trip, and that callers can't mutate the cached copy.
+    """
+    data = {
+        "@context": [
+            "https://www.w3.org/ns/activitystreams",
+            {"toot": "http://joinmastodon.org/ns#", "Emoji": "toot:Emoji"},
+        ],
+        "id": "https://remote.test/notes/1",
+        "type": "Note",
+        "to": ["https://www.w3.org/ns/activitystreams#Public"],
+        "content": "<p>Hello</p>",
+        "tag": [{"type": "Emoji", "name": ":wave:"}],
+    }
+    expected = jsonld.compact(jsonld.expand(copy.deepcopy(data)), data["@context"])
+    canonical_cache.clear()
+    first = canonicalise(copy.deepcopy(data), include_security=True)
+    assert len(canonical_cache) == 1
+    first["to"] = "mutated"
+    second = canonicalise(copy.deepcopy(data), include_security=True)
+    third = canonicalise(copy.deepcopy(data))
+    assert second["to"] == "as:Public"
+    assert json.dumps(third) == json.dumps(expected)
@@ -2,7 +2,7 @@ import pytest
 from django.test.client import RequestFactory
 from pytest_httpx import HTTPXMock
 
-from core.signatures import HttpSignature, LDSignature, VerificationError
+from core.signatures import HttpSignature, LDSignature, RsaKeys, VerificationError
 
 
 def test_sign_ld(keypair):
@@ -136,3 +136,21 @@ def test_verify_http_bad_signature(keypair):
         HttpSignature.verify_request(
             fake_request, keypair["public_key"], skip_date=True
         )
+
+
+def test_key_cache(keypair):
+    """
+    Tests that parsed keys are reused, and that forgetting a key ID
+    evicts its entries.
+    """
+    RsaKeys.cache.clear()
+    key_id = keypair["public_key_id"]
+    first = RsaKeys.load_public_key(keypair["public_key"], key_id)
+    assert RsaKeys.load_public_key(keypair["public_key"], key_id) is first
+    RsaKeys.load_private_key(keypair["private_key"], key_id)
+    assert RsaKeys.cache.take() == {"hits": 1, "misses": 2}
+    assert RsaKeys.cache.hits == 0
+    # Rotating the key drops both the public and private copies
+    RsaKeys.forget(key_id)
+    assert not RsaKeys.cache.keys
+    assert RsaKeys.load_public_key(keypair["public_key"], key_id) is not first
@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+
+import httpx
+import pytest
+from django.conf import settings
+from django.test import RequestFactory
+from pytest_httpx import HTTPXMock
+
+from mediaproxy import cache as cache_module
+from mediaproxy.cache import get_cache, parse_range
+from mediaproxy.views import BaseProxyView
+
+URL = "https://remote.test/media/image.png"
+
+
+class ImageView(BaseProxyView):
+    def get_remote_url(self):
+        return URL
+
+
+@pytest.fixture
+def proxy(monkeypatch, tmp_path):
+    """
+    Returns a function that requests URL through a cached proxy view
+    """
+    monkeypatch.setattr(settings.SETUP, "MEDIA_PROXY_CACHE_DIR", str(tmp_path))
+    factory = RequestFactory()
+
+    def request(**headers):
+        response = ImageView.as_view()(factory.get("/proxy/", headers=headers))
+        if response.streaming:
+            response.body = b"".join(response.streaming_content)
+        else:
+            response.body = response.content
+        return response
+
+    return request
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    with pytest.raises(ValueError):
+        parse_range("bytes=100-", 100)
+
+
+def test_cache_and_revalidate(proxy, httpx_mock: HTTPXMock):
+    """
+    Tests that files are fetched once, served from disk (with ranges and
+    conditional requests), and revalidated once expired.
+    """
+    body = bytes(range(256)) * 1000
+    httpx_mock.add_response(
+        url=URL,
+        content=body,
+        headers={
+            "Content-Type": "image/png",
+            "Cache-Control": "public, max-age=60",
+            "ETag": '"v1"',
+            "Last-Modified": "Mon, 02 Jan 2023 00:00:00 GMT",
+        },
+    )
+    response = proxy()
+    assert response.status_code == 200
+    assert response.body == body
+    assert response["Content-Type"] == "image/png"
+    assert response["ETag"] == '"v1"'
+
+    # Now from disk
+    response = proxy()
+    assert response.body == body
+    assert response["Content-Length"] == str(len(body))
+    assert response["Accept-Ranges"] == "bytes"
+    response = proxy(Range="bytes=10-19")
+    assert response.status_code == 206
+    assert response["Content-Range"] == f"bytes 10-19/{len(body)}"
+    assert response.body == body[10:20]
+    assert proxy(Range=f"bytes={len(body)}-").status_code == 416
+    assert proxy(**{"If-None-Match": '"v1"'}).status_code == 304
+    assert len(httpx_mock.get_requests()) == 1
+
+    # Expire it; a 304 from the remote server keeps the cached copy
+    cache = get_cache()
+    assert cache
+    path = cache.paths(URL)[1]
+    meta = cache.read_meta(path, URL)
+    assert meta
+    meta["expires"] = time.time() - 1
+    cache.write_meta(path + ".json", meta)
+    httpx_mock.add_response(
+        url=URL, status_code=304, match_headers={"If-None-Match": '"v1"'}
+    )
+    assert proxy().body == body
+    assert len(httpx_mock.get_requests()) == 2
+    assert proxy().body == body
+    assert len(httpx_mock.get_requests()) == 2
+
+    # If the remote server goes away, we serve the stale copy
+    meta = cache.read_meta(path, URL)
+    assert meta
+    meta["expires"] = time.time() - 1
+    cache.write_meta(path + ".json", meta)
+    httpx_mock.add_exception(httpx.ConnectError("gone"))
+    assert proxy().body == body
+
+
+def test_coalesce_and_evict(proxy, monkeypatch, httpx_mock: HTTPXMock):
+    """
+    Tests that simultaneous requests share one fetch, and that the least
+    recently used files are dropped when over size.
+    """
+    calls = []
+
+    def slow_response(request: httpx.Request):
+        calls.append(request)
+        time.sleep(0.3)
+        return httpx.Response(200, content=b"x" * 1000)
+
+    httpx_mock.add_callback(slow_response, url=URL)
+    results: list[bytes] = []
+    threads = [
+        threading.Thread(target=lambda: results.append(proxy().body)) for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [b"x" * 1000] * 5
+    assert len(calls) == 1
+
+    # Fill it past the limit with other files
+    monkeypatch.setattr(settings.SETUP, "MEDIA_PROXY_CACHE_SIZE", 2500)
+    monkeypatch.setattr(cache_module, "MAX_OBJECT_FRACTION", 0.5)
+    cache = get_cache()
+    assert cache
+    httpx_mock.add_response(content=b"y" * 1000)
+    for i in range(3):
+        meta, path, downloading = cache.fetch(f"https://remote.test/{i}")
+        b"".join(cache.follow(path))
+    assert cache.read_meta(cache.paths(URL)[1], URL) is None
+    assert cache.scan_size() <= 2500
+
+
+def test_size_limit_and_failures(proxy, monkeypatch, httpx_mock: HTTPXMock):
+    """
+    Tests that files too big to cache are turned away, whether or not they
+    say how big they are, and that failed fetches always let go of their
+    claim on the URL.
+    """
+    monkeypatch.setattr(settings.SETUP, "MEDIA_PROXY_CACHE_SIZE", 10000)
+    cache = get_cache()
+    assert cache
+    path = cache.paths(URL)[1]
+
+    def leftovers():
+        return [
+            p for p in [path, path + ".part", path + ".part.json"] if os.path.exists(p)
+        ]
+
+    # Too big by its Content-Length
+    httpx_mock.add_response(url=URL, content=b"x" * 2000)
+    assert proxy().status_code == 502
+    assert leftovers() == []
+
+    # Too big once it's arrived; whoever was streaming it gets cut short
+    httpx_mock.add_callback(
+        lambda request: httpx.Response(
+            200, stream=httpx.ByteStream(b"x" * 2000), headers={}
+        ),
+        url=URL,
+    )
+    response = proxy()
+    assert response.status_code == 200
+    assert len(response.body) <= 1000
+    assert leftovers() == []
+
+    # Something unexpected going wrong mid-fetch
+    def broken(request):
+        raise RuntimeError("Unexpected")
+
+    httpx_mock.add_callback(broken, url=URL)
+    with pytest.raises(RuntimeError):
+        proxy()
+    assert leftovers() == []
+
+    # And it can be fetched again afterwards
+    httpx_mock.add_response(url=URL, content=b"x" * 500)
+    assert proxy().body == b"x" * 500
+    assert leftovers() == [path]
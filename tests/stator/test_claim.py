@@ -0,0 +1,98 @@
+import datetime
+import threading
+import time
+
+import pytest
+from django.db import connections
+from django.utils import timezone
+
+from activities.models import Hashtag
+
+
+def claim_all(runners: int, batch_size: int) -> tuple[list[str], float]:
+    """
+    Has `runners` threads (each with their own database connection) claim
+    batches until the queue is empty, returning what they claimed and how
+    long it took.
+    """
+    claimed: list[str] = []
+    lock = threading.Lock()
+    start = threading.Barrier(runners)
+
+    def runner():
+        try:
+            start.wait()
+            while True:
+                batch = Hashtag.transition_get_with_lock(
+                    batch_size, timezone.now() + datetime.timedelta(minutes=5)
+                )
+                if not batch:
+                    break
+                with lock:
+                    claimed.extend(instance.pk for instance in batch)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=runner) for _ in range(runners)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return claimed, time.perf_counter() - started
+
+
+def fill_queue(total: int):
+    """
+    Makes `total` hashtags needing a transition, except for three that are
+    locked or waiting on a retry (which must never be claimed).
+    """
+    Hashtag.objects.all().delete()
+    Hashtag.objects.bulk_create(Hashtag(hashtag=f"tag{i}") for i in range(total))
+    Hashtag.objects.filter(hashtag__in=["tag0", "tag1"]).update(
+        state_locked_until=timezone.now() + datetime.timedelta(minutes=5)
+    )
+    Hashtag.objects.filter(hashtag="tag2").update(
+        state_next_attempt=timezone.now() + datetime.timedelta(minutes=5)
+    )
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("runners", [1, 4])
+def test_concurrent_claim(runners):
+    """
+    Simulates several Stator runners claiming from one queue; each row must
+    be claimed exactly once, with nobody waiting on anyone else's locks.
+    """
+    fill_queue(500)
+    claimed, _ = claim_all(runners, batch_size=50)
+    assert len(claimed) == 500 - 3
+    assert len(set(claimed)) == len(claimed)
+    assert not {"tag0", "tag1", "tag2"} & set(claimed)
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_claim_benchmark(capsys):
+    """
+    Compares how fast 1, 2 and 4 runners empty a large queue between them.
+    Extra runners don't add CPU here, but claiming mustn't serialise on
+    locks, so throughput shouldn't fall away as they're added.
+    """
+    total = 5000
+    rates = {}
+    for runners in [1, 2, 4]:
+        fill_queue(total)
+        claimed, elapsed = claim_all(runners, batch_size=50)
+        assert len(claimed) == total - 3
+        assert len(set(claimed)) == len(claimed)
+        rates[runners] = len(claimed) / elapsed
+    with capsys.disabled():
+        print(
+            "\nRows claimed per second: "
+            + ", ".join(
+                f"{runners} runner(s) {rate:.0f}" for runners, rate in rates.items()
+            )
+        )
+    assert rates[2] > rates[1] * 0.5
+    assert rates[4] > rates[1] * 0.5
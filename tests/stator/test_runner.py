@@ -0,0 +1,269 @@
+import asyncio
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from django.conf import settings
+from django.utils import timezone
+
+from activities.models import FanOut, Hashtag, HashtagStates, Post
+from core.http import pool_stats
+from core.signatures import RsaKeys
+from stator.models import StatorMetric, Stats
+from stator.runner import AsyncStatorRunner, StatorRunner
+from users.models import User
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_runner_sync_handler(config_system):
+    """
+    Tests that the asyncio runner runs normal (sync) handlers through its
+    thread pool and applies their transitions.
+    """
+    Hashtag.objects.create(hashtag="sync")
+    runner = AsyncStatorRunner([Hashtag], concurrency=10, db_pool_size=2)
+    runner.run_single_cycle()
+
+    assert Hashtag.objects.get(hashtag="sync").state == HashtagStates.updated
+    assert runner.handled == {"activities.hashtag": 1}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_runner_coroutine_handler(config_system, monkeypatch):
+    """
+    Tests that coroutine handlers are awaited directly on the event loop.
+    """
+    calls = []
+
+    async def handle_outdated(cls, instance):
+        calls.append(instance.pk)
+        return cls.updated
+
+    monkeypatch.setattr(HashtagStates, "handle_outdated", classmethod(handle_outdated))
+    Hashtag.objects.create(hashtag="one")
+    Hashtag.objects.create(hashtag="two")
+    runner = AsyncStatorRunner([Hashtag], concurrency=10, db_pool_size=1)
+    runner.run_single_cycle()
+
+    assert sorted(calls) == ["one", "two"]
+    assert set(Hashtag.objects.values_list("state", flat=True)) == {"updated"}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_runner_cancelled(config_system, monkeypatch):
+    """
+    Tests that cancelling the asyncio runner (as Ctrl-C does) still lets
+    in-flight transitions finish and shuts the pool down.
+    """
+    started = asyncio.Event()
+
+    async def handle_outdated(cls, instance):
+        started.set()
+        await asyncio.sleep(0.2)
+        return cls.updated
+
+    monkeypatch.setattr(HashtagStates, "handle_outdated", classmethod(handle_outdated))
+    Hashtag.objects.create(hashtag="slow")
+    runner = AsyncStatorRunner([Hashtag], concurrency=10, db_pool_size=2)
+
+    async def run_then_cancel():
+        task = asyncio.create_task(runner.arun())
+        await started.wait()
+        task.cancel()
+        await task
+
+    asyncio.run(run_then_cancel())
+    assert Hashtag.objects.get(hashtag="slow").state == HashtagStates.updated
+    assert runner.executor._shutdown
+
+
+def test_shutdown_pool_busy_thread():
+    """
+    Tests that shutting the pool down doesn't wait forever on a thread
+    that's still busy.
+    """
+    runner = AsyncStatorRunner([Hashtag], db_pool_size=2)
+    runner.executor = ThreadPoolExecutor(max_workers=2)
+    release = threading.Event()
+    runner.executor.submit(release.wait)
+    started = time.monotonic()
+    runner.shutdown_pool(timeout=0.2)
+    assert time.monotonic() - started < 2
+    release.set()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_runner_remote_delivery(
+    identity, remote_identity, config_system, httpx_mock
+):
+    """
+    Tests that the asyncio runner sends remote FanOuts from the event loop,
+    through their async handler.
+    """
+    httpx_mock.add_response(url=remote_identity.inbox_uri, status_code=202)
+    post = Post.create_local(author=identity, content="<p>Hello</p>")
+    fan_out = FanOut.objects.create(
+        identity=remote_identity, type=FanOut.Types.post, subject_post=post
+    )
+    runner = AsyncStatorRunner([FanOut], concurrency=10, db_pool_size=1)
+    runner.run_single_cycle()
+
+    fan_out.refresh_from_db()
+    assert fan_out.state == "sent"
+    (request,) = httpx_mock.get_requests()
+    assert "Signature" in request.headers
+
+
+def test_allocate_slots():
+    """
+    Tests that free slots are shared by weight, after minimums, and never
+    beyond a model's capacity.
+    """
+    runner = StatorRunner(
+        [],
+        model_weights={"a": 3, "b": 1, "c": 0},
+        model_min_slots={"c": 2},
+    )
+    assert runner.allocate_slots(10, {"a": 20, "b": 20, "c": 20}, {}) == {
+        "a": 6,
+        "b": 2,
+        "c": 2,
+    }
+    # Minimums only count slots a model isn't already using
+    assert runner.allocate_slots(4, {"a": 20, "b": 20, "c": 20}, {"c": 2}) == {
+        "a": 3,
+        "b": 1,
+        "c": 0,
+    }
+    # A capped model's share goes to the others
+    assert runner.allocate_slots(8, {"a": 2, "b": 20}) == {"a": 2, "b": 6}
+
+    # Handing out one slot at a time still keeps to the weights over time
+    runner.slot_credits = {}
+    picked = []
+    for _ in range(8):
+        slots = runner.allocate_slots(1, {"a": 20, "b": 20})
+        picked.extend(label for label, number in slots.items() if number)
+    assert picked.count("a") == 6
+    assert picked.count("b") == 2
+
+
+@pytest.mark.django_db
+def test_lanes_and_latency(identity, remote_identity, config_system):
+    """
+    Tests that FanOuts to local users are picked up before remote ones, and
+    that the wait is recorded per lane.
+    """
+    post = Post.create_local(author=identity, content="<p>Hello</p>")
+    FanOut.objects.filter(subject_post=post).delete()
+    remote = FanOut.objects.create(
+        identity=remote_identity, type=FanOut.Types.post, subject_post=post
+    )
+    local = FanOut.objects.create(
+        identity=identity, type=FanOut.Types.post, subject_post=post
+    )
+    FanOut.objects.filter(pk=local.pk).update(
+        state_changed=timezone.now() - datetime.timedelta(seconds=30)
+    )
+    runner = StatorRunner([FanOut], model_weights={}, model_min_slots={})
+    runner.handled = {}
+
+    lock_expiry = timezone.now() + datetime.timedelta(seconds=60)
+    (first,) = FanOut.transition_get_with_lock(1, lock_expiry)
+    (second,) = FanOut.transition_get_with_lock(1, lock_expiry)
+    assert (first.pk, first.state_lane) == (local.pk, "local")
+    assert (second.pk, second.state_lane) == (remote.pk, "remote")
+
+    runner.record_pickup(FanOut, first)
+    runner.record_pickup(FanOut, second)
+    runner.submit_stats(FanOut)
+    latency = Stats.get_for_model(FanOut).most_recent_latency()
+    assert set(latency) == {"local", "remote"}
+    assert 30 <= latency["local"][0] < 60
+    assert latency["remote"][1] < 30
+
+
+@pytest.mark.django_db
+def test_metrics(client, config_system, monkeypatch):
+    """
+    Tests that transition outcomes and timings are stored per state and
+    exported on /metrics.
+    """
+    Hashtag.objects.create(hashtag="one")
+    Hashtag.objects.create(hashtag="two")
+    runner = StatorRunner([Hashtag], model_weights={}, model_min_slots={})
+    runner.handled = {}
+    runner.run_single_cycle()
+    runner.submit_stats(Hashtag)
+
+    metrics = {
+        metric.name: metric
+        for metric in StatorMetric.objects.filter(
+            model_label="activities.hashtag", state="outdated"
+        )
+    }
+    assert set(metrics) == {"success", "duration", "wait"}
+    assert metrics["success"].count == 2
+    assert sum(metrics["duration"].buckets.values()) == 2
+
+    # A second run adds to the totals rather than replacing them
+    Hashtag.objects.create(hashtag="three")
+    runner.run_single_cycle()
+    runner.submit_stats(Hashtag)
+    assert (
+        StatorMetric.objects.get(
+            model_label="activities.hashtag", state="outdated", name="success"
+        ).count
+        == 3
+    )
+
+    # So are the process's outbound HTTP pool and key cache counts
+    pool_stats.reset()
+    pool_stats.record_request()
+    pool_stats.record_request()
+    pool_stats.record_miss()
+    RsaKeys.cache.clear()
+    RsaKeys.cache.misses = 1
+    runner.submit_process_stats()
+    assert pool_stats.requests == 0
+
+    # Only admins can see them without a token
+    assert client.get("/metrics").status_code == 403
+    client.force_login(User.objects.create(email="admin@example.com", admin=True))
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.content.decode()
+    assert (
+        'stator_transitions_total{model="activities.hashtag",state="outdated",outcome="success"} 3'
+        in body
+    )
+    assert (
+        'stator_handler_duration_seconds_count{model="activities.hashtag",state="outdated"} 3'
+        in body
+    )
+    assert 'stator_queue_depth{model="activities.hashtag"} 0' in body
+    assert "stator_http_requests_total 2" in body
+    assert "stator_http_connections_opened_total 1" in body
+    assert "stator_key_cache_misses_total 1" in body
+
+    # Or with the token as a bearer token, but not in the query string
+    client.logout()
+    monkeypatch.setattr(settings.SETUP, "METRICS_TOKEN", "secret")
+    assert client.get("/metrics?token=secret").status_code == 403
+    assert client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code == 403
+    assert client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code == 200
+
+
+@pytest.mark.django_db
+def test_ready_count(config_system, monkeypatch):
+    """
+    Tests that the queue depth is exact while small, and falls back to an
+    estimate once it passes the limit.
+    """
+    for name in ["one", "two", "three"]:
+        Hashtag.objects.create(hashtag=name)
+    assert Hashtag.transition_ready_count() == 3
+    monkeypatch.setattr(settings.SETUP, "STATOR_QUEUE_COUNT_LIMIT", 2)
+    assert Hashtag.transition_ready_count() >= 2
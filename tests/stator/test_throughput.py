@@ -0,0 +1,143 @@
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from activities.models import FanOut, FanOutStates, Post
+from core.snowflake import Snowflake
+from stator.runner import AsyncStatorRunner, StatorRunner
+from users.models import Domain, Identity
+
+# How long each simulated remote inbox takes to answer, in seconds
+LATENCY = 0.25
+
+# How long each runner gets
+DURATION = 10
+
+
+# A remote server that answers every POST with a 202 after LATENCY. It runs
+# in its own process so it isn't competing with the runners for the GIL.
+SLOW_SERVER = """
+import asyncio, sys
+
+async def handle(reader, writer):
+    try:
+        while True:
+            head = await reader.readuntil(b"\\r\\n\\r\\n")
+            for line in head.split(b"\\r\\n"):
+                if line.lower().startswith(b"content-length:"):
+                    await reader.readexactly(int(line.split(b":")[1]))
+            await asyncio.sleep(float(sys.argv[1]))
+            writer.write(b"HTTP/1.1 202 Accepted\\r\\nContent-Length: 0\\r\\n\\r\\n")
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        writer.close()
+
+async def main():
+    server = await asyncio.start_server(handle, "0.0.0.0", 0, backlog=4096)
+    print(server.sockets[0].getsockname()[1], flush=True)
+    await server.serve_forever()
+
+asyncio.run(main())
+"""
+
+
+@pytest.fixture
+def slow_inboxes():
+    """
+    Runs the slow remote server, and returns its port
+    """
+    server = subprocess.Popen(
+        [sys.executable, "-c", SLOW_SERVER, str(LATENCY)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert server.stdout
+        yield int(server.stdout.readline())
+    finally:
+        server.kill()
+        server.wait()
+
+
+def measure(runner: StatorRunner, post: Post, targets: list[Identity]) -> float:
+    """
+    Runs the runner for DURATION over fresh fan-outs of the post to every
+    target, and returns how many it delivered per second.
+    """
+    FanOut.objects.all().delete()
+    FanOut.objects.bulk_create(
+        FanOut(identity=target, type=FanOut.Types.post, subject_post=post)
+        for target in targets
+    )
+    runner.minimum_loop_delay = 0.05
+    started = time.monotonic()
+    try:
+        runner.run()
+    finally:
+        signal.alarm(0)
+    elapsed = time.monotonic() - started
+    sent = FanOut.objects.filter(state=FanOutStates.sent).count()
+    assert sent < len(targets), "Ran out of work; add more targets"
+    return sent / elapsed
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("batch_size", [0, FanOut.DELIVERY_BATCH_SIZE])
+def test_runner_throughput(
+    identity, config_system, slow_inboxes, monkeypatch, batch_size, capsys
+):
+    """
+    Compares remote delivery throughput of the threaded and asyncio runners,
+    with every remote inbox taking LATENCY to answer. Spread over 100 hosts,
+    so the per-host limit doesn't decide it.
+    """
+    monkeypatch.setattr(FanOut, "DELIVERY_BATCH_SIZE", batch_size)
+    post = Post.create_local(author=identity, content="<p>Hello</p>")
+    # Sequential IDs, as this many random snowflakes at once would clash
+    first_id = Snowflake.generate_identity()
+    targets: list[Identity] = []
+    for host in range(100):
+        domain = Domain.objects.create(
+            domain=f"bench{host}.test", local=False, state="updated"
+        )
+        targets += Identity.objects.bulk_create(
+            Identity(
+                id=first_id + (host * 100 + i + 1) * 8,
+                actor_uri=f"https://{domain.domain}/{i}/",
+                inbox_uri=f"http://127.0.0.{host + 2}:{slow_inboxes}/{i}/inbox/",
+                username=f"user{i}",
+                domain=domain,
+                local=False,
+                state="updated",
+            )
+            for i in range(100)
+        )
+
+    threaded = measure(
+        StatorRunner(
+            [FanOut], concurrency=20, concurrency_per_model=20, run_for=DURATION
+        ),
+        post,
+        targets,
+    )
+    asyncio = measure(
+        AsyncStatorRunner(
+            [FanOut],
+            concurrency=200,
+            concurrency_per_model=200,
+            db_pool_size=4,
+            run_for=DURATION,
+        ),
+        post,
+        targets,
+    )
+    with capsys.disabled():
+        print(
+            f"\nBatch size {batch_size}: threaded (20 threads) {threaded:.0f}/s, "
+            f"asyncio (200 tasks, 4 DB threads) {asyncio:.0f}/s"
+        )
+    assert asyncio > threaded
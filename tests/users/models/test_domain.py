@@ -1,4 +1,8 @@
 import pytest
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from users.models import Domain
 
@@ -51,3 +55,52 @@ def test_recursive_block():
 
     # An unrelated domain should not be blocked
     assert not Domain.get_remote_domain("example.com").recursively_blocked()
+
+
+@pytest.mark.django_db
+def test_blocklist_refresh(monkeypatch, django_assert_num_queries):
+    """
+    Tests that block checks are answered from memory, and pick up changes
+    made by other processes once the refresh interval has passed
+    """
+    Domain.objects.create(domain="evil.com", local=False, blocked=True)
+    assert Domain.blocklist.blocked("EVIL.com")
+    with django_assert_num_queries(0):
+        assert Domain.blocklist.blocked("a.b.evil.com")
+        assert not Domain.blocklist.blocked("notevil.com")
+
+    # Another process blocks a domain, without going through save()
+    Domain.objects.create(domain="bad.org", local=False)
+    Domain.objects.filter(domain="bad.org").update(blocked=True, updated=timezone.now())
+    assert not Domain.blocklist.blocked("bad.org")
+    monkeypatch.setattr(settings.SETUP, "DOMAIN_BLOCKLIST_REFRESH", 0)
+    assert Domain.blocklist.blocked("bad.org")
+
+    # Unblocking through save() applies at once
+    monkeypatch.setattr(settings.SETUP, "DOMAIN_BLOCKLIST_REFRESH", 60)
+    domain = Domain.objects.get(domain="evil.com")
+    domain.blocked = False
+    domain.save()
+    assert not Domain.blocklist.blocked("a.b.evil.com")
+
+
+@pytest.mark.django_db
+def test_blocklist_large():
+    """
+    Tests that checks against a large blocklist are answered from memory,
+    without a query per check
+    """
+    Domain.objects.bulk_create(
+        Domain(domain=f"blocked{i}.example.org", local=False, blocked=True)
+        for i in range(5000)
+    )
+    Domain.blocklist.expire()
+    hostnames = [f"sub{i}.blocked{i}.example.org" for i in range(2500)] + [
+        f"sub{i}.allowed{i}.example.net" for i in range(2500)
+    ]
+    Domain.blocklist.blocked("warm.example.org")
+
+    with CaptureQueriesContext(connection) as queries:
+        results = [Domain.blocklist.blocked(hostname) for hostname in hostnames]
+    assert len(queries) == 0
+    assert results.count(True) == 2500
@@ -1,4 +1,5 @@
 import pytest
+from asgiref.sync import async_to_sync
 from pytest_httpx import HTTPXMock
 
 from core.models import Config
@@ -96,9 +97,11 @@ def test_identity_max_per_user(config_system, client):
 
 
 @pytest.mark.django_db
-def test_fetch_actor(httpx_mock, config_system):
+@pytest.mark.parametrize("use_async", [False, True])
+def test_fetch_actor(httpx_mock, config_system, use_async):
     """
-    Ensures that making identities via actor fetching works
+    Ensures that making identities via actor fetching works, both in
+    and out of the event loop
     """
     # Make a shell remote identity
     identity = Identity.objects.create(
@@ -186,7 +189,10 @@ def test_fetch_actor(httpx_mock, config_system):
             ],
         },
     )
-    identity.fetch_actor()
+    if use_async:
+        assert async_to_sync(identity.afetch_actor)()
+    else:
+        assert identity.fetch_actor()
 
     # Verify the data arrived
     identity = Identity.objects.get(pk=identity.pk)
@@ -0,0 +1,40 @@
+import threading
+
+import pytest
+from django.conf import settings
+from django.db import connections
+
+from users.models import InboxMessage
+from users.services import InboxService
+
+
+@pytest.mark.django_db(transaction=True)
+def test_enqueue_batched(monkeypatch):
+    """
+    Tests that inbox messages from concurrent requests are written out in
+    one batch, and that every request waits until its message is written
+    """
+    monkeypatch.setattr(settings.SETUP, "INBOX_BATCH_SIZE", 2)
+    monkeypatch.setattr(settings.SETUP, "INBOX_BATCH_SECONDS", 5)
+    written = []
+
+    def request(number):
+        try:
+            InboxService.enqueue({"type": "Test", "id": str(number)})
+            written.append(InboxMessage.objects.count())
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=request, args=[i]) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert written == [2, 2]
+    assert InboxService.batch is None
+
+    # A lone message is written once it's waited for company
+    monkeypatch.setattr(settings.SETUP, "INBOX_BATCH_SECONDS", 0.01)
+    InboxService.enqueue({"type": "Test", "id": "3"})
+    assert InboxMessage.objects.count() == 3
+    assert InboxService.batch is None
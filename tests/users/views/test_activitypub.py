@@ -1,6 +1,16 @@
+import importlib
+import logging
+
 import pytest
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.test import AsyncClient
+from django.urls import clear_url_caches, resolve
 
-from users.models import InboxMessage
+from takahe import urls
+from users.models import Follow, InboxMessage
+from users.services import InboxService
 
 
 @pytest.mark.django_db
@@ -112,3 +122,136 @@ def test_ignore_lemmy(client, identity):
     )
     assert num_inbox_messages == InboxMessage.objects.count()
     assert resp.status_code == 202
+
+
+@pytest.mark.django_db
+def test_inbox_queue_full(client, identity, monkeypatch):
+    """
+    Tests that the inbox asks senders to back off when the queue is too deep
+    """
+    monkeypatch.setattr(settings.SETUP, "INBOX_MAX_QUEUE", 1)
+    InboxService.depth_cache.clear()
+    InboxMessage.objects.create(message={"type": "Test"})
+    resp = client.post(
+        identity.inbox_uri,
+        data={"type": "Delete", "actor": "https://remote.test/test-actor/"},
+        content_type="application/activity+json",
+    )
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "60"
+
+
+@pytest.mark.django_db
+def test_inbox_deferred(client, identity, remote_identity, stator, monkeypatch):
+    """
+    Tests that deferred mode stores the raw message and Stator finishes
+    processing it.
+    """
+    monkeypatch.setattr(settings.SETUP, "INBOX_DEFERRED", True)
+    data = {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://remote.test/test-actor/follows/1/",
+        "type": "Follow",
+        "actor": remote_identity.actor_uri,
+        "object": identity.actor_uri,
+    }
+    resp = client.post(
+        identity.inbox_uri, data=data, content_type="application/activity+json"
+    )
+    assert resp.status_code == 202
+    message = InboxMessage.objects.get()
+    assert message.message == {"type": "__deferred__", "object": data}
+    stator.run_single_cycle()
+    message.refresh_from_db()
+    assert message.state == "processed"
+    assert message.message["type"] == "Follow"
+    assert Follow.objects.filter(source=remote_identity, target=identity).exists()
+
+    # Messages from blocked domains never make it in
+    remote_identity.domain.blocked = True
+    remote_identity.domain.save()
+    resp = client.post(
+        identity.inbox_uri, data=data, content_type="application/activity+json"
+    )
+    assert resp.status_code == 202
+    assert InboxMessage.objects.count() == 1
+
+
+@pytest.fixture
+def asgi(monkeypatch):
+    """
+    Loads the URLs and middleware as they are with TAKAHE_ASGI set
+    """
+    monkeypatch.setattr(settings, "ASGI", True)
+    monkeypatch.setattr(
+        settings,
+        "MIDDLEWARE",
+        [settings.ASYNC_MIDDLEWARE.get(name, name) for name in settings.MIDDLEWARE],
+    )
+    clear_url_caches()
+    importlib.reload(urls)
+    yield
+    monkeypatch.setattr(settings, "ASGI", False)
+    clear_url_caches()
+    importlib.reload(urls)
+
+
+def test_wsgi_views_sync():
+    """
+    Tests that the federation endpoints are plain sync views, with the usual
+    sync middleware, unless TAKAHE_ASGI is set
+    """
+    for path in ["/.well-known/webfinger", "/@test@example.com/", "/inbox/"]:
+        assert not iscoroutinefunction(resolve(path).func)
+    assert not set(settings.MIDDLEWARE) & set(settings.ASYNC_MIDDLEWARE.values())
+
+
+@pytest.mark.django_db
+def test_asgi_fast_path(identity, remote_identity, asgi, monkeypatch, caplog):
+    """
+    Tests the federation endpoints through the ASGI handler, and that the
+    middleware chain runs natively async (nothing adapted to sync)
+    """
+    monkeypatch.setattr(settings.SETUP, "INBOX_DEFERRED", True)
+    assert iscoroutinefunction(resolve("/.well-known/webfinger").func)
+    identity.generate_keypair()
+    # Django only logs adaptations in debug mode
+    with caplog.at_level(logging.DEBUG, logger="django.request"):
+        monkeypatch.setattr(settings, "DEBUG", True)
+        ASGIHandler().load_middleware(is_async=True)
+        monkeypatch.setattr(settings, "DEBUG", False)
+    assert "adapted" not in caplog.text
+
+    client = AsyncClient()
+
+    @async_to_sync
+    async def request(method, path, **kwargs):
+        return await getattr(client, method)(path, **kwargs)
+
+    response = request("get", "/.well-known/webfinger?resource=acct:test@example.com")
+    assert response.json()["subject"] == "acct:test@example.com"
+    assert request("head", "/.well-known/host-meta").status_code == 200
+    assert request("put", "/.well-known/host-meta").status_code == 405
+    response = request(
+        "get", "/@test@example.com/", headers={"Accept": "application/activity+json"}
+    )
+    assert response.json()["id"] == identity.actor_uri
+    assert "Accept" in response.headers["Vary"]
+    response = request("get", "/@test@example.com/")
+    assert response.status_code == 200
+    assert "Accept" in response.headers["Vary"]
+    response = request("get", "/nodeinfo/2.0/")
+    assert response.json()["usage"]["users"]["total"] == 1
+    response = request(
+        "post",
+        identity.inbox_uri,
+        data={
+            "id": "https://remote.test/test-actor/follows/2/",
+            "type": "Follow",
+            "actor": remote_identity.actor_uri,
+            "object": identity.actor_uri,
+        },
+        content_type="application/activity+json",
+    )
+    assert response.status_code == 202
+    assert InboxMessage.objects.get().message["type"] == "__deferred__"
@@ -1,4 +1,5 @@
 import pytest
+from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import Client
 from pytest_httpx import HTTPXMock
@@ -35,6 +36,7 @@ def test_import_following(
 
     # It should have made an inbox message to do that follow in the background
     assert InboxMessage.objects.count() == 1
+    assert InboxMessage.objects.get().message["object"]["type"] == "AddFollows"
 
     # Run stator to process it
     stator.run_single_cycle()
@@ -43,6 +45,74 @@ def test_import_following(
     assert identity.outbound_follows.filter(target=remote_identity).count() == 1
 
 
+@pytest.mark.django_db
+def test_import_following_grouped(
+    client_with_user: Client,
+    identity: Identity,
+    remote_identity: Identity,
+    stator: StatorRunner,
+    httpx_mock: HTTPXMock,
+    monkeypatch,
+):
+    """
+    Validates that follow imports are grouped by server, and worked through
+    a batch at a time
+    """
+    monkeypatch.setattr(settings.SETUP, "IMPORT_FOLLOW_BATCH", 1)
+    csv_file = SimpleUploadedFile(
+        "follows.csv",
+        b"Account address,Show boosts,Notify on new posts,Languages\n"
+        b"test@remote.test,true,false,\n"
+        b"@test@example2.com,false,false,\n"
+        b"test@REMOTE.test,true,false,\n",
+    )
+    response = client_with_user.post(
+        f"/@{identity.handle}/settings/import_export/",
+        {
+            "csv": csv_file,
+            "import_type": "following",
+        },
+    )
+    assert response.status_code == 302
+
+    # One message per server
+    messages = {
+        message.message["object"]["domain"]: message.message["object"]
+        for message in InboxMessage.objects.all()
+    }
+    assert set(messages) == {"remote.test", "example2.com"}
+    assert len(messages["remote.test"]["follows"]) == 2
+    assert messages["example2.com"]["follows"] == [
+        {"handle": "test@example2.com", "boosts": False}
+    ]
+
+    # Handling the remote.test one follows the first and queues the rest
+    IdentityService.handle_internal_add_follows(messages["remote.test"])
+    assert identity.outbound_follows.filter(target=remote_identity).count() == 1
+    assert InboxMessage.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_import_following_bad_format(
+    client_with_user: Client,
+    identity: Identity,
+):
+    """
+    Validates that malformed follow imports are rejected without queueing
+    """
+    csv_file = SimpleUploadedFile("follows.csv", b"Handle\ntest@remote.test\n")
+    response = client_with_user.post(
+        f"/@{identity.handle}/settings/import_export/",
+        {
+            "csv": csv_file,
+            "import_type": "following",
+        },
+    )
+    assert response.status_code == 302
+    assert response.url == ".?bad_format=following"
+    assert InboxMessage.objects.count() == 0
+
+
 @pytest.mark.django_db
 def test_export_following(
     client_with_user: Client,
@@ -63,7 +133,7 @@ def test_export_following(
     )
     assert response.status_code == 200
     assert (
-        response.content.strip()
+        b"".join(response.streaming_content).strip()
         == b"Account address,Show boosts,Notify on new posts,Languages\r\ntest@remote.test,true,false,"
     )
 
@@ -87,7 +157,10 @@ def test_export_followers(
         f"/@{identity.handle}/settings/import_export/followers.csv"
     )
     assert response.status_code == 200
-    assert response.content.strip() == b"Account address\r\ntest@example2.com"
+    assert (
+        b"".join(response.streaming_content).strip()
+        == b"Account address\r\ntest@example2.com"
+    )
 
 
 @pytest.mark.django_db
@@ -112,7 +185,10 @@ def test_export_blocks(
         f"/@{identity.handle}/settings/import_export/blocks.csv"
     )
     assert response.status_code == 200
-    assert response.content.strip() == b"Account address\r\ntest@example2.com"
+    assert (
+        b"".join(response.streaming_content).strip()
+        == b"Account address\r\ntest@example2.com"
+    )
 
     # Unblock should clear the CSV content
     IdentityService(identity).unblock(identity2)
@@ -124,7 +200,7 @@ def test_export_blocks(
         f"/@{identity.handle}/settings/import_export/blocks.csv"
     )
     assert response.status_code == 200
-    assert response.content.strip() == b"Account address"
+    assert b"".join(response.streaming_content).strip() == b"Account address"
 
 
 @pytest.mark.django_db
@@ -150,7 +226,7 @@ def test_export_mutes(
     )
     assert response.status_code == 200
     assert (
-        response.content.strip()
+        b"".join(response.streaming_content).strip()
         == b"Account address,Hide notifications\r\ntest@example2.com,false"
     )
 
@@ -166,7 +242,7 @@ def test_export_mutes(
     )
     assert response.status_code == 200
     assert (
-        response.content.strip()
+        b"".join(response.streaming_content).strip()
         == b"Account address,Hide notifications\r\ntest@example2.com,true"
     )
 
@@ -176,4 +252,7 @@ def test_export_mutes(
         f"/@{identity.handle}/settings/import_export/mutes.csv"
     )
     assert response.status_code == 200
-    assert response.content.strip() == b"Account address,Hide notifications"
+    assert (
+        b"".join(response.streaming_content).strip()
+        == b"Account address,Hide notifications"
+    )
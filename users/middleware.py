@@ -1,3 +1,4 @@
+from core.middleware import AsyncMiddlewareMixin
 from users.models import Domain
 
 
@@ -12,6 +13,24 @@ class DomainMiddleware:
     def __call__(self, request):
         request.domain = None
         if "host" in request.headers:
-            request.domain = Domain.get_domain(request.headers["host"])
+            request.domain = Domain.get_domain(request.headers["host"], cached=True)
         response = self.get_response(request)
         return response
+
+
+class AsyncDomainMiddleware(AsyncMiddlewareMixin):
+    """
+    DomainMiddleware, for running natively async under ASGI.
+    """
+
+    def process_request(self, request):
+        request.domain = None
+        if "host" in request.headers:
+            request.domain = Domain.get_domain(request.headers["host"], cached=True)
+
+    async def aprocess_request(self, request):
+        request.domain = None
+        if "host" in request.headers:
+            request.domain = await Domain.aget_domain(
+                request.headers["host"], cached=True
+            )
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0022_follow_request"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="domain",
+            name="delivery_failures",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="domain",
+            name="delivery_last_failure",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="domain",
+            name="delivery_retry_after",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
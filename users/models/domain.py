@@ -1,17 +1,25 @@
+import datetime
 import json
 import logging
+import random
 import re
 import ssl
+import threading
+import time
 from functools import cached_property
 from typing import Optional
 
 import httpx
 import pydantic
 import urlman
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 
+from core.http import get_client
+from core.lookups import LookupCache
 from core.models import Config
 from stator.models import State, StateField, StateGraph, StatorModel
 from users.schemas import NodeInfo
@@ -19,6 +27,87 @@ from users.schemas import NodeInfo
 logger = logging.getLogger(__name__)
 
 
+class DomainBlocklist:
+    """
+    The set of blocked domain names, held in memory so block checks don't
+    need a query.
+
+    Every DOMAIN_BLOCKLIST_REFRESH seconds it compares a version stamp (the
+    number of blocked domains and when the latest one changed) against the
+    database, and reloads the set if it has moved on. Saving a domain in
+    this process expires it straight away.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.domains: frozenset[str] = frozenset()
+        self.version: tuple | None = None
+        self.checked: float | None = None
+
+    def current_version(self) -> tuple:
+        stats = Domain.objects.filter(blocked=True).aggregate(
+            count=models.Count("pk"), latest=models.Max("updated")
+        )
+        return (stats["count"], stats["latest"])
+
+    def due(self) -> bool:
+        """
+        Returns if it's time to compare against the database again
+        """
+        return (
+            self.checked is None
+            or time.monotonic() - self.checked
+            >= settings.SETUP.DOMAIN_BLOCKLIST_REFRESH
+        )
+
+    def refresh(self):
+        """
+        Reloads the set if it's due a check and has changed
+        """
+        if not self.due():
+            return
+        with self.lock:
+            if not self.due():
+                return
+            version = self.current_version()
+            if version != self.version:
+                self.domains = frozenset(
+                    Domain.objects.filter(blocked=True).values_list("domain", flat=True)
+                )
+                self.version = version
+            self.checked = time.monotonic()
+
+    def expire(self):
+        """
+        Makes the next check compare against the database
+        """
+        self.checked = None
+
+    def matches(self, hostname: str) -> bool:
+        domains = self.domains
+        hostname = hostname.lower()
+        while hostname not in domains:
+            if "." not in hostname:
+                return False
+            hostname = hostname.split(".", 1)[1]
+        return True
+
+    def blocked(self, hostname: str) -> bool:
+        """
+        Returns if the hostname, or any domain it is under, is blocked
+        """
+        self.refresh()
+        return self.matches(hostname)
+
+    async def ablocked(self, hostname: str) -> bool:
+        """
+        Async version of blocked(); the occasional refresh runs in a thread
+        """
+        if self.due():
+            await sync_to_async(self.refresh)()
+        return self.matches(hostname)
+
+
 class DomainStates(StateGraph):
     outdated = State(try_interval=60 * 30, force_initial=True)
     updated = State(try_interval=60 * 60 * 24, attempt_immediately=False)
@@ -117,9 +206,20 @@ class Domain(StatorModel):
     # Free-form notes field for admins
     notes = models.TextField(blank=True, null=True)
 
+    # Outbound delivery health: how many deliveries in a row have failed,
+    # when the last one did, and (if the circuit is open) when to try again
+    delivery_failures = models.PositiveIntegerField(default=0)
+    delivery_last_failure = models.DateTimeField(null=True, blank=True)
+    delivery_retry_after = models.DateTimeField(null=True, blank=True)
+
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    # Domains by (lowercased) host name, for the request path
+    lookup_cache = LookupCache("domain")
+
+    blocklist = DomainBlocklist()
+
     class urls(urlman.Urls):
         root = "/admin/domains/"
         create = "/admin/domains/create/"
@@ -149,11 +249,32 @@ class Domain(StatorModel):
         return cls.objects.get_or_create(domain=domain.lower(), local=False)[0]
 
     @classmethod
-    def get_domain(cls, domain: str) -> Optional["Domain"]:
+    async def aget_remote_domain(cls, domain: str) -> "Domain":
+        return (await cls.objects.aget_or_create(domain=domain.lower(), local=False))[0]
+
+    @classmethod
+    def get_domain(cls, domain: str, cached: bool = False) -> Optional["Domain"]:
+        domain = domain.lower()
+        if cached:
+            return cls.lookup_cache.get(domain, lambda: cls.get_domain(domain))
         try:
             return cls.objects.get(
-                models.Q(domain=domain.lower())
-                | models.Q(service_domain=domain.lower())
+                models.Q(domain=domain) | models.Q(service_domain=domain)
+            )
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    async def aget_domain(cls, domain: str, cached: bool = False) -> Optional["Domain"]:
+        """
+        Async version of get_domain()
+        """
+        domain = domain.lower()
+        if cached:
+            return await cls.lookup_cache.aget(domain, lambda: cls.aget_domain(domain))
+        try:
+            return await cls.objects.aget(
+                models.Q(domain=domain) | models.Q(service_domain=domain)
             )
         except cls.DoesNotExist:
             return None
@@ -188,7 +309,36 @@ class Domain(StatorModel):
                 raise ValueError(
                     f"Service domain {self.service_domain} is already a domain elsewhere!"
                 )
+        previous = (
+            Domain.objects.filter(pk=self.pk)
+            .values_list("domain", "service_domain", "blocked")
+            .first()
+        )
+        if previous:
+            self.lookup_cache.invalidate(previous[0], previous[1])
         super().save(*args, **kwargs)
+        self.lookup_cache.invalidate(self.domain, self.service_domain)
+        if self.blocked or (previous and previous[2]):
+            self.blocklist.expire()
+
+    def delete(self, *args, **kwargs):
+        self.lookup_cache.invalidate(self.domain, self.service_domain)
+        if self.blocked:
+            self.blocklist.expire()
+        return super().delete(*args, **kwargs)
+
+    def make_default(self):
+        """
+        Unsets default on every other domain, so this is the only one
+        """
+        others = Domain.objects.filter(default=True).exclude(pk=self.pk)
+        hosts = [
+            host
+            for pair in others.values_list("domain", "service_domain")
+            for host in pair
+        ]
+        others.update(default=False)
+        self.lookup_cache.invalidate(*hosts)
 
     def fetch_nodeinfo(self) -> NodeInfo | None:
         """
@@ -196,71 +346,68 @@ class Domain(StatorModel):
         """
         nodeinfo20_url = f"https://{self.domain}/nodeinfo/2.0"
 
-        with httpx.Client(
-            timeout=settings.SETUP.REMOTE_TIMEOUT,
-            headers={"User-Agent": settings.TAKAHE_USER_AGENT},
-        ) as client:
+        client = get_client()
+        try:
+            response = client.get(
+                f"https://{self.domain}/.well-known/nodeinfo",
+                follow_redirects=True,
+                headers={"Accept": "application/json"},
+            )
+        except httpx.HTTPError:
+            pass
+        except (ssl.SSLCertVerificationError, ssl.SSLError):
+            return None
+        else:
             try:
-                response = client.get(
-                    f"https://{self.domain}/.well-known/nodeinfo",
-                    follow_redirects=True,
-                    headers={"Accept": "application/json"},
-                )
-            except httpx.HTTPError:
+                for link in response.json().get("links", []):
+                    if (
+                        link.get("rel")
+                        == "http://nodeinfo.diaspora.software/ns/schema/2.0"
+                    ):
+                        nodeinfo20_url = link.get("href", nodeinfo20_url)
+                        break
+            except json.JSONDecodeError:
                 pass
-            except (ssl.SSLCertVerificationError, ssl.SSLError):
-                return None
-            else:
-                try:
-                    for link in response.json().get("links", []):
-                        if (
-                            link.get("rel")
-                            == "http://nodeinfo.diaspora.software/ns/schema/2.0"
-                        ):
-                            nodeinfo20_url = link.get("href", nodeinfo20_url)
-                            break
-                except json.JSONDecodeError:
-                    pass
-
-            try:
-                response = client.get(
-                    nodeinfo20_url,
-                    follow_redirects=True,
-                    headers={"Accept": "application/json"},
-                )
-                response.raise_for_status()
-            except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
-                response = getattr(ex, "response", None)
-                if (
-                    response
-                    and response.status_code < 500
-                    and response.status_code not in [401, 403, 404, 406, 410]
-                ):
-                    logger.warning(
-                        "Client error fetching nodeinfo: %d %s %s",
-                        response.status_code,
-                        nodeinfo20_url,
-                        ex,
-                        extra={
-                            "content": response.content,
-                            "domain": self.domain,
-                        },
-                    )
-                return None
 
-            try:
-                info = NodeInfo(**response.json())
-            except (json.JSONDecodeError, pydantic.ValidationError) as ex:
+        try:
+            response = client.get(
+                nodeinfo20_url,
+                follow_redirects=True,
+                headers={"Accept": "application/json"},
+            )
+            response.raise_for_status()
+        except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
+            response = getattr(ex, "response", None)
+            if (
+                response
+                and response.status_code < 500
+                and response.status_code not in [401, 403, 404, 406, 410]
+            ):
                 logger.warning(
-                    "Client error decoding nodeinfo: %s %s",
+                    "Client error fetching nodeinfo: %d %s %s",
+                    response.status_code,
                     nodeinfo20_url,
                     ex,
                     extra={
+                        "content": response.content,
                         "domain": self.domain,
                     },
                 )
-                return None
-            return info
+            return None
+
+        try:
+            info = NodeInfo(**response.json())
+        except (json.JSONDecodeError, pydantic.ValidationError) as ex:
+            logger.warning(
+                "Client error decoding nodeinfo: %s %s",
+                nodeinfo20_url,
+                ex,
+                extra={
+                    "domain": self.domain,
+                },
+            )
+            return None
+        return info
 
     @property
     def software(self):
@@ -282,12 +429,61 @@ class Domain(StatorModel):
         # Efficient short-circuit
         if self.blocked:
             return True
-        # Build domain list
-        domain_parts = [self.domain]
-        while "." in domain_parts[-1]:
-            domain_parts.append(domain_parts[-1].split(".", 1)[1])
-        # See if any of those are blocked
-        return Domain.objects.filter(domain__in=domain_parts, blocked=True).exists()
+        return self.blocklist.blocked(self.domain)
+
+    ### Delivery health ###
+
+    @classmethod
+    def delivery_backoff(cls, failures: int) -> float:
+        """
+        Returns how many seconds to wait before retrying after `failures`
+        failures in a row: exponential, capped, with jitter so everything
+        queued for one server doesn't retry at the same moment.
+        """
+        base = settings.SETUP.DELIVERY_BACKOFF_BASE
+        ceiling = settings.SETUP.DELIVERY_BACKOFF_MAX
+        backoff = min(ceiling, base * 2 ** min(max(failures - 1, 0), 32))
+        return backoff * random.uniform(0.5, 1.0)
+
+    @classmethod
+    def record_delivery_success(cls, domain: str):
+        """
+        Closes the circuit for a domain after a delivery got through.
+        """
+        cls.objects.filter(domain=domain, delivery_failures__gt=0).update(
+            delivery_failures=0,
+            delivery_retry_after=None,
+        )
+
+    @classmethod
+    def record_delivery_failure(cls, domain: str) -> float:
+        """
+        Counts a failed delivery to a domain, opening its circuit if it has
+        now failed too many times in a row. Returns how long to wait before
+        retrying the delivery.
+        """
+        now = timezone.now()
+        cls.objects.filter(domain=domain).update(
+            delivery_failures=models.F("delivery_failures") + 1,
+            delivery_last_failure=now,
+        )
+        failures = (
+            cls.objects.filter(domain=domain)
+            .values_list("delivery_failures", flat=True)
+            .first()
+        ) or 1
+        backoff = cls.delivery_backoff(failures)
+        if failures >= settings.SETUP.DELIVERY_CIRCUIT_THRESHOLD:
+            cls.objects.filter(domain=domain).update(
+                delivery_retry_after=now + datetime.timedelta(seconds=backoff)
+            )
+        return backoff
+
+    @property
+    def delivery_circuit_open(self) -> bool:
+        return bool(
+            self.delivery_retry_after and self.delivery_retry_after > timezone.now()
+        )
 
     ### Config ###
 
@@ -1,12 +1,12 @@
 import logging
 import ssl
+from collections.abc import Iterable
 from functools import cached_property, partial
 from typing import Literal, Optional
 from urllib.parse import urlparse
 
 import httpx
 import urlman
-from django.conf import settings
 from django.db import IntegrityError, models, transaction
 from django.utils import timezone
 from django.utils.functional import lazy
@@ -14,6 +14,7 @@ from lxml import etree
 
 from core.exceptions import ActorMismatchError
 from core.html import ContentRenderer, FediverseHtmlParser
+from core.http import get_async_client, get_client
 from core.json import json_from_response
 from core.ld import (
     canonicalise,
@@ -22,6 +23,7 @@ from core.ld import (
     get_list,
     media_type_from_filename,
 )
+from core.lookups import LookupCache
 from core.models import Config
 from core.signatures import HttpSignature, RsaKeys
 from core.snowflake import Snowflake
@@ -33,7 +35,7 @@ from core.uris import (
     StaticAbsoluteUrl,
 )
 from stator.exceptions import TryAgainLater
-from stator.models import State, StateField, StateGraph, StatorModel
+from stator.models import State, StateField, StateGraph, StatorModel, in_db_pool
 from users.models.domain import Domain
 from users.models.inbox_message import InboxMessage
 from users.models.system_actor import SystemActor
@@ -83,6 +85,7 @@ class IdentityStates(StateGraph):
 
         # Fan out to each target
         shared_inboxes = set()
+        fan_outs = []
         for follower in Follow.objects.select_related("source", "target").filter(
             target=identity
         ):
@@ -91,12 +94,15 @@ class IdentityStates(StateGraph):
             if shared_uri and shared_uri in shared_inboxes:
                 continue
 
-            FanOut.objects.create(
-                identity=follower.source,
-                type=type_,
-                subject_identity=identity,
+            fan_outs.append(
+                FanOut(
+                    identity=follower.source,
+                    type=type_,
+                    subject_identity=identity,
+                )
             )
             shared_inboxes.add(shared_uri)
+        FanOut.objects.bulk_create(fan_outs)
 
     @classmethod
     def handle_edited(cls, instance: "Identity"):
@@ -172,6 +178,13 @@ class IdentityStates(StateGraph):
         if identity.fetch_actor():
             return cls.updated
 
+    @classmethod
+    async def ahandle_outdated(cls, identity: "Identity"):
+        if identity.local:
+            return cls.updated
+        if await identity.afetch_actor():
+            return cls.updated
+
     @classmethod
     def handle_updated(cls, instance: "Identity"):
         if not instance.local and instance.state_age > Config.system.identity_max_age:
@@ -280,6 +293,9 @@ class Identity(StatorModel):
 
     objects = IdentityManager()
 
+    # Identities by pk, for the request path
+    lookup_cache = LookupCache("identity")
+
     ### Model attributes ###
 
     class Meta:
@@ -311,6 +327,14 @@ class Identity(StatorModel):
             return self.handle
         return self.actor_uri
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.lookup_cache.invalidate(self.pk)
+
+    def delete(self, *args, **kwargs):
+        self.lookup_cache.invalidate(self.pk)
+        return super().delete(*args, **kwargs)
+
     def absolute_profile_uri(self):
         """
         Returns a profile URI that is always absolute, for sending out to
@@ -401,6 +425,17 @@ class Identity(StatorModel):
 
     ### Alternate constructors/fetchers ###
 
+    @classmethod
+    def get_cached(cls, pk: int | None) -> Optional["Identity"]:
+        """
+        Returns the Identity with this pk, with its domain (cached)
+        """
+        if pk is None:
+            return None
+        return cls.lookup_cache.get(
+            pk, lambda: cls.objects.select_related("domain").filter(pk=pk).first()
+        )
+
     @classmethod
     def by_handle(cls, handle, fetch: bool = False) -> Optional["Identity"]:
         username, domain = handle.lstrip("@").split("@", 1)
@@ -454,25 +489,51 @@ class Identity(StatorModel):
             except cls.DoesNotExist:
                 if fetch and not local:
                     actor_uri, handle = cls.fetch_webfinger(f"{username}@{domain}")
-                    if handle is None:
+                    if actor_uri is None or handle is None:
                         return None
-                    # See if this actually does match an existing actor
-                    try:
-                        return cls.objects.get(actor_uri=actor_uri)
-                    except cls.DoesNotExist:
-                        pass
-                    # OK, make one
-                    username, domain = handle.split("@")
-                    if not domain_instance:
-                        domain_instance = Domain.get_remote_domain(domain)
-                    return cls.objects.create(
-                        actor_uri=actor_uri,
-                        username=username,
-                        domain_id=domain_instance,
-                        local=False,
-                    )
+                    return cls.by_webfinger(actor_uri, handle, domain_instance)
                 return None
 
+    @classmethod
+    async def aby_username_and_domain(
+        cls, username: str, domain: Domain
+    ) -> Optional["Identity"]:
+        """
+        Async version of by_username_and_domain(), for identities we already
+        know about (no fetching)
+        """
+        if username.startswith("@"):
+            raise ValueError("Username must not start with @")
+        filters = {"username__iexact": username, "domain_id": domain.domain}
+        if domain.local:
+            filters["local"] = True
+        try:
+            return await cls.objects.select_related("domain").aget(**filters)
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def by_webfinger(
+        cls, actor_uri: str, handle: str, domain: Domain | None = None
+    ) -> "Identity":
+        """
+        Returns the Identity for the results of a webfinger lookup, making a
+        new one if it doesn't match an existing actor.
+        """
+        try:
+            return cls.objects.get(actor_uri=actor_uri)
+        except cls.DoesNotExist:
+            pass
+        username, domain_name = handle.split("@")
+        if not domain:
+            domain = Domain.get_remote_domain(domain_name)
+        return cls.objects.create(
+            actor_uri=actor_uri,
+            username=username,
+            domain_id=domain,
+            local=False,
+        )
+
     @classmethod
     def by_actor_uri(cls, uri, create=False, transient=False) -> "Identity":
         try:
@@ -500,6 +561,16 @@ class Identity(StatorModel):
     def name_or_handle(self):
         return self.name or self.handle
 
+    def invalidate_rendered_content(self):
+        """
+        Forgets any cached renderings of the profile; call before changing it.
+        """
+        contents = [("summary", self.summary), ("data", self.name_or_handle)]
+        for data in self.metadata or []:
+            contents.extend([("data", data["name"]), ("data", data["value"])])
+        ContentRenderer.invalidate(self, contents)
+        self.__dict__.pop("html_name_or_handle", None)
+
     @cached_property
     def html_name_or_handle(self):
         """
@@ -716,7 +787,9 @@ class Identity(StatorModel):
 
         # Remove all login tokens
         Authorization.objects.filter(identity=self).delete()
-        Token.objects.filter(identity=self).delete()
+        tokens = Token.objects.filter(identity=self)
+        Token.lookup_cache.invalidate(*tokens.values_list("token", flat=True))
+        tokens.delete()
         # Remove all users from ourselves and mark deletion date
         self.users.set([])
         self.deleted = timezone.now()
@@ -732,73 +805,134 @@ class Identity(StatorModel):
         Given a domain (hostname), returns the correct webfinger URL to use
         based on probing host-meta.
         """
-        with httpx.Client(
-            timeout=settings.SETUP.REMOTE_TIMEOUT,
-            headers={"User-Agent": settings.TAKAHE_USER_AGENT},
-        ) as client:
+        try:
+            response = get_client().get(
+                f"https://{domain}/.well-known/host-meta",
+                follow_redirects=True,
+                headers={"Accept": "application/xml"},
+            )
+        except httpx.RequestError:
+            response = None
+        return cls.webfinger_url_from_host_meta(domain, response)
+
+    @classmethod
+    async def afetch_webfinger_url(cls, domain: str):
+        """
+        Async version of fetch_webfinger_url
+        """
+        try:
+            response = await get_async_client().get(
+                f"https://{domain}/.well-known/host-meta",
+                follow_redirects=True,
+                headers={"Accept": "application/xml"},
+            )
+        except httpx.RequestError:
+            response = None
+        return cls.webfinger_url_from_host_meta(domain, response)
+
+    @classmethod
+    def webfinger_url_from_host_meta(
+        cls, domain: str, response: httpx.Response | None
+    ) -> str:
+        # In the case of anything other than a success, we'll still try
+        # hitting the webfinger URL on the domain we were given to handle
+        # incorrectly setup servers.
+        if (
+            response is not None
+            and response.status_code == 200
+            and response.content.strip()
+        ):
             try:
-                response = client.get(
-                    f"https://{domain}/.well-known/host-meta",
-                    follow_redirects=True,
-                    headers={"Accept": "application/xml"},
+                tree = etree.fromstring(response.content)
+                template = tree.xpath(
+                    "string(.//*[local-name() = 'Link' and @rel='lrdd' and (not(@type) or @type='application/jrd+json')]/@template)"
                 )
-
-                # In the case of anything other than a success, we'll still try
-                # hitting the webfinger URL on the domain we were given to handle
-                # incorrectly setup servers.
-                if response.status_code == 200 and response.content.strip():
-                    tree = etree.fromstring(response.content)
-                    template = tree.xpath(
-                        "string(.//*[local-name() = 'Link' and @rel='lrdd' and (not(@type) or @type='application/jrd+json')]/@template)"
-                    )
-                    if template:
-                        return template
-            except (httpx.RequestError, etree.ParseError):
+                if template:
+                    return template
+            except etree.ParseError:
                 pass
 
         return f"https://{domain}/.well-known/webfinger?resource={{uri}}"
 
     @classmethod
-    def fetch_webfinger(cls, handle: str) -> tuple[str | None, str | None]:
+    def fetch_webfinger(
+        cls, handle: str, webfinger_url: str | None = None
+    ) -> tuple[str | None, str | None]:
         """
         Given a username@domain handle, returns a tuple of
         (actor uri, canonical handle) or None, None if it does not resolve.
+
+        Pass webfinger_url (from fetch_webfinger_url) when looking up several
+        handles on one domain, so it's only worked out once.
         """
-        domain = handle.split("@")[1].lower()
-        try:
-            webfinger_url = cls.fetch_webfinger_url(domain)
-        except ssl.SSLCertVerificationError:
-            return None, None
+        if webfinger_url is None:
+            domain = handle.split("@")[1].lower()
+            try:
+                webfinger_url = cls.fetch_webfinger_url(domain)
+            except ssl.SSLCertVerificationError:
+                return None, None
 
         # Go make a Webfinger request
-        with httpx.Client(
-            timeout=settings.SETUP.REMOTE_TIMEOUT,
-            headers={"User-Agent": settings.TAKAHE_USER_AGENT},
-        ) as client:
+        try:
+            response = get_client().get(
+                webfinger_url.format(uri=f"acct:{handle}"),
+                follow_redirects=True,
+                headers={"Accept": "application/json"},
+            )
+            response.raise_for_status()
+        except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
+            return cls.webfinger_error(ex)
+        return cls.parse_webfinger(response)
+
+    @classmethod
+    async def afetch_webfinger(
+        cls, handle: str, webfinger_url: str | None = None
+    ) -> tuple[str | None, str | None]:
+        """
+        Async version of fetch_webfinger
+        """
+        if webfinger_url is None:
+            domain = handle.split("@")[1].lower()
             try:
-                response = client.get(
-                    webfinger_url.format(uri=f"acct:{handle}"),
-                    follow_redirects=True,
-                    headers={"Accept": "application/json"},
-                )
-                response.raise_for_status()
-            except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
-                response = getattr(ex, "response", None)
-                if isinstance(ex, httpx.TimeoutException) or (
-                    response and response.status_code in [408, 429, 504]
-                ):
-                    raise TryAgainLater() from ex
-                elif (
-                    response
-                    and response.status_code < 500
-                    and response.status_code not in [400, 401, 403, 404, 406, 410]
-                ):
-                    raise ValueError(
-                        f"Client error fetching webfinger: {response.status_code}",
-                        response.content,
-                    )
+                webfinger_url = await cls.afetch_webfinger_url(domain)
+            except ssl.SSLCertVerificationError:
                 return None, None
 
+        try:
+            response = await get_async_client().get(
+                webfinger_url.format(uri=f"acct:{handle}"),
+                follow_redirects=True,
+                headers={"Accept": "application/json"},
+            )
+            response.raise_for_status()
+        except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
+            return cls.webfinger_error(ex)
+        return cls.parse_webfinger(response)
+
+    @classmethod
+    def webfinger_error(cls, ex: Exception) -> tuple[None, None]:
+        """
+        Handles a failed Webfinger request: raises if it's worth trying again
+        or looks like our fault, and otherwise it just doesn't resolve.
+        """
+        response = getattr(ex, "response", None)
+        if isinstance(ex, httpx.TimeoutException) or (
+            response and response.status_code in [408, 429, 504]
+        ):
+            raise TryAgainLater() from ex
+        elif (
+            response
+            and response.status_code < 500
+            and response.status_code not in [400, 401, 403, 404, 406, 410]
+        ):
+            raise ValueError(
+                f"Client error fetching webfinger: {response.status_code}",
+                response.content,
+            )
+        return None, None
+
+    @classmethod
+    def parse_webfinger(cls, response: httpx.Response) -> tuple[str | None, str | None]:
         try:
             data = response.json()
         except ValueError:
@@ -828,33 +962,30 @@ class Identity(StatorModel):
         """
         Fetch an identity's featured collection.
         """
-        with httpx.Client(
-            timeout=settings.SETUP.REMOTE_TIMEOUT,
-            headers={"User-Agent": settings.TAKAHE_USER_AGENT},
-        ) as client:
-            try:
-                response = client.get(
-                    uri,
-                    follow_redirects=True,
-                    headers={"Accept": "application/activity+json"},
+        client = get_client()
+        try:
+            response = client.get(
+                uri,
+                follow_redirects=True,
+                headers={"Accept": "application/activity+json"},
+            )
+            response.raise_for_status()
+        except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
+            response = getattr(ex, "response", None)
+            if isinstance(ex, httpx.TimeoutException) or (
+                response and response.status_code in [408, 429, 504]
+            ):
+                raise TryAgainLater() from ex
+            elif (
+                response
+                and response.status_code < 500
+                and response.status_code not in [401, 403, 404, 406, 410]
+            ):
+                raise ValueError(
+                    f"Client error fetching featured collection: {response.status_code}",
+                    response.content,
                 )
-                response.raise_for_status()
-            except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
-                response = getattr(ex, "response", None)
-                if isinstance(ex, httpx.TimeoutException) or (
-                    response and response.status_code in [408, 429, 504]
-                ):
-                    raise TryAgainLater() from ex
-                elif (
-                    response
-                    and response.status_code < 500
-                    and response.status_code not in [401, 403, 404, 406, 410]
-                ):
-                    raise ValueError(
-                        f"Client error fetching featured collection: {response.status_code}",
-                        response.content,
-                    )
-                return []
+            return []
 
         try:
             data = canonicalise(response.json(), include_security=True)
@@ -888,8 +1019,6 @@ class Identity(StatorModel):
         Fetches the user's actor information, as well as their domain from
         webfinger if it's available.
         """
-        from activities.models import Emoji
-
         if self.local:
             raise ValueError("Cannot fetch local identities")
         try:
@@ -901,10 +1030,74 @@ class Identity(StatorModel):
             raise TryAgainLater()
         except (httpx.RequestError, ssl.SSLCertVerificationError):
             return False
+        document = self.actor_document(response)
+        if document is None:
+            return False
+        # Now go do webfinger with that info to see if we can get a canonical domain
+        webfinger_handle = None
+        handle = self.actor_handle(document)
+        if handle:
+            try:
+                webfinger_handle = self.fetch_webfinger(handle)[1]
+            except TryAgainLater:
+                # continue with original domain when webfinger times out
+                logger.info("WebFinger timed out: %s", self.actor_uri)
+            except ValueError as exc:
+                logger.info(
+                    "Can't parse WebFinger: %s %s",
+                    exc.args[0],
+                    self.actor_uri,
+                    exc_info=exc,
+                )
+                return False
+        return self.apply_actor(document, webfinger_handle)
+
+    async def afetch_actor(self) -> bool:
+        """
+        Async version of fetch_actor: the actor and webfinger requests wait
+        on the event loop, and only handling their results uses the database
+        pool.
+        """
+        if self.local:
+            raise ValueError("Cannot fetch local identities")
+        try:
+            response = await SystemActor().asigned_request(
+                method="get",
+                uri=self.actor_uri,
+            )
+        except httpx.TimeoutException:
+            raise TryAgainLater()
+        except (httpx.RequestError, ssl.SSLCertVerificationError):
+            return False
+        document = await in_db_pool(self.actor_document, response)
+        if document is None:
+            return False
+        webfinger_handle = None
+        handle = self.actor_handle(document)
+        if handle:
+            try:
+                webfinger_handle = (await self.afetch_webfinger(handle))[1]
+            except TryAgainLater:
+                logger.info("WebFinger timed out: %s", self.actor_uri)
+            except ValueError as exc:
+                logger.info(
+                    "Can't parse WebFinger: %s %s",
+                    exc.args[0],
+                    self.actor_uri,
+                    exc_info=exc,
+                )
+                return False
+        return await in_db_pool(self.apply_actor, document, webfinger_handle)
+
+    def actor_document(self, response: httpx.Response) -> dict | None:
+        """
+        Returns the canonicalised actor document from a fetch of our actor
+        URI, or None if there isn't a usable one.
+        """
         content_type = response.headers.get("content-type")
         if content_type and "html" in content_type:
             # Some servers don't properly handle "application/activity+json"
-            return False
+            return None
         status_code = response.status_code
         if status_code >= 400:
             if status_code in [408, 429, 504]:
@@ -916,10 +1109,10 @@ class Identity(StatorModel):
                 logger.info(
                     "Client error fetching actor: %d %s", status_code, self.actor_uri
                 )
-            return False
+            return None
         json_data = json_from_response(response)
         if not json_data:
-            return False
+            return None
         try:
             document = canonicalise(json_data, include_security=True)
         except ValueError:
@@ -931,9 +1124,30 @@ class Identity(StatorModel):
                     "content": response.content,
                 },
             )
-            return False
+            return None
         if "type" not in document:
-            return False
+            return None
+        return document
+
+    def actor_handle(self, document: dict) -> str | None:
+        """
+        Returns the handle to look up over webfinger for an actor document.
+        """
+        username = document.get("preferredUsername")
+        if username and "@value" in username:
+            username = username["@value"]
+        if not username:
+            return None
+        return f"{username}@{urlparse(self.actor_uri).hostname}"
+
+    def apply_actor(self, document: dict, webfinger_handle: str | None) -> bool:
+        """
+        Updates and saves us from a fetched actor document, and the canonical
+        handle webfinger gave for it (if any).
+        """
+        from activities.models import Emoji
+
+        self.invalidate_rendered_content()
         self.name = document.get("name")
         self.profile_uri = document.get("url")
         self.inbox_uri = document.get("inbox")
@@ -950,11 +1164,18 @@ class Identity(StatorModel):
         if self.username:
             self.username = self.username
         self.manually_approves_followers = document.get("manuallyApprovesFollowers")
+        old_public_key, old_public_key_id = self.public_key, self.public_key_id
         self.public_key = document.get("publicKey", {}).get("publicKeyPem")
         self.public_key_id = document.get("publicKey", {}).get("id")
         # Sometimes the public key PEM is in a language construct?
         if isinstance(self.public_key, dict):
             self.public_key = self.public_key["@value"]
+        # Drop the parsed copy of a key that's been rotated
+        if (old_public_key, old_public_key_id) != (
+            self.public_key,
+            self.public_key_id,
+        ):
+            RsaKeys.forget(old_public_key_id)
         self.icon_uri = get_first_image_url(document.get("icon", None))
         self.image_uri = get_first_image_url(document.get("image", None))
         self.discoverable = document.get("toot:discoverable", True)
@@ -972,30 +1193,12 @@ class Identity(StatorModel):
                         "value": FediverseHtmlParser(attachment["value"]).html,
                     }
                 )
-        # Now go do webfinger with that info to see if we can get a canonical domain
-        actor_url_parts = urlparse(self.actor_uri)
-        self.domain = Domain.get_remote_domain(actor_url_parts.hostname)
-        if self.username:
-            try:
-                webfinger_actor, webfinger_handle = self.fetch_webfinger(
-                    f"{self.username}@{actor_url_parts.hostname}"
-                )
-                if webfinger_handle:
-                    webfinger_username, webfinger_domain = webfinger_handle.split("@")
-                    self.username = webfinger_username
-                    self.domain = Domain.get_remote_domain(webfinger_domain)
-            except TryAgainLater:
-                # continue with original domain when webfinger times out
-                logger.info("WebFinger timed out: %s", self.actor_uri)
-                pass
-            except ValueError as exc:
-                logger.info(
-                    "Can't parse WebFinger: %s %s",
-                    exc.args[0],
-                    self.actor_uri,
-                    exc_info=exc,
-                )
-                return False
+        # Use the canonical domain from webfinger if we got one
+        self.domain = Domain.get_remote_domain(urlparse(self.actor_uri).hostname)
+        if self.username and webfinger_handle:
+            webfinger_username, webfinger_domain = webfinger_handle.split("@")
+            self.username = webfinger_username
+            self.domain = Domain.get_remote_domain(webfinger_domain)
         # Emojis (we need the domain so we do them here)
         for tag in get_list(document, "tag"):
             if tag["type"].lower() in ["toot:emoji", "emoji"]:
@@ -1054,18 +1257,52 @@ class Identity(StatorModel):
             "acct": self.handle or "",
         }
 
+    def emoji_content(self) -> str:
+        """
+        Returns the text that custom emoji on the profile can appear in
+        """
+        metadata_value_text = (
+            " ".join([m["value"] for m in self.metadata]) if self.metadata else ""
+        )
+        return f"{self.name} {self.summary} {metadata_value_text}"
+
+    @classmethod
+    def prefetch_mastodon_emojis(cls, identities: Iterable["Identity"]):
+        """
+        Looks up the custom emoji (and any cached field HTML) for several
+        identities' to_mastodon_json at once, rather than one query each.
+        """
+        from activities.models import Emoji
+
+        identities = [
+            identity
+            for identity in identities
+            if getattr(identity, "_mastodon_emojis", None) is None
+        ]
+        models.prefetch_related_objects(identities, "domain")
+        emoji_lists = Emoji.emojis_from_contents(
+            [(identity.emoji_content(), identity.domain) for identity in identities]
+        )
+        for identity, emojis in zip(identities, emoji_lists):
+            identity._mastodon_emojis = emojis
+        ContentRenderer(local=False).prefetch(
+            "data",
+            [
+                (identity, data["value"])
+                for identity in identities
+                for data in identity.metadata or []
+            ],
+        )
+
     def to_mastodon_json(self, source=False, include_counts=True):
         from activities.models import Emoji, Post
 
         header_image = self.local_image_url()
         missing = StaticAbsoluteUrl("img/missing.png").absolute
 
-        metadata_value_text = (
-            " ".join([m["value"] for m in self.metadata]) if self.metadata else ""
-        )
-        emojis = Emoji.emojis_from_content(
-            f"{self.name} {self.summary} {metadata_value_text}", self.domain
-        )
+        emojis = getattr(self, "_mastodon_emojis", None)
+        if emojis is None:
+            emojis = Emoji.emojis_from_content(self.emoji_content(), self.domain)
         renderer = ContentRenderer(local=False)
         result = {
             "id": self.pk,
@@ -1157,9 +1394,27 @@ class Identity(StatorModel):
             key_id=self.public_key_id,
         )
 
+    async def asigned_request(
+        self,
+        method: Literal["get", "post"],
+        uri: str,
+        body: dict | None = None,
+    ):
+        """
+        Async version of signed_request, for coroutine Stator handlers.
+        """
+        return await HttpSignature.asigned_request(
+            method=method,
+            uri=uri,
+            body=body,
+            private_key=self.private_key,
+            key_id=self.public_key_id,
+        )
+
     def generate_keypair(self):
         if not self.local:
             raise ValueError("Cannot generate keypair for remote user")
+        RsaKeys.forget(self.public_key_id)
         self.private_key, self.public_key = RsaKeys.generate_keypair()
         self.public_key_id = self.actor_uri + "#main-key"
         self.save()
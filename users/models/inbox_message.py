@@ -1,3 +1,5 @@
+from collections.abc import Iterable
+
 from django.db import models
 from pyld.jsonld import JsonLdError
 
@@ -17,7 +19,15 @@ class InboxMessageStates(StateGraph):
     def handle_received(cls, instance: "InboxMessage"):
         from activities.models import Post, PostInteraction, TimelineEvent
         from users.models import Block, Follow, Identity, Report
-        from users.services import IdentityService
+        from users.services import IdentityService, InboxService
+
+        # Messages accepted in deferred mode get their full checks here
+        if instance.message_type == InboxService.DEFERRED_TYPE:
+            document = InboxService.process_deferred(instance.message["object"])
+            if document is None:
+                return cls.processed
+            instance.message = document
+            instance.save(update_fields=["message"])
 
         try:
             match instance.message_type:
@@ -145,6 +155,10 @@ class InboxMessageStates(StateGraph):
                             IdentityService.handle_internal_add_follow(
                                 instance.message["object"]
                             )
+                        case "addfollows":
+                            IdentityService.handle_internal_add_follows(
+                                instance.message["object"]
+                            )
                         case "syncpins":
                             IdentityService.handle_internal_sync_pins(
                                 instance.message["object"]
@@ -182,6 +196,16 @@ class InboxMessage(StatorModel):
             }
         )
 
+    @classmethod
+    def create_internal_many(cls, payloads: Iterable[dict]):
+        """
+        Creates several internal action messages in one query
+        """
+        cls.objects.bulk_create(
+            cls(message={"type": "__internal__", "object": payload})
+            for payload in payloads
+        )
+
     @property
     def message_type(self):
         return self.message["type"].lower()
@@ -27,6 +27,7 @@ class SystemActor:
         return self.profile_uri
 
     def generate_keys(self):
+        RsaKeys.forget(self.public_key_id)
         self.private_key, self.public_key = RsaKeys.generate_keypair()
         Config.set_system("system_actor_private_key", self.private_key)
         Config.set_system("system_actor_public_key", self.public_key)
@@ -95,3 +96,20 @@ class SystemActor:
             private_key=self.private_key,
             key_id=self.public_key_id,
         )
+
+    async def asigned_request(
+        self,
+        method: Literal["get", "post"],
+        uri: str,
+        body: dict | None = None,
+    ):
+        """
+        Async version of signed_request, for coroutine Stator handlers.
+        """
+        return await HttpSignature.asigned_request(
+            method=method,
+            uri=uri,
+            body=body,
+            private_key=self.private_key,
+            key_id=self.public_key_id,
+        )
@@ -4,6 +4,7 @@ import urlman
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.db import models
 
+from core.lookups import LookupCache
 from core.models import Config
 
 
@@ -49,10 +50,30 @@ class User(AbstractBaseUser):
 
     objects = UserManager()
 
+    # Users by pk, for the request path
+    lookup_cache = LookupCache("user")
+
     class urls(urlman.Urls):
         admin = "/admin/users/"
         admin_edit = "{admin}{self.pk}/"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.lookup_cache.invalidate(self.pk)
+
+    def delete(self, *args, **kwargs):
+        self.lookup_cache.invalidate(self.pk)
+        return super().delete(*args, **kwargs)
+
+    @classmethod
+    def get_cached(cls, pk: int | None) -> "User | None":
+        """
+        Returns the User with this pk (cached)
+        """
+        if pk is None:
+            return None
+        return cls.lookup_cache.get(pk, lambda: cls.objects.filter(pk=pk).first())
+
     @property
     def is_active(self):
         return not (self.deleted or self.banned)
@@ -1,4 +1,5 @@
 from .announcement import AnnouncementService  # noqa
 from .domain import DomainService  # noqa
 from .identity import IdentityService  # noqa
+from .inbox import InboxService  # noqa
 from .user import UserService  # noqa
@@ -1,3 +1,5 @@
+from django.utils import timezone
+
 from users.models import Domain
 
 
@@ -9,7 +11,8 @@ class DomainService:
     @classmethod
     def block(cls, domains: list[str]) -> None:
         domains_to_block = Domain.objects.filter(domain__in=domains)
-        domains_to_block.update(blocked=True)
+        # Bump updated too, so other processes see the blocklist has changed
+        domains_to_block.update(blocked=True, updated=timezone.now())
 
         already_blocked = domains_to_block.values_list("domain", flat=True)
         domains_to_create = []
@@ -20,3 +23,5 @@ class DomainService:
                 )
 
         Domain.objects.bulk_create(domains_to_create)
+        Domain.lookup_cache.invalidate(*domains)
+        Domain.blocklist.expire()
@@ -1,7 +1,11 @@
 import logging
+import ssl
+from concurrent.futures import ThreadPoolExecutor
 
+from django.conf import settings
 from django.core.exceptions import MultipleObjectsReturned
 from django.db import models, transaction
+from django.db.models.functions import Lower, RowNumber
 from django.template.defaultfilters import linebreaks_filter
 
 from activities.models import FanOut, Post, PostInteraction, PostInteractionStates
@@ -50,12 +54,16 @@ class IdentityService:
         identity.users.add(user)
         identity.generate_keypair()
         # Send fanouts to all admin identities
-        for admin_identity in cls.admin_identities():
-            FanOut.objects.create(
-                type=FanOut.Types.identity_created,
-                identity=admin_identity,
-                subject_identity=identity,
-            )
+        FanOut.objects.bulk_create(
+            [
+                FanOut(
+                    type=FanOut.Types.identity_created,
+                    identity=admin_identity,
+                    subject_identity=identity,
+                )
+                for admin_identity in cls.admin_identities()
+            ]
+        )
         return identity
 
     @classmethod
@@ -195,23 +203,49 @@ class IdentityService:
         """
         Returns a dict of any active relationships from the given identity.
         """
-        return {
-            "outbound_follow": Follow.maybe_get(
-                from_identity, self.identity, require_active=True
-            ),
-            "inbound_follow": Follow.maybe_get(
-                self.identity, from_identity, require_active=True
-            ),
-            "outbound_block": Block.maybe_get(
-                from_identity, self.identity, mute=False, require_active=True
-            ),
-            "inbound_block": Block.maybe_get(
-                self.identity, from_identity, mute=False, require_active=True
-            ),
-            "outbound_mute": Block.maybe_get(
-                from_identity, self.identity, mute=True, require_active=True
-            ),
+        return self.relationships_for(from_identity, [self.identity])[self.identity.pk]
+
+    @classmethod
+    def relationships_for(
+        cls, from_identity: Identity, identities: list[Identity]
+    ) -> dict:
+        """
+        Returns relationships() for several identities at once, keyed by
+        their ID, in two queries however many there are.
+        """
+        pks = [identity.pk for identity in identities]
+        result: dict = {
+            pk: {
+                "outbound_follow": None,
+                "inbound_follow": None,
+                "outbound_block": None,
+                "inbound_block": None,
+                "outbound_mute": None,
+            }
+            for pk in pks
         }
+        for follow in Follow.objects.active().filter(
+            models.Q(source=from_identity, target_id__in=pks)
+            | models.Q(source_id__in=pks, target=from_identity)
+        ):
+            if follow.source_id == from_identity.pk and follow.target_id in result:
+                result[follow.target_id]["outbound_follow"] = follow
+            if follow.target_id == from_identity.pk and follow.source_id in result:
+                result[follow.source_id]["inbound_follow"] = follow
+        for block in Block.objects.active().filter(
+            models.Q(source=from_identity, target_id__in=pks)
+            | models.Q(source_id__in=pks, target=from_identity, mute=False)
+        ):
+            if block.source_id == from_identity.pk and block.target_id in result:
+                key = "outbound_mute" if block.mute else "outbound_block"
+                result[block.target_id][key] = block
+            if (
+                block.target_id == from_identity.pk
+                and block.source_id in result
+                and not block.mute
+            ):
+                result[block.source_id]["inbound_block"] = block
+        return result
 
     def sync_pins(self, object_uris):
         if not object_uris or self.identity.domain.blocked:
@@ -243,12 +277,15 @@ class IdentityService:
             ).exclude(post__object_uri__in=object_uris):
                 removed.transition_perform(PostInteractionStates.undone_fanned_out)
 
-    def mastodon_json_relationship(self, from_identity: Identity):
+    def mastodon_json_relationship(
+        self, from_identity: Identity, relationships: dict | None = None
+    ):
         """
         Returns a Relationship object for the from_identity's relationship
         with this identity.
         """
-        relationships = self.relationships(from_identity)
+        if relationships is None:
+            relationships = self.relationships(from_identity)
         return {
             "id": self.identity.pk,
             "following": relationships["outbound_follow"] is not None
@@ -276,6 +313,51 @@ class IdentityService:
             ),
         }
 
+    @classmethod
+    def familiar_followers(
+        cls, from_identity: Identity, identities: list[Identity], limit: int = 20
+    ) -> dict:
+        """
+        Returns, for each of the identities (keyed by ID), up to `limit` of
+        the people from_identity follows who also follow them, in one query.
+        """
+        result: dict = {identity.pk: [] for identity in identities}
+        familiar = (
+            Identity.objects.filter(
+                inbound_follows__source=from_identity,
+                outbound_follows__target__in=identities,
+            )
+            .annotate(
+                familiar_to=models.F("outbound_follows__target"),
+                familiar_rank=models.Window(
+                    RowNumber(),
+                    partition_by=models.F("outbound_follows__target"),
+                    order_by=models.F("pk").asc(),
+                ),
+            )
+            .filter(familiar_rank__lte=limit)
+            .select_related("domain")
+        )
+        for identity in familiar:
+            result[identity.familiar_to].append(identity)
+        return result
+
+    @classmethod
+    def mastodon_json_relationships(
+        cls, identities: list[Identity], from_identity: Identity
+    ) -> list[dict]:
+        """
+        Returns mastodon_json_relationship for several identities, in order,
+        using a fixed number of queries.
+        """
+        relationships = cls.relationships_for(from_identity, identities)
+        return [
+            cls(identity).mastodon_json_relationship(
+                from_identity, relationships[identity.pk]
+            )
+            for identity in identities
+        ]
+
     def set_summary(self, summary: str):
         """
         Safely sets a summary and turns linebreaks into HTML
@@ -327,6 +409,94 @@ class IdentityService:
         # Follow!
         self.follow(target_identity=target_identity, boosts=payload.get("boosts", True))
 
+    @classmethod
+    def handle_internal_add_follows(cls, payload):
+        """
+        Handles an inbox message saying we need to follow several handles on
+        one server (from a follow import). It works through them a batch at a
+        time, queueing the rest as a new message, so each server only has one
+        import task (making a capped number of lookups at once) going.
+
+        Message format:
+        {
+            "type": "AddFollows",
+            "source": "90310938129083",
+            "domain": "aeracode.org",
+            "follows": [{"handle": "andrew@aeracode.org", "boosts": true}],
+        }
+        """
+        self = cls(Identity.objects.get(pk=payload["source"]))
+        batch_size = settings.SETUP.IMPORT_FOLLOW_BATCH
+        follows = payload["follows"][:batch_size]
+        rest = payload["follows"][batch_size:]
+        # Accounts we already know about don't need looking up
+        known = {
+            identity.username.lower(): identity
+            for identity in Identity.objects.annotate(
+                username_lower=Lower("username")
+            ).filter(
+                domain_id=payload["domain"],
+                username_lower__in=[
+                    follow["handle"].split("@")[0].lower() for follow in follows
+                ],
+            )
+        }
+        targets = []
+        unknown = []
+        for follow in follows:
+            identity = known.get(follow["handle"].split("@")[0].lower())
+            if identity:
+                targets.append((identity, follow))
+            else:
+                unknown.append(follow)
+        domain = Domain.get_domain(payload["domain"])
+        if unknown and not (domain and domain.local):
+            for follow, result in zip(
+                unknown, cls.fetch_webfingers(payload["domain"], unknown)
+            ):
+                if result is None:
+                    # Couldn't reach them right now; try again a few times
+                    attempts = follow.get("attempts", 0) + 1
+                    if attempts < 3:
+                        rest.append({**follow, "attempts": attempts})
+                    continue
+                actor_uri, handle = result
+                if actor_uri is None or handle is None:
+                    logger.info("Cannot find identity to follow: %s", follow["handle"])
+                    continue
+                targets.append((Identity.by_webfinger(actor_uri, handle), follow))
+        for identity, follow in targets:
+            self.follow(target_identity=identity, boosts=follow.get("boosts", True))
+        if rest:
+            InboxMessage.create_internal({**payload, "follows": rest})
+
+    @classmethod
+    def fetch_webfingers(
+        cls, domain: str, follows: list[dict]
+    ) -> list[tuple[str | None, str | None] | None]:
+        """
+        Does webfinger lookups for several handles on one domain (working out
+        its webfinger URL only once), IMPORT_FOLLOW_CONCURRENCY at a time.
+        Lookups that should be retried later come back as None.
+        """
+        try:
+            webfinger_url = Identity.fetch_webfinger_url(domain)
+        except ssl.SSLCertVerificationError:
+            return [(None, None) for _ in follows]
+
+        def lookup(follow):
+            try:
+                return Identity.fetch_webfinger(follow["handle"], webfinger_url)
+            except TryAgainLater:
+                return None
+            except ValueError:
+                return None, None
+
+        with ThreadPoolExecutor(
+            max_workers=settings.SETUP.IMPORT_FOLLOW_CONCURRENCY
+        ) as executor:
+            return list(executor.map(lookup, follows))
+
     @classmethod
     def handle_internal_sync_pins(cls, payload):
         """
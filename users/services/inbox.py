@@ -0,0 +1,341 @@
+import logging
+import threading
+from typing import NamedTuple
+from urllib.parse import urldefrag, urlparse
+
+from asgiref.sync import sync_to_async
+from cachetools import TTLCache
+from django.conf import settings
+from pyld.jsonld import JsonLdError
+
+from core.ld import canonicalise
+from core.signatures import LDSignature, VerificationError, VerificationFormatError
+from users.models import Domain, Identity, InboxMessage, InboxMessageStates
+
+logger = logging.getLogger(__name__)
+
+
+class ActorDetails(NamedTuple):
+    blocked: bool
+    public_key: str | None
+    public_key_id: str | None
+
+
+class InboxBatch:
+    """
+    Messages from concurrent inbox requests that are written in one go.
+    """
+
+    def __init__(self):
+        self.messages: list[InboxMessage] = []
+        self.full = threading.Event()
+        self.written = threading.Event()
+        self.error: Exception | None = None
+
+
+class InboxService:
+    """
+    Handling for incoming inbox deliveries, shared by the inbox view and the
+    deferred processing in Stator.
+    """
+
+    #: InboxMessage type for documents accepted without full processing
+    DEFERRED_TYPE = "__deferred__"
+
+    # Per-process caches for the checks done on the request path
+    actor_cache: TTLCache = TTLCache(maxsize=10000, ttl=60)
+    depth_cache: TTLCache = TTLCache(maxsize=1, ttl=10)
+    cache_lock = threading.Lock()
+
+    # The batch that inbox requests are currently joining
+    batch: InboxBatch | None = None
+    batch_lock = threading.Lock()
+
+    @classmethod
+    def actor_details(cls, actor_uri: str, fresh: bool = False) -> ActorDetails | None:
+        """
+        Returns the block status and key for a known actor, or None if we've
+        never seen them.
+        """
+        if not fresh:
+            with cls.cache_lock:
+                if actor_uri in cls.actor_cache:
+                    return cls.actor_cache[actor_uri]
+        return cls.cache_actor_details(
+            actor_uri,
+            Identity.objects.filter(actor_uri=actor_uri)
+            .values_list("restriction", "public_key", "public_key_id")
+            .first(),
+        )
+
+    @classmethod
+    async def aactor_details(
+        cls, actor_uri: str, fresh: bool = False
+    ) -> ActorDetails | None:
+        """
+        Async version of actor_details()
+        """
+        if not fresh:
+            with cls.cache_lock:
+                if actor_uri in cls.actor_cache:
+                    return cls.actor_cache[actor_uri]
+        return cls.cache_actor_details(
+            actor_uri,
+            await Identity.objects.filter(actor_uri=actor_uri)
+            .values_list("restriction", "public_key", "public_key_id")
+            .afirst(),
+        )
+
+    @classmethod
+    def cache_actor_details(
+        cls, actor_uri: str, row: tuple | None
+    ) -> ActorDetails | None:
+        details = None
+        if row:
+            details = ActorDetails(
+                blocked=row[0] == Identity.Restriction.blocked,
+                public_key=row[1],
+                public_key_id=row[2],
+            )
+        with cls.cache_lock:
+            cls.actor_cache[actor_uri] = details
+        return details
+
+    @classmethod
+    def domain_blocked(cls, hostname: str) -> bool:
+        """
+        Returns if the domain (or any parent domain) is blocked
+        """
+        return Domain.blocklist.blocked(hostname)
+
+    @classmethod
+    async def adomain_blocked(cls, hostname: str) -> bool:
+        """
+        Async version of domain_blocked()
+        """
+        return await Domain.blocklist.ablocked(hostname)
+
+    @classmethod
+    def queue_full(cls) -> bool:
+        """
+        Returns if there are more messages waiting than we're configured to
+        accept (the count is only refreshed every few seconds).
+        """
+        limit = settings.SETUP.INBOX_MAX_QUEUE
+        if not limit:
+            return False
+        with cls.cache_lock:
+            depth = cls.depth_cache.get("depth")
+        if depth is None:
+            depth = cls.cache_depth(
+                InboxMessage.objects.filter(state=InboxMessageStates.received).count()
+            )
+        return depth >= limit
+
+    @classmethod
+    async def aqueue_full(cls) -> bool:
+        """
+        Async version of queue_full()
+        """
+        limit = settings.SETUP.INBOX_MAX_QUEUE
+        if not limit:
+            return False
+        with cls.cache_lock:
+            depth = cls.depth_cache.get("depth")
+        if depth is None:
+            depth = cls.cache_depth(
+                await InboxMessage.objects.filter(
+                    state=InboxMessageStates.received
+                ).acount()
+            )
+        return depth >= limit
+
+    @classmethod
+    def cache_depth(cls, depth: int) -> int:
+        with cls.cache_lock:
+            cls.depth_cache["depth"] = depth
+        return depth
+
+    @classmethod
+    def should_discard(cls, document: dict, identity: Identity) -> bool:
+        """
+        Returns True for messages we accept but throw away: deletes for actors
+        we never knew, anything from blocked users or domains, and types we
+        can't handle anyway.
+        """
+        document_type = document["type"]
+        document_subtype = None
+        if isinstance(document.get("object"), dict):
+            document_subtype = document["object"].get("type")
+
+        if (
+            document_type == "Delete"
+            and document["actor"] == document["object"]
+            and identity._state.adding
+        ):
+            # We don't have an Identity record for the user. No-op
+            return True
+
+        # See if it's from a blocked user or domain - without calling
+        # fetch_actor, which would fetch data from potentially bad actor
+        domain = identity.domain
+        if not domain:
+            actor_url_parts = urlparse(document["actor"])
+            domain = Domain.get_remote_domain(actor_url_parts.hostname)
+        if identity.blocked or domain.recursively_blocked():
+            # I love to lie! Throw it away!
+            logger.info(
+                "Inbox: Discarded message from blocked %s %s",
+                "domain" if domain.recursively_blocked() else "user",
+                identity.actor_uri,
+            )
+            return True
+
+        # See if it's a type of message we know we want to ignore right now
+        # (e.g. Lemmy likes/dislikes, which we can't process anyway)
+        if document_type == "Announce" and document_subtype in [
+            "Like",
+            "Dislike",
+            "Create",
+            "Undo",
+            "Update",
+        ]:
+            return True
+        return False
+
+    @classmethod
+    def check_ld_signature(cls, document: dict) -> None:
+        """
+        Verifies the LD signature on a document if there is one, stripping it
+        if it can't be verified. Raises VerificationFormatError if it's
+        malformed.
+        """
+        # Mastodon advices not implementing LD Signatures, but
+        # they're widely deployed today. Validate it if one exists.
+        # https://docs.joinmastodon.org/spec/security/#ld
+        if "signature" not in document:
+            return
+        try:
+            # signatures are identified by the signature block
+            creator = urldefrag(document["signature"]["creator"]).url
+            creator_identity = Identity.by_actor_uri(
+                creator, create=True, transient=True
+            )
+            if not creator_identity.public_key:
+                logger.info("Inbox: New actor, no key available: %s", creator)
+                # if we can't verify it, we don't keep it
+                document.pop("signature")
+            else:
+                LDSignature.verify_signature(
+                    document,
+                    creator_identity.public_key,
+                    creator_identity.public_key_id,
+                )
+                logger.debug(
+                    "Inbox: %s from %s has good LD signature",
+                    document["type"],
+                    creator_identity,
+                )
+        except VerificationFormatError:
+            raise
+        except VerificationError:
+            # An invalid LD Signature might also indicate nothing but
+            # a syntactical difference between implementations.
+            # Strip it out if we can't verify it.
+            if "signature" in document:
+                document.pop("signature")
+            logger.info(
+                "Inbox: Stripping invalid LD signature from %s %s",
+                creator_identity,
+                document["id"],
+            )
+
+    @classmethod
+    def process_deferred(cls, raw_document: dict) -> dict | None:
+        """
+        Runs the checks a deferred message skipped on the way in, returning
+        the canonicalised document, or None if it should be dropped.
+        """
+        try:
+            document = canonicalise(raw_document, include_security=True)
+        except (JsonLdError, ValueError) as e:
+            logger.info("Inbox: Dropping deferred message that won't parse: %s", e)
+            return None
+        if "actor" not in document or document["type"].startswith("__"):
+            return None
+        identity = Identity.by_actor_uri(document["actor"], create=True, transient=True)
+        if cls.should_discard(document, identity):
+            return None
+        try:
+            cls.check_ld_signature(document)
+        except VerificationFormatError as e:
+            logger.warning("Inbox error: Bad LD signature format: %s", e.args[0])
+            return None
+        return document
+
+    @classmethod
+    def enqueue(cls, message: dict) -> None:
+        """
+        Saves a message for Stator to process. If we're configured to batch
+        writes, it's written along with any other requests' messages that
+        arrive within INBOX_BATCH_SECONDS, but it's always written by the time
+        this returns, so nothing that's been accepted is lost with the process.
+        """
+        if settings.SETUP.INBOX_BATCH_SIZE <= 1:
+            InboxMessage.objects.create(message=message)
+            return
+        batch, first = cls.join_batch(message)
+        if first:
+            # The first request in writes the batch once it's full or it's
+            # waited long enough; the rest wait for it
+            batch.full.wait(settings.SETUP.INBOX_BATCH_SECONDS)
+            cls.write_batch(batch)
+        else:
+            batch.written.wait()
+            if batch.error is not None:
+                raise batch.error
+
+    @classmethod
+    async def aenqueue(cls, message: dict) -> None:
+        """
+        Async version of enqueue(); batched writes wait in a thread
+        """
+        if settings.SETUP.INBOX_BATCH_SIZE <= 1:
+            await InboxMessage.objects.acreate(message=message)
+        else:
+            await sync_to_async(cls.enqueue)(message)
+
+    @classmethod
+    def join_batch(cls, message: dict) -> tuple[InboxBatch, bool]:
+        """
+        Adds a message to the current batch (starting one if there isn't
+        one), returning it and whether this message started it.
+        """
+        with cls.batch_lock:
+            first = cls.batch is None
+            if cls.batch is None:
+                cls.batch = InboxBatch()
+            batch = cls.batch
+            batch.messages.append(InboxMessage(message=message))
+            if len(batch.messages) >= settings.SETUP.INBOX_BATCH_SIZE:
+                # Later messages start a new batch
+                cls.batch = None
+                batch.full.set()
+        return batch, first
+
+    @classmethod
+    def write_batch(cls, batch: InboxBatch) -> None:
+        """
+        Writes out a batch's messages in one go, and lets its other requests
+        know how that went.
+        """
+        with cls.batch_lock:
+            if cls.batch is batch:
+                cls.batch = None
+        try:
+            InboxMessage.objects.bulk_create(batch.messages)
+        except Exception as error:
+            batch.error = error
+            raise
+        finally:
+            batch.written.set()
@@ -38,6 +38,34 @@ def by_handle_or_404(request, handle, local=True, fetch=False) -> Identity:
     return identity
 
 
+async def aby_handle_or_404(request, handle) -> Identity:
+    """
+    Async version of by_handle_or_404(), for identities we already know about
+    (there's no fetching, and the local filter follows the domain)
+    """
+    if "@" not in handle:
+        if "host" not in request.headers:
+            raise Http404("No hostname available")
+        username = handle
+        domain_instance = await Domain.aget_domain(request.headers["host"], cached=True)
+        if domain_instance is None:
+            raise Http404("No matching domains found")
+    else:
+        username, domain = handle.split("@", 1)
+        if not Domain.is_valid_domain(domain):
+            raise Http404("Invalid domain")
+        # Resolve the domain to the display domain
+        domain_instance = await Domain.aget_domain(domain, cached=True)
+        if domain_instance is None:
+            domain_instance = await Domain.aget_remote_domain(domain)
+    identity = await Identity.aby_username_and_domain(username, domain_instance)
+    if identity is None:
+        raise Http404(f"No identity for handle {handle}")
+    if identity.blocked:
+        raise Http404("Blocked user")
+    return identity
+
+
 def by_handle_for_user_or_404(request, handle):
     """
     Retrieves an identity the local user can control via their handle, or
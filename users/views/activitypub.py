@@ -1,7 +1,8 @@
 import json
 import logging
-from urllib.parse import urldefrag, urlparse
+from urllib.parse import urlparse
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.utils.decorators import method_decorator
@@ -12,19 +13,14 @@ from django.views.generic import View
 from activities.models import Post
 from activities.services import TimelineService
 from core.decorators import cache_page
-from core.ld import canonicalise
+from core.ld import canonicalise, get_str_or_id
 from core.models import Config
-from core.signatures import (
-    HttpSignature,
-    LDSignature,
-    VerificationError,
-    VerificationFormatError,
-)
-from core.views import StaticContentView
+from core.signatures import HttpSignature, VerificationError, VerificationFormatError
+from core.views import AsyncCapableView, StaticContentView
 from takahe import __version__
-from users.models import Identity, InboxMessage, SystemActor
-from users.models.domain import Domain
-from users.shortcuts import by_handle_or_404
+from users.models import Identity, SystemActor
+from users.services import InboxService
+from users.shortcuts import aby_handle_or_404, by_handle_or_404
 
 logger = logging.getLogger(__name__)
 
@@ -33,11 +29,14 @@ class HttpResponseUnauthorized(HttpResponse):
     status_code = 401
 
 
-class HostMeta(View):
+class HostMeta(AsyncCapableView):
     """
     Returns a canned host-meta response
     """
 
+    async def aget(self, request):
+        return self.get(request)
+
     def get(self, request):
         return HttpResponse(
             """<?xml version="1.0" encoding="UTF-8"?>
@@ -49,11 +48,14 @@ class HostMeta(View):
         )
 
 
-class NodeInfo(View):
+class NodeInfo(AsyncCapableView):
     """
     Returns the well-known nodeinfo response, pointing to the 2.0 one
     """
 
+    async def aget(self, request):
+        return self.get(request)
+
     def get(self, request):
         host = request.META.get("HOST", settings.MAIN_DOMAIN)
         return JsonResponse(
@@ -68,8 +70,9 @@ class NodeInfo(View):
         )
 
 
-@method_decorator(cache_page(), name="dispatch")
-class NodeInfo2(View):
+@method_decorator(cache_page(), name="get")
+@method_decorator(cache_page(), name="aget")
+class NodeInfo2(AsyncCapableView):
     """
     Returns the nodeinfo 2.0 response
     """
@@ -89,6 +92,25 @@ class NodeInfo2(View):
             local_identities = Identity.objects.filter(local=True).count()
             local_posts = Post.objects.filter(local=True).count()
             metadata = {}
+        return self.render(local_identities, local_posts, metadata)
+
+    async def aget(self, request):
+        if request.domain:
+            domain_config = await sync_to_async(Config.load_domain)(request.domain)
+            local_identities = await Identity.objects.filter(
+                local=True, domain=request.domain
+            ).acount()
+            local_posts = await Post.objects.filter(
+                local=True, author__domain=request.domain
+            ).acount()
+            metadata = {"nodeName": domain_config.site_name}
+        else:
+            local_identities = await Identity.objects.filter(local=True).acount()
+            local_posts = await Post.objects.filter(local=True).acount()
+            metadata = {}
+        return self.render(local_identities, local_posts, metadata)
+
+    def render(self, local_identities: int, local_posts: int, metadata: dict):
         return JsonResponse(
             {
                 "version": "2.0",
@@ -105,8 +127,9 @@ class NodeInfo2(View):
         )
 
 
-@method_decorator(cache_page(), name="dispatch")
-class Webfinger(View):
+@method_decorator(cache_page(), name="get")
+@method_decorator(cache_page(), name="aget")
+class Webfinger(AsyncCapableView):
     """
     Services webfinger requests
     """
@@ -127,9 +150,24 @@ class Webfinger(View):
 
         return JsonResponse(actor.to_webfinger(), content_type="application/jrd+json")
 
+    async def aget(self, request):
+        resource = request.GET.get("resource")
+        if not resource:
+            return HttpResponseBadRequest("No resource specified")
+        if not resource.startswith("acct:"):
+            return HttpResponseBadRequest("Not an account resource")
+        handle = resource[5:]
+
+        if handle.startswith("__system__@"):
+            actor = SystemActor()
+        else:
+            actor = await aby_handle_or_404(request, handle)
+
+        return JsonResponse(actor.to_webfinger(), content_type="application/jrd+json")
+
 
 @method_decorator(csrf_exempt, name="dispatch")
-class Inbox(View):
+class Inbox(AsyncCapableView):
     """
     AP Inbox endpoint
     """
@@ -138,12 +176,39 @@ class Inbox(View):
         # Reject bodies that are unfeasibly big
         if len(request.body) > settings.JSONLD_MAX_SIZE:
             return HttpResponseBadRequest("Payload size too large")
+        # Ask senders to back off if we're too far behind on processing
+        if InboxService.queue_full():
+            return HttpResponse(
+                "Inbox queue is full",
+                status=429,
+                headers={"Retry-After": str(settings.SETUP.INBOX_RETRY_AFTER)},
+            )
+        if settings.SETUP.INBOX_DEFERRED:
+            return self.post_deferred(request)
+        return self.post_immediate(request)
+
+    async def apost(self, request, handle=None):
+        if len(request.body) > settings.JSONLD_MAX_SIZE:
+            return HttpResponseBadRequest("Payload size too large")
+        if await InboxService.aqueue_full():
+            return HttpResponse(
+                "Inbox queue is full",
+                status=429,
+                headers={"Retry-After": str(settings.SETUP.INBOX_RETRY_AFTER)},
+            )
+        if settings.SETUP.INBOX_DEFERRED:
+            return await self.apost_deferred(request)
+        # Full processing resolves actors and LD signatures with the sync
+        # ORM (and sometimes the network), so it runs in a thread
+        return await sync_to_async(self.post_immediate)(request)
+
+    def post_immediate(self, request):
+        """
+        Accepts a message after canonicalising it and running all the checks
+        """
         # Load the LD
         document = canonicalise(json.loads(request.body), include_security=True)
         document_type = document["type"]
-        document_subtype = None
-        if isinstance(document.get("object"), dict):
-            document_subtype = document["object"].get("type")
 
         # Find the Identity by the actor on the incoming item
         # This ensures that the signature used for the headers matches the actor
@@ -153,38 +218,7 @@ class Inbox(View):
             return HttpResponseBadRequest("Unspecified actor")
 
         identity = Identity.by_actor_uri(document["actor"], create=True, transient=True)
-        if (
-            document_type == "Delete"
-            and document["actor"] == document["object"]
-            and identity._state.adding
-        ):
-            # We don't have an Identity record for the user. No-op
-            return HttpResponse(status=202)
-
-        # See if it's from a blocked user or domain - without calling
-        # fetch_actor, which would fetch data from potentially bad actor
-        domain = identity.domain
-        if not domain:
-            actor_url_parts = urlparse(document["actor"])
-            domain = Domain.get_remote_domain(actor_url_parts.hostname)
-        if identity.blocked or domain.recursively_blocked():
-            # I love to lie! Throw it away!
-            logger.info(
-                "Inbox: Discarded message from blocked %s %s",
-                "domain" if domain.recursively_blocked() else "user",
-                identity.actor_uri,
-            )
-            return HttpResponse(status=202)
-
-        # See if it's a type of message we know we want to ignore right now
-        # (e.g. Lemmy likes/dislikes, which we can't process anyway)
-        if document_type == "Announce" and document_subtype in [
-            "Like",
-            "Dislike",
-            "Create",
-            "Undo",
-            "Update",
-        ]:
+        if InboxService.should_discard(document, identity):
             return HttpResponse(status=202)
 
         # authenticate HTTP signature first, if one is present and the actor
@@ -197,6 +231,7 @@ class Inbox(View):
                     HttpSignature.verify_request(
                         request,
                         identity.public_key,
+                        key_id=identity.public_key_id,
                     )
                     logger.debug(
                         "Inbox: %s from %s has good HTTP signature",
@@ -215,41 +250,11 @@ class Inbox(View):
                 logger.warning("Inbox error: Bad HTTP signature from %s", identity)
                 return HttpResponseUnauthorized("Bad signature")
 
-        # Mastodon advices not implementing LD Signatures, but
-        # they're widely deployed today. Validate it if one exists.
-        # https://docs.joinmastodon.org/spec/security/#ld
-        if "signature" in document:
-            try:
-                # signatures are identified by the signature block
-                creator = urldefrag(document["signature"]["creator"]).url
-                creator_identity = Identity.by_actor_uri(
-                    creator, create=True, transient=True
-                )
-                if not creator_identity.public_key:
-                    logger.info("Inbox: New actor, no key available: %s", creator)
-                    # if we can't verify it, we don't keep it
-                    document.pop("signature")
-                else:
-                    LDSignature.verify_signature(document, creator_identity.public_key)
-                    logger.debug(
-                        "Inbox: %s from %s has good LD signature",
-                        document["type"],
-                        creator_identity,
-                    )
-            except VerificationFormatError as e:
-                logger.warning("Inbox error: Bad LD signature format: %s", e.args[0])
-                return HttpResponseBadRequest(e.args[0])
-            except VerificationError:
-                # An invalid LD Signature might also indicate nothing but
-                # a syntactical difference between implementations.
-                # Strip it out if we can't verify it.
-                if "signature" in document:
-                    document.pop("signature")
-                logger.info(
-                    "Inbox: Stripping invalid LD signature from %s %s",
-                    creator_identity,
-                    document["id"],
-                )
+        try:
+            InboxService.check_ld_signature(document)
+        except VerificationFormatError as e:
+            logger.warning("Inbox error: Bad LD signature format: %s", e.args[0])
+            return HttpResponseBadRequest(e.args[0])
 
         if not ("signature" in request or "signature" in document):
             logger.debug(
@@ -263,7 +268,109 @@ class Inbox(View):
             return HttpResponseUnauthorized("Bad type")
 
         # Hand off the item to be processed by the queue
-        InboxMessage.objects.create(message=document)
+        InboxService.enqueue(document)
+        return HttpResponse(status=202)
+
+    def post_deferred(self, request):
+        """
+        Accepts a message with only the checks we can do from cached data,
+        leaving canonicalisation, LD signatures and full block checks for
+        Stator.
+        """
+        document = json.loads(request.body)
+        if not isinstance(document, dict):
+            return HttpResponseBadRequest("Not a JSON object")
+        actor = get_str_or_id(document.get("actor"))
+        if not actor:
+            logger.warning("Inbox error: unspecified actor")
+            return HttpResponseBadRequest("Unspecified actor")
+        # Don't allow injection of internal messages
+        if str(document.get("type", "")).startswith("__"):
+            return HttpResponseUnauthorized("Bad type")
+
+        details = InboxService.actor_details(actor)
+        hostname = urlparse(actor).hostname
+        if (details and details.blocked) or (
+            hostname and InboxService.domain_blocked(hostname)
+        ):
+            logger.info("Inbox: Discarded message from blocked %s", actor)
+            return HttpResponse(status=202)
+
+        if "signature" in request and details and details.public_key:
+            try:
+                try:
+                    HttpSignature.verify_request(
+                        request, details.public_key, key_id=details.public_key_id
+                    )
+                except VerificationFormatError:
+                    raise
+                except VerificationError:
+                    # The cached key may have been rotated since; check again
+                    details = InboxService.actor_details(actor, fresh=True)
+                    if not (details and details.public_key):
+                        raise
+                    HttpSignature.verify_request(
+                        request, details.public_key, key_id=details.public_key_id
+                    )
+            except VerificationFormatError as e:
+                logger.warning("Inbox error: Bad HTTP signature format: %s", e.args[0])
+                return HttpResponseBadRequest(e.args[0])
+            except VerificationError:
+                logger.warning("Inbox error: Bad HTTP signature from %s", actor)
+                return HttpResponseUnauthorized("Bad signature")
+
+        InboxService.enqueue({"type": InboxService.DEFERRED_TYPE, "object": document})
+        return HttpResponse(status=202)
+
+    async def apost_deferred(self, request):
+        """
+        Async version of post_deferred()
+        """
+        document = json.loads(request.body)
+        if not isinstance(document, dict):
+            return HttpResponseBadRequest("Not a JSON object")
+        actor = get_str_or_id(document.get("actor"))
+        if not actor:
+            logger.warning("Inbox error: unspecified actor")
+            return HttpResponseBadRequest("Unspecified actor")
+        # Don't allow injection of internal messages
+        if str(document.get("type", "")).startswith("__"):
+            return HttpResponseUnauthorized("Bad type")
+
+        details = await InboxService.aactor_details(actor)
+        hostname = urlparse(actor).hostname
+        if (details and details.blocked) or (
+            hostname and await InboxService.adomain_blocked(hostname)
+        ):
+            logger.info("Inbox: Discarded message from blocked %s", actor)
+            return HttpResponse(status=202)
+
+        if "signature" in request and details and details.public_key:
+            try:
+                try:
+                    HttpSignature.verify_request(
+                        request, details.public_key, key_id=details.public_key_id
+                    )
+                except VerificationFormatError:
+                    raise
+                except VerificationError:
+                    # The cached key may have been rotated since; check again
+                    details = await InboxService.aactor_details(actor, fresh=True)
+                    if not (details and details.public_key):
+                        raise
+                    HttpSignature.verify_request(
+                        request, details.public_key, key_id=details.public_key_id
+                    )
+            except VerificationFormatError as e:
+                logger.warning("Inbox error: Bad HTTP signature format: %s", e.args[0])
+                return HttpResponseBadRequest(e.args[0])
+            except VerificationError:
+                logger.warning("Inbox error: Bad HTTP signature from %s", actor)
+                return HttpResponseUnauthorized("Bad signature")
+
+        await InboxService.aenqueue(
+            {"type": InboxService.DEFERRED_TYPE, "object": document}
+        )
         return HttpResponse(status=202)
 
 
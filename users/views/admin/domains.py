@@ -148,7 +148,7 @@ class DomainCreate(FormView):
         )
         domain.users.set(form.cleaned_data["users"])
         if domain.default:
-            Domain.objects.exclude(pk=domain.pk).update(default=False)
+            domain.make_default()
         return redirect(Domain.urls.root)
 
 
@@ -219,7 +219,7 @@ class DomainEdit(FormView):
         self.domain.save()
         self.domain.users.set(form.cleaned_data["users"])
         if self.domain.default:
-            Domain.objects.exclude(pk=self.domain.pk).update(default=False)
+            self.domain.make_default()
         Config.set_domain(self.domain, "hide_login", form.cleaned_data["hide_login"])
         Config.set_domain(self.domain, "site_name", form.cleaned_data["site_name"])
         if isinstance(form.cleaned_data["site_icon"], File):
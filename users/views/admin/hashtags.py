@@ -22,6 +22,11 @@ class Hashtags(ListView):
     def get_queryset(self):
         return Hashtag.objects.filter().order_by("hashtag")
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        Hashtag.prefetch_usage_totals(context["page_obj"])
+        return context
+
 
 @method_decorator(moderator_required, name="dispatch")
 class HashtagEdit(FormView):
@@ -1,11 +1,13 @@
 import string
 
+from asgiref.sync import sync_to_async
 from django import forms
 from django.contrib.auth.decorators import login_required
 from django.contrib.syndication.views import Feed
 from django.core import validators
 from django.http import Http404, JsonResponse
 from django.shortcuts import redirect
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
 from django.utils.feedgenerator import Rss201rev2Feed
 from django.utils.xmlutils import SimplerXMLGenerator
@@ -17,14 +19,16 @@ from activities.services import SearchService, TimelineService
 from core.decorators import cache_page, cache_page_by_ap_json
 from core.ld import canonicalise
 from core.models import Config
+from core.views import AsyncCapableView
 from users.models import Domain, FollowStates, Identity
 from users.services import IdentityService
-from users.shortcuts import by_handle_or_404
+from users.shortcuts import aby_handle_or_404, by_handle_or_404
 
 
-@method_decorator(vary_on_headers("Accept"), name="dispatch")
-@method_decorator(cache_page_by_ap_json(public_only=True), name="dispatch")
-class ViewIdentity(ListView):
+@method_decorator(vary_on_headers("Accept"), name="get")
+@method_decorator(cache_page_by_ap_json(public_only=True), name="get")
+@method_decorator(cache_page_by_ap_json(public_only=True), name="aget")
+class ViewIdentity(AsyncCapableView, ListView):
     """
     Shows identity profile pages, and also acts as the Actor endpoint when
     approached with the right Accept header.
@@ -42,6 +46,27 @@ class ViewIdentity(ListView):
             local=False,
             fetch=False,
         )
+        return self.serve(request)
+
+    async def aget(self, request, handle):
+        self.identity = await aby_handle_or_404(self.request, handle)
+        if not self.identity.local:
+            # Just a redirect
+            response = self.serve(request)
+        elif request.ap_json:
+            # to_ap() looks up emojis, so needs to run in a thread
+            actor = await sync_to_async(self.identity.to_ap)()
+            response = JsonResponse(
+                canonicalise(actor, include_security=True),
+                content_type="application/activity+json",
+            )
+        else:
+            # The HTML page is still built synchronously
+            response = await sync_to_async(self.serve)(request)
+        patch_vary_headers(response, ["Accept"])
+        return response
+
+    def serve(self, request):
         # If it's remote, redirect to its profile page
         if not self.identity.local:
             if self.identity.profile_uri:
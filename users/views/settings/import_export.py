@@ -1,8 +1,10 @@
+import codecs
 import csv
+import itertools
 
 from django import forms
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import redirect
 from django.utils.decorators import method_decorator
 from django.views.generic import FormView, View
@@ -29,31 +31,35 @@ class ImportExportPage(IdentityViewMixin, FormView):
 
     def form_valid(self, form):
         # Load CSV (we don't touch the DB till the whole file comes in clean)
+        # It's read a line at a time so big lists don't sit in memory twice
         try:
-            lines = form.cleaned_data["csv"].read().decode("utf-8").splitlines()
-            reader = csv.DictReader(lines)
-            prepared_data = []
+            reader = csv.DictReader(
+                codecs.iterdecode(form.cleaned_data["csv"], "utf-8")
+            )
+            by_domain: dict[str, list[dict]] = {}
             for row in reader:
                 entry = {
-                    "handle": row["Account address"],
+                    "handle": row["Account address"].strip().lstrip("@"),
                     "boosts": not (row["Show boosts"].lower().strip()[0] == "f"),
                 }
                 if len(entry["handle"].split("@")) != 2:
                     raise ValueError("Handle looks wrong")
-                prepared_data.append(entry)
-        except (TypeError, ValueError):
+                domain = entry["handle"].split("@")[1].lower()
+                by_domain.setdefault(domain, []).append(entry)
+        except (TypeError, ValueError, KeyError, IndexError):
             return redirect(".?bad_format=following")
-        # For each one, add an inbox message to create that follow
-        # We can't do them all inline here as the identity fetch might take ages
-        for entry in prepared_data:
-            InboxMessage.create_internal(
-                {
-                    "type": "AddFollow",
-                    "source": self.identity.pk,
-                    "target_handle": entry["handle"],
-                    "boosts": entry["boosts"],
-                }
-            )
+        # Add one inbox message per server to create those follows; we can't
+        # do them inline here as the identity fetches might take ages, and
+        # grouping them means each server gets asked about them in turn.
+        InboxMessage.create_internal_many(
+            {
+                "type": "AddFollows",
+                "source": self.identity.pk,
+                "domain": domain,
+                "follows": entries,
+            }
+            for domain, entries in by_domain.items()
+        )
         return redirect(".?success=following")
 
     def get_context_data(self, **kwargs):
@@ -69,6 +75,16 @@ class ImportExportPage(IdentityViewMixin, FormView):
         return context
 
 
+class Echo:
+    """
+    File-like object that just hands back what is written to it, so the
+    csv writer can feed a streaming response one row at a time
+    """
+
+    def write(self, value):
+        return value
+
+
 class CsvView(IdentityViewMixin, View):
     """
     Generic view that exports a queryset as a CSV
@@ -85,31 +101,40 @@ class CsvView(IdentityViewMixin, View):
         raise NotImplementedError()
 
     def get(self, request, *args, **kwargs):
-        response = HttpResponse(
+        writer = csv.writer(Echo())
+        return StreamingHttpResponse(
+            (
+                writer.writerow(row)
+                for row in itertools.chain(
+                    [self.columns.keys()],
+                    (
+                        self.get_row(item)
+                        for item in self.get_queryset(request).iterator()
+                    ),
+                )
+            ),
             content_type="text/csv",
             headers={"Content-Disposition": f'attachment; filename="{self.filename}"'},
         )
-        writer = csv.writer(response)
-        writer.writerow(self.columns.keys())
-        for item in self.get_queryset(request):
-            row = []
-            for attrname in self.columns.values():
-                # Get value
-                getter = getattr(self, attrname, None)
-                if getter:
-                    value = getter(item)
-                elif hasattr(item, attrname):
-                    value = getattr(item, attrname)
-                else:
-                    raise ValueError(f"Cannot export attribute {attrname}")
-                # Make it into CSV format
-                if isinstance(value, bool):
-                    value = "true" if value else "false"
-                elif isinstance(value, int):
-                    value = str(value)
-                row.append(value)
-            writer.writerow(row)
-        return response
+
+    def get_row(self, item) -> list[str]:
+        row = []
+        for attrname in self.columns.values():
+            # Get value
+            getter = getattr(self, attrname, None)
+            if getter:
+                value = getter(item)
+            elif hasattr(item, attrname):
+                value = getattr(item, attrname)
+            else:
+                raise ValueError(f"Cannot export attribute {attrname}")
+            # Make it into CSV format
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            elif isinstance(value, int):
+                value = str(value)
+            row.append(value)
+        return row
 
 
 class CsvFollowing(CsvView):
@@ -123,7 +148,7 @@ class CsvFollowing(CsvView):
     filename = "following.csv"
 
     def get_queryset(self, request):
-        return self.identity.outbound_follows.active()
+        return self.identity.outbound_follows.active().select_related("target")
 
     def get_handle(self, follow: Follow):
         return follow.target.handle
@@ -143,7 +168,7 @@ class CsvFollowers(CsvView):
     filename = "followers.csv"
 
     def get_queryset(self, request):
-        return self.identity.inbound_follows.active()
+        return self.identity.inbound_follows.active().select_related("source")
 
     def get_handle(self, follow: Follow):
         return follow.source.handle
@@ -157,7 +182,11 @@ class CsvBlocks(CsvView):
     filename = "blocked_accounts.csv"
 
     def get_queryset(self, request):
-        return self.identity.outbound_blocks.active().filter(mute=False)
+        return (
+            self.identity.outbound_blocks.active()
+            .filter(mute=False)
+            .select_related("target")
+        )
 
     def get_handle(self, block: Block):
         return block.target.handle
@@ -172,7 +201,11 @@ class CsvMutes(CsvView):
     filename = "muted_accounts.csv"
 
     def get_queryset(self, request):
-        return self.identity.outbound_blocks.active().filter(mute=True)
+        return (
+            self.identity.outbound_blocks.active()
+            .filter(mute=True)
+            .select_related("target")
+        )
 
     def get_handle(self, mute: Block):
         return mute.target.handle